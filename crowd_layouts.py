@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import numpy as np
+
+'''
+Library of pregenerated, seeded crowd layouts.
+
+A library holds no_layouts initial crowds for one treatment and crowd size. Each layout is an array of
+(x, y, target_x, target_y) rows, one per pedestrian, and is reproducible from its seed. The layouts are
+stored in a .npy file (memory-mapped when loaded, so only the selected layout is read) next to a .json
+file holding the spec they were generated from and their seeds.
+
+Build the default libraries (they must match the crowd zones in main_moving_final.py):
+    python crowd_layouts.py --layouts 60 --size 40
+'''
+
+# Default layout spec of a treatment, mirrors the crowd variables in main_moving_final.py
+def default_spec(treatment, no_pedestrians, width = 1500, height = 840, pavement_height = 210, player_radius = 17.5):
+    finish_line_x = (2*width)-50
+    crowd_zones = {'H2': (finish_line_x - (width/2) + 50, finish_line_x + 50), 'H3': (-300, width/2 - 300)}
+    crowd_targets_x = {'H2': -100, 'H3': finish_line_x}
+    return {'treatment': treatment,
+            'no_pedestrians': no_pedestrians,
+            'x_min': crowd_zones[treatment][0],
+            'x_max': crowd_zones[treatment][1],
+            'y_min': (height - pavement_height) + 2*player_radius,
+            'y_max': height - 2*player_radius,
+            'target_x': crowd_targets_x[treatment],
+            'target_y_min': (height - pavement_height) + player_radius,
+            'target_y_max': height - player_radius,
+            'min_distance': 2*player_radius,
+            'player_x': 20,
+            'player_y': height - (pavement_height/2)}
+
+# Generate one layout by rejection sampling
+def generate_layout(seed, spec):
+    rng = np.random.default_rng(seed)
+    coords = np.empty((0, 2))
+    player = np.array([spec['player_x'], spec['player_y']])
+
+    while len(coords) < spec['no_pedestrians']:
+        candidate = np.array([rng.integers(int(spec['x_min']), int(spec['x_max']), endpoint = True),
+                              rng.integers(int(spec['y_min']), int(spec['y_max']), endpoint = True)], dtype = float)
+        # Check the candidate against the existing pedestrians and the player
+        if len(coords) and np.hypot(*(coords - candidate).T).min() < spec['min_distance']:
+            continue
+        if np.hypot(*(player - candidate)) < spec['min_distance']:
+            continue
+        coords = np.vstack([coords, candidate])
+
+    target_y = rng.integers(int(spec['target_y_min']), int(spec['target_y_max']), size = len(coords), endpoint = True)
+    targets = np.column_stack([np.full(len(coords), spec['target_x'], dtype = float), target_y])
+    return np.hstack([coords, targets])
+
+# Check that a layout respects its spec
+def validate_layout(layout, spec):
+    coords = layout[:, 0:2]
+    if len(layout) != spec['no_pedestrians']:
+        return False
+    if (coords[:, 0] < spec['x_min']).any() or (coords[:, 0] > spec['x_max']).any():
+        return False
+    if (coords[:, 1] < spec['y_min']).any() or (coords[:, 1] > spec['y_max']).any():
+        return False
+    distances = np.hypot(*(coords[:, None, :] - coords[None, :, :]).transpose(2, 0, 1))
+    np.fill_diagonal(distances, np.inf)
+    if distances.min() < spec['min_distance']:
+        return False
+    player = np.array([spec['player_x'], spec['player_y']])
+    return bool(np.hypot(*(coords - player).T).min() >= spec['min_distance'])
+
+# Paths of the library files of a treatment and crowd size
+def library_paths(directory, treatment, no_pedestrians):
+    base = os.path.join(directory, f'{treatment}_{no_pedestrians}')
+    return base + '.npy', base + '.json'
+
+# Generate and save a library of layouts
+def build_library(directory, spec, no_layouts, base_seed = 0):
+    os.makedirs(directory, exist_ok = True)
+    layouts_path, spec_path = library_paths(directory, spec['treatment'], spec['no_pedestrians'])
+    seeds = [base_seed + i for i in range(no_layouts)]
+
+    layouts = np.lib.format.open_memmap(layouts_path, mode = 'w+', dtype = np.float64,
+                                        shape = (no_layouts, spec['no_pedestrians'], 4))
+    for i, seed in enumerate(seeds):
+        layout = generate_layout(seed, spec)
+        if not validate_layout(layout, spec):
+            raise ValueError(f'Layout {i} (seed {seed}) of {layouts_path} is invalid')
+        layouts[i] = layout
+    layouts.flush()
+    del layouts
+
+    with open(spec_path, 'w') as f:
+        json.dump({'spec': spec, 'seeds': seeds}, f, indent = 2)
+
+# Load one layout by index, building the library first if it is missing or was built from another spec
+def load_layout(directory, spec, index, no_layouts = 60):
+    layouts_path, spec_path = library_paths(directory, spec['treatment'], spec['no_pedestrians'])
+    stored_spec = None
+    if os.path.exists(layouts_path) and os.path.exists(spec_path):
+        with open(spec_path) as f:
+            stored_spec = json.load(f)['spec']
+    if stored_spec != spec:
+        print(f'Building crowd layout library {layouts_path}')
+        build_library(directory, spec, no_layouts)
+
+    layouts = np.load(layouts_path, mmap_mode = 'r')
+    return np.array(layouts[index % len(layouts)]), len(layouts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Pregenerate seeded crowd layouts for the crowded treatments')
+    parser.add_argument('--directory', default = 'crowd_layouts')
+    parser.add_argument('--layouts', type = int, default = 60, help = 'number of layouts per treatment')
+    parser.add_argument('--size', type = int, nargs = '+', default = [40], help = 'crowd sizes to build')
+    parser.add_argument('--treatments', nargs = '+', default = ['H2', 'H3'])
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the first layout')
+    args = parser.parse_args()
+
+    for treatment in args.treatments:
+        for size in args.size:
+            build_library(args.directory, default_spec(treatment, size), args.layouts, args.seed)
+            print(f'Built {args.layouts} layouts for {treatment} with {size} pedestrians')
@@ -0,0 +1,236 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+'''
+Vectorised, strip-partitioned crowd stepper.
+
+The pavements are long and thin, so the crowd is split into x-strips of (roughly) equal agent count.
+Each strip is updated by one worker process against its own agents plus the halo agents that lie
+within B_s of the strip edges (no force or collision reaches further than that). Inside a strip the
+agents are taken in x-sorted blocks, each with its own halo, so the pairwise work stays small.
+
+Agent state lives in multiprocessing.shared_memory arrays:
+    state  - (capacity, 6) rows of x, y, v_x, v_y, target_x, target_y
+    output - (capacity, 8) rows of new x, new y, new v_x, new v_y and the proximity of the agent: index of
+             its closest agent (-1 if none is within the halo), the distance to it, the distance to the player
+             and whether its move collided (the distances are those of the collision check, so they are free)
+    params - agent count, player x, player y and the inner strip edges
+
+The main process writes the state, releases the workers through a barrier and waits on the same
+barrier for them to finish, so the crowd synchronises twice per Timestep (two barrier waits per step).
+By default there is one worker per core but one, which is left to the game loop.
+
+The physics mirrors Pedestrian.move_towards, except that every agent is updated from the positions
+at the start of the step rather than from the partially updated list.
+'''
+
+# Update the agents in owned (indices) against the agents in local (indices, must include owned)
+def step_agents(state, owned, local, player, constants, pavements, mid_y, timestep):
+    # Unpack constants
+    m, v_0, T_alpha, A_s, B_s, r, A_b, B_b = constants
+
+    pos = state[owned, 0:2]
+    vel = state[owned, 2:4]
+    targets = state[owned, 4:6]
+
+    # Neighbours are the local agents plus the player
+    neighbours = np.vstack([state[local, 0:2], np.asarray(player, dtype = float).reshape(1, 2)])
+    is_self = np.zeros((len(owned), len(neighbours)), dtype = bool)
+    is_self[:, :-1] = owned[:, None] == local[None, :]
+
+    # Social force from the neighbours within B_s
+    diff = pos[:, None, :] - neighbours[None, :, :]
+    distance = np.hypot(diff[..., 0], diff[..., 1])
+    interacting = (distance > 0) & (distance <= B_s) & ~is_self
+    safe_distance = np.where(interacting, distance, 1)
+    magnitude = np.where(interacting, A_s * np.exp(-(safe_distance - 2*r) / B_s) / safe_distance, 0)
+    F_s = (diff * magnitude[..., None]).sum(axis = 1)
+
+    # Boundary force from the closest edge of the agent's pavement
+    x, y = pos[:, 0], pos[:, 1]
+    bottom = y >= mid_y
+    x1 = np.where(bottom, pavements[1][0], pavements[0][0])
+    y1 = np.where(bottom, pavements[1][1], pavements[0][1])
+    x2 = np.where(bottom, pavements[1][2], pavements[0][2])
+    y2 = np.where(bottom, pavements[1][3], pavements[0][3])
+    distance_to_top = np.abs(y - y1)
+    distance_to_bottom = np.abs(y - y2)
+    closest_y = np.where(distance_to_top < distance_to_bottom, y1, y2)
+    distance_to_boundary = np.minimum(distance_to_top, distance_to_bottom)
+    distance_to_boundary = np.where(distance_to_boundary == 0, 1e-6, distance_to_boundary) # Prevent division by zero
+    closest_x = np.clip(x, x1, x2)
+    near = distance_to_boundary <= B_b
+    boundary_magnitude = np.where(near, A_b * np.exp((distance_to_boundary - r) / B_b) / distance_to_boundary, 0)
+    F_b = -np.stack([closest_x - x, closest_y - y], axis = 1) * boundary_magnitude[:, None]
+
+    # Target force
+    to_target = targets - pos
+    distance_to_target = np.hypot(to_target[:, 0], to_target[:, 1])
+    e_i = np.where(distance_to_target[:, None] > 0, to_target / np.where(distance_to_target > 0, distance_to_target, 1)[:, None], 0)
+    F_t = m * ((v_0 * e_i) - vel) / T_alpha
+
+    # Update the velocities and positions
+    new_vel = vel + (F_t + F_s + F_b) * timestep
+    new_pos = pos + new_vel * timestep
+
+    # Keep the agents on their pavement
+    below = new_pos[:, 1] < y1 + r
+    above = new_pos[:, 1] > y2 - r
+    new_pos[:, 1] = np.where(below, y1 + r, np.where(above, y2 - r, new_pos[:, 1]))
+    new_vel[:, 1] = np.where(below | above, 0, new_vel[:, 1])
+
+    # Agents whose new position is inside another agent (or the player) stay where they are
+    new_diff = new_pos[:, None, :] - neighbours[None, :, :]
+    new_distance = np.hypot(new_diff[..., 0], new_diff[..., 1])
+    collision = ((new_distance < 2*r) & ~is_self).any(axis = 1)
+    new_pos[collision] = pos[collision]
+
+    # Closest other agent and the player's distance, from the same distances (see proximity_events.py)
+    agent_distance = np.where(is_self[:, :-1], np.inf, new_distance[:, :-1])
+    nearest = agent_distance.argmin(axis = 1)
+    nearest_distance = agent_distance[np.arange(len(owned)), nearest]
+    nearest_index = np.where(np.isfinite(nearest_distance), local[nearest], -1)
+    proximity = np.column_stack([nearest_index, nearest_distance, new_distance[:, -1], collision])
+
+    # Cap the speed
+    speed = np.hypot(new_vel[:, 0], new_vel[:, 1])
+    scale = np.where(speed > v_0, v_0 / np.where(speed > 0, speed, 1), 1)
+    new_vel *= scale[:, None]
+
+    return new_pos, new_vel, proximity
+
+# Update the agents of one strip, in blocks of neighbouring agents so that the pairwise work stays small
+def step_strip(state, output, count, edges, strip, player, constants, pavements, mid_y, timestep, block_size = 128):
+    halo = constants[4] # B_s
+    lower = edges[strip - 1] if strip > 0 else -np.inf
+    upper = edges[strip] if strip < len(edges) else np.inf
+
+    x = state[:count, 0]
+    order = np.argsort(x, kind = 'stable')
+    sorted_x = x[order]
+    start = np.searchsorted(sorted_x, lower, 'left')
+    end = np.searchsorted(sorted_x, upper, 'left')
+
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        owned = order[block_start:block_end]
+        # The block plus the halo agents within B_s of it
+        local_start = np.searchsorted(sorted_x, sorted_x[block_start] - halo, 'left')
+        local_end = np.searchsorted(sorted_x, sorted_x[block_end - 1] + halo, 'right')
+        local = order[local_start:local_end]
+        new_pos, new_vel, proximity = step_agents(state, owned, local, player, constants, pavements, mid_y, timestep)
+        output[owned, 0:2] = new_pos
+        output[owned, 2:4] = new_vel
+        output[owned, 4:8] = proximity
+
+# Worker process: update one strip every time the barrier releases it
+def strip_worker(names, capacity, no_strips, strip, constants, pavements, mid_y, timestep, barrier):
+    blocks = [shared_memory.SharedMemory(name = name) for name in names]
+    state = np.ndarray((capacity, 6), dtype = np.float64, buffer = blocks[0].buf)
+    output = np.ndarray((capacity, 8), dtype = np.float64, buffer = blocks[1].buf)
+    params = np.ndarray((3 + no_strips - 1,), dtype = np.float64, buffer = blocks[2].buf)
+
+    while True:
+        barrier.wait()
+        count = int(params[0])
+        if count < 0:
+            break
+        step_strip(state, output, count, params[3:], strip, params[1:3], constants, pavements, mid_y, timestep)
+        barrier.wait()
+
+    del state, output, params
+    for block in blocks:
+        block.close()
+
+# Default number of workers, every core but the one running the game loop
+def default_workers():
+    return max(0, (os.cpu_count() or 1) - 1)
+
+# Crowd stepper class (no_workers = 0 steps the strips in this process, still vectorised, None uses default_workers())
+class CrowdStepper:
+    def __init__(self, capacity, constants, pavements, mid_y, timestep, no_workers = None):
+        self.capacity = capacity
+        self.constants = list(constants)
+        self.pavements = [tuple(pavement) for pavement in pavements]
+        self.mid_y = mid_y
+        self.timestep = timestep
+        # Without fork (Windows, macOS by default) every spawned worker would re-import the game script, so step in this process
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            no_workers = 0
+        elif no_workers is None:
+            no_workers = default_workers()
+        self.no_workers = no_workers
+        self.no_strips = max(1, no_workers)
+
+        # Shared agent state
+        sizes = [capacity * 6 * 8, capacity * 8 * 8, (3 + self.no_strips - 1) * 8]
+        self.blocks = [shared_memory.SharedMemory(create = True, size = size) for size in sizes]
+        self.state = np.ndarray((capacity, 6), dtype = np.float64, buffer = self.blocks[0].buf)
+        self.output = np.ndarray((capacity, 8), dtype = np.float64, buffer = self.blocks[1].buf)
+        self.params = np.ndarray((3 + self.no_strips - 1,), dtype = np.float64, buffer = self.blocks[2].buf)
+
+        # Start the workers (fork keeps the game script from being re-run in every worker)
+        self.workers = []
+        if no_workers:
+            context = multiprocessing.get_context('fork')
+            self.barrier = context.Barrier(no_workers + 1)
+            names = [block.name for block in self.blocks]
+            for strip in range(no_workers):
+                worker = context.Process(target = strip_worker, daemon = True,
+                                         args = (names, capacity, self.no_strips, strip, self.constants, self.pavements,
+                                                 mid_y, timestep, self.barrier))
+                worker.start()
+                self.workers.append(worker)
+
+    # Advance a crowd (see Crowd in main_moving_final.py) by one Timestep, towards targets (crowd.targets if None)
+    def step(self, crowd, player, targets = None):
+        count = len(crowd)
+        if count == 0:
+            return
+        if count > self.capacity:
+            raise ValueError(f'Crowd of {count} exceeds the stepper capacity of {self.capacity}')
+
+        self.state[:count, 0:2] = crowd.coords
+        self.state[:count, 2:4] = crowd.velocities
+        self.state[:count, 4:6] = crowd.targets if targets is None else targets
+
+        # Strip edges at the quantiles of x so that every strip gets a similar number of agents
+        edges = np.quantile(self.state[:count, 0], np.linspace(0, 1, self.no_strips + 1)[1:-1])
+        self.params[0] = count
+        self.params[1:3] = player
+        self.params[3:] = edges
+
+        if self.workers:
+            barrier = self.barrier
+            barrier.wait() # release the workers
+            barrier.wait() # wait for every strip to finish
+        else:
+            for strip in range(self.no_strips):
+                step_strip(self.state, self.output, count, edges, strip, player, self.constants, self.pavements,
+                           self.mid_y, self.timestep)
+
+        # Copy the results back into the crowd
+        new_state = self.output[:count, 0:4].tolist()
+        for i, (x, y, vel_x, vel_y) in enumerate(new_state):
+            crowd.pedestrians[i].x = x
+            crowd.pedestrians[i].y = y
+            crowd.coords[i] = (x, y)
+            crowd.velocities[i] = (vel_x, vel_y)
+
+    # Proximity of the agents in the last step (count, 4): closest agent index, its distance, player distance, collision
+    def proximity(self, count):
+        return self.output[:count, 4:8].copy()
+
+    def close(self):
+        if self.workers:
+            self.params[0] = -1
+            self.barrier.wait()
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+        del self.state, self.output, self.params
+        for block in self.blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,58 @@
+import numpy as np
+
+'''
+Headless warm-up of the initial crowds.
+
+The crowd layouts place every pedestrian at rest, so without a warm-up the first seconds of a crowded
+trial show the whole crowd accelerating together. warm_up steps a crowd spawned from the layout with the
+step the scenario will run (Crowd.step, with the scalar model or the parallel stepper as configured, and
+the navigation field if there is one), so the steady state comes from the same dynamics that take over
+when the trial starts. It runs in the calling thread, with no window, until the crowd has settled: the
+mean speed and the mean distance to the closest neighbour (from the step's collision check), averaged
+over windows of window seconds, change by less than tolerance from one window to the next. The scenario
+then spawns the settled positions and velocities instead of the layout.
+
+The warm-up runs in the crowd's own frame: after each step the mean drift along the street is taken back
+out (Crowd.shift), so the crowd settles its spacing and lanes where the layout put it and meets the player
+at the same point of the trial. The player stands at its start position throughout, so the settled crowd
+still keeps clear of it.
+'''
+
+# Mean speed and mean distance to the closest neighbour in a crowd's last step (see Crowd.proximity), None without neighbours
+def crowd_metrics(crowd):
+    proximity = np.asarray(crowd.proximity, dtype = float).reshape(-1, 9)
+    speed = float(np.hypot(proximity[:, 3], proximity[:, 4]).mean()) if len(proximity) else 0.0
+    spacing = proximity[:, 6][np.isfinite(proximity[:, 6])]
+    return speed, float(spacing.mean()) if len(spacing) else None
+
+# Warm up a crowd in place, step advances it by one timestep (eg lambda: crowd.step(stepper, start)), returns the warm-up stats
+def warm_up(crowd, step, timestep, max_time = 10, min_time = 1, window = 0.5, tolerance = 0.02):
+    stats = {'seconds': 0.0, 'converged': False, 'mean_speed': 0.0, 'mean_spacing': None}
+    if len(crowd) == 0:
+        return stats
+
+    window_steps = max(1, round(window / timestep))
+    speeds, spacings = [], []
+    previous = None
+    steps = 0
+    while steps * timestep < max_time and len(crowd):
+        drift = -np.reshape(crowd.coords, (-1, 2))[:, 0].mean()
+        step()
+        steps += 1
+        speed, spacing = crowd_metrics(crowd)
+        speeds.append(speed)
+        spacings.append(0.0 if spacing is None else spacing)
+        # Take the mean drift back out to stay in the crowd's frame (the step's positions are taken before anyone leaves)
+        drift += np.asarray(crowd.proximity, dtype = float).reshape(-1, 9)[:, 1].mean()
+        crowd.shift(-drift)
+
+        if steps % window_steps == 0:
+            current = (np.mean(speeds[-window_steps:]), np.mean(spacings[-window_steps:]))
+            if previous is not None and steps * timestep >= min_time and \
+               all(abs(value - last) <= tolerance * max(abs(last), 1e-9) for value, last in zip(current, previous)):
+                stats['converged'] = True
+                break
+            previous = current
+
+    stats.update({'seconds': steps * timestep, 'mean_speed': speeds[-1], 'mean_spacing': spacings[-1] or None})
+    return stats
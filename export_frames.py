@@ -0,0 +1,190 @@
+import argparse
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from replay import SessionReplay, latest_session
+from trajectory_compression import track_samples
+
+'''
+Offline export of recorded sessions to numbered frame sequences (for videos of the routes).
+
+Each trial is rendered headlessly (SDL dummy driver) with the game's own drawing code, exactly as
+replay.py shows it, and written as frames/participant_<p>/session_<s>_<position>_<treatment>/000000.png
+(or .rgb, raw RGB bytes, faster to write). The timelines are cut into chunks of chunk_frames frames
+which a process pool renders in parallel, so exporting a cohort scales with the number of cores.
+A chunk starting mid-trial renders the same frames as a sequential pass: the world streams in around
+the camera and the dynamic lights are a function of the trial time.
+
+Overlays:
+    trajectory - the player's path so far in the trial
+    heatmap    - where the participants of the whole store walked in the same treatment
+                 (player samples binned with occupancy.py)
+
+    python export_frames.py sessions.db --participants 63 64 --overlay trajectory
+    ffmpeg -framerate 30 -i frames/participant_63/session_1_1_H2/%06d.png -pix_fmt yuv420p H2.mp4
+'''
+
+# Per worker process: the game module, the open replays and the overlays already built
+worker_state = {}
+
+# Import the game in a worker (it opens its window on import, so this has to happen after the driver is set)
+def worker_game():
+    if 'game' not in worker_state:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        import main_moving_final as game
+        worker_state['game'] = game
+        worker_state['replays'] = {}
+        worker_state['trajectories'] = {}
+        worker_state['heatmaps'] = {}
+    return worker_state['game']
+
+def worker_replay(database, session_id):
+    key = (database, session_id)
+    if key not in worker_state['replays']:
+        worker_state['replays'][key] = SessionReplay(database, session_id)
+    return worker_state['replays'][key]
+
+# Player samples (time, x, y) of a trial
+def trial_trajectory(database, trial_id):
+    if trial_id not in worker_state['trajectories']:
+        with sqlite3.connect(f'file:{database}?mode=ro', uri = True) as connection:
+            rows = connection.execute('SELECT time, x, y FROM samples WHERE trial_id = ? ORDER BY time', (trial_id,)).fetchall()
+            track = connection.execute('SELECT data, first_time, last_time, points FROM tracks WHERE trial_id = ? AND pedestrian = -1', (trial_id,)).fetchone()
+        if track is not None: # stored compressed, resampled at the times of its samples
+            times, positions = track_samples(*track)
+            rows = np.column_stack([times, positions])
+        worker_state['trajectories'][trial_id] = np.array(rows).reshape(-1, 3)
+    return worker_state['trajectories'][trial_id]
+
+# Heatmap surface (the whole street, in render pixels) of the player samples of a treatment
+def treatment_heatmap(database, treatment, cell_size = 20):
+    if treatment not in worker_state['heatmaps']:
+        import pygame
+        from occupancy import OccupancyGrid
+        game = worker_state['game']
+        with sqlite3.connect(f'file:{database}?mode=ro', uri = True) as connection:
+            positions = np.array(connection.execute('SELECT x, y FROM samples WHERE treatment = ?', (treatment,)).fetchall()).reshape(-1, 2)
+            tracks = connection.execute('SELECT data, first_time, last_time, points FROM tracks WHERE treatment = ? AND pedestrian = -1', (treatment,)).fetchall()
+        positions = np.vstack([positions] + [track_samples(*track)[1] for track in tracks])
+        grid = OccupancyGrid(game.road_start, game.road_end, 0, game.height, cell_size, game.segment_length)
+        grid.add(positions, np.zeros_like(positions), 1)
+        counts = grid.grid('samples').T # (no_x, no_y) like surfarray
+        level = np.log1p(counts) / max(np.log1p(counts.max()), 1e-9)
+
+        cells = pygame.Surface(counts.shape, pygame.SRCALPHA)
+        colour = pygame.surfarray.pixels3d(cells)
+        colour[..., 0] = 255
+        colour[..., 1] = (255 * (1 - level)).astype(np.uint8)
+        colour[..., 2] = 0
+        del colour
+        alpha = pygame.surfarray.pixels_alpha(cells)
+        alpha[...] = (170 * level).astype(np.uint8)
+        del alpha
+        size = (round(grid.no_x * cell_size * game.render_scale), round(grid.no_y * cell_size * game.render_scale))
+        worker_state['heatmaps'][treatment] = pygame.transform.smoothscale(cells, size)
+    return worker_state['heatmaps'][treatment]
+
+# Render frames first to last - 1 of one trial (runs in a worker process), returns the number written and the frame size
+def render_chunk(job):
+    game = worker_game()
+    import pygame
+    replay = worker_replay(job['database'], job['session_id'])
+    trial = replay.trials[job['trial']]
+    spec = game.scenario_specs[trial['treatment']]
+    world = game.World(spec['bright_side'], dynamic_lights = spec['dynamic_lights'], seed = replay.participant)
+    screen = game.screen
+    font = pygame.font.Font(None, round(26 * game.render_scale))
+    os.makedirs(job['directory'], exist_ok = True)
+
+    player_y = game.height - (game.pavement_height/2)
+    for frame in range(job['first'], job['last']):
+        local_t = frame / job['fps']
+        _, local_t, player, pedestrians, clicks = replay.state(trial['start'] + local_t)
+        if player is not None:
+            player_x, player_y = player
+        else:
+            player_x = game.player_x
+        camera_offset_x = player_x - game.width/2
+        world.update(camera_offset_x)
+        world.update_lights(local_t, player_x)
+        game.draw_scenario(screen, world, spec['goal_x'], player_y, pedestrians, camera_offset_x)
+
+        if job['overlay'] == 'heatmap':
+            screen.blit(treatment_heatmap(job['database'], trial['treatment']), (round((game.road_start - camera_offset_x) * game.render_scale), 0))
+        elif job['overlay'] == 'trajectory':
+            samples = trial_trajectory(job['database'], trial['id'])
+            path = samples[:np.searchsorted(samples[:, 0], local_t, side = 'right'), 1:3].tolist() + [[player_x, player_y]]
+            if len(path) > 1:
+                pygame.draw.lines(screen, game.target_colour, False, [game.scaled_point(x - camera_offset_x, y) for x, y in path],
+                                  max(1, round(3 * game.render_scale)))
+        if job['caption']:
+            caption = f"Participant {replay.participant}   {trial['treatment']}   {local_t:6.2f} s"
+            screen.blit(font.render(caption, True, game.road_marking_colour), game.scaled_point(20, game.height - 40))
+
+        path = os.path.join(job['directory'], f"{frame:06d}.{job['format']}")
+        if job['format'] == 'png':
+            pygame.image.save(screen, path)
+        else:
+            with open(path, 'wb') as f:
+                f.write(pygame.image.tobytes(screen, 'RGB'))
+    return job['last'] - job['first'], screen.get_size()
+
+# Chunks of every trial of the sessions (optionally only some treatments)
+def export_jobs(database, session_ids, out_dir, fps, chunk_frames, image_format, overlay, caption, treatments = None):
+    jobs = []
+    for session_id in session_ids:
+        replay = SessionReplay(database, session_id)
+        for k, trial in enumerate(replay.trials):
+            if treatments is not None and trial['treatment'] not in treatments:
+                continue
+            directory = os.path.join(out_dir, f'participant_{replay.participant}', f"session_{session_id}_{k + 1}_{trial['treatment']}")
+            no_frames = math.ceil(trial['duration'] * fps)
+            for first in range(0, no_frames, chunk_frames):
+                jobs.append({'database': database, 'session_id': session_id, 'trial': k, 'first': first, 'last': min(first + chunk_frames, no_frames),
+                             'fps': fps, 'directory': directory, 'format': image_format, 'overlay': overlay, 'caption': caption})
+        replay.connection.close()
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Render recorded sessions to numbered frames')
+    parser.add_argument('database', nargs = '?', default = 'sessions.db')
+    group = parser.add_mutually_exclusive_group(required = True)
+    group.add_argument('--participants', type = int, nargs = '+', help = "export the participants' latest sessions")
+    group.add_argument('--sessions', type = int, nargs = '+', help = 'session ids')
+    group.add_argument('--all', action = 'store_true', help = 'every completed session')
+    parser.add_argument('--treatments', nargs = '+', help = 'only these treatments (default all)')
+    parser.add_argument('--out', default = 'frames')
+    parser.add_argument('--fps', type = int, default = 30)
+    parser.add_argument('--format', default = 'png', choices = ('png', 'rgb'))
+    parser.add_argument('--overlay', default = 'none', choices = ('none', 'trajectory', 'heatmap'))
+    parser.add_argument('--no-caption', action = 'store_true')
+    parser.add_argument('--chunk-frames', type = int, default = 150)
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (default every core)')
+    args = parser.parse_args()
+
+    if args.all:
+        with sqlite3.connect(f'file:{args.database}?mode=ro', uri = True) as connection:
+            session_ids = [row[0] for row in connection.execute('SELECT id FROM sessions WHERE completed = 1 ORDER BY id')]
+    elif args.sessions:
+        session_ids = args.sessions
+    else:
+        session_ids = [latest_session(args.database, participant) for participant in args.participants]
+
+    jobs = export_jobs(args.database, session_ids, args.out, args.fps, args.chunk_frames, args.format, args.overlay, not args.no_caption, args.treatments)
+    no_frames = sum(job['last'] - job['first'] for job in jobs)
+    print(f'Rendering {no_frames} frames of {len(session_ids)} sessions in {len(jobs)} chunks')
+    start = time.perf_counter()
+    done = 0
+    size = None
+    with ProcessPoolExecutor(max_workers = args.workers) as pool:
+        for written, size in pool.map(render_chunk, jobs):
+            done += written
+            print(f'\r{done}/{no_frames} frames', end = '', flush = True)
+    elapsed = time.perf_counter() - start
+    print(f'\n{no_frames} frames in {elapsed:.1f} s ({no_frames / max(elapsed, 1e-9):.0f} frames/s) in {args.out}')
+    if args.format == 'rgb' and size is not None:
+        print(f'Raw frames are {size[0]}x{size[1]} RGB24 (ffmpeg -f image2 -c:v rawvideo -pixel_format rgb24 -video_size {size[0]}x{size[1]} ...)')
@@ -0,0 +1,134 @@
+import statistics
+import time
+import pygame
+
+'''
+Frame pacing and input-to-photon latency measurement.
+
+Modes:
+    fixed  - pygame.time.Clock.tick(fps), sleeps with SDL_Delay (coarse, but the historical behaviour)
+    vsync  - the display is opened with vsync so display.update() waits for the refresh, no extra cap
+    hybrid - uncapped loop that sleeps until sleep_margin before the frame deadline and then busy-waits,
+             which gives tight frame times without vsync
+
+The physics does not step once per frame: physics_steps(dt) runs a fixed-step accumulator, so the game
+advances physics_rate Timesteps per second of real time whatever the frame rate or refresh rate (a 144 Hz
+vsync display shows the same motion as a 60 Hz one, with some frames repeating a step).
+
+Latency is handling-to-present latency: it is measured from when the game handles a MOUSEBUTTONDOWN
+to the first presented frame (after display.update() returns) showing a physics step that moved the
+player towards the clicked target. A frame that only shows the player still walking to its previous
+target does not end the measurement, so clicks made while walking are not cut short by motion the click
+did not cause. pygame events carry no timestamp, so the time the event waited in the queue (up to a
+frame) is not included, and the figure understates input-to-photon latency by that much.
+'''
+
+frame_modes = ('fixed', 'vsync', 'hybrid')
+
+# Frame pacer class
+class FramePacer:
+    def __init__(self, mode, fps, physics_rate = None, sleep_margin = 0.002, max_steps = 5):
+        if mode not in frame_modes:
+            raise ValueError(f'Unknown frame pacing mode {mode!r}, expected one of {frame_modes}')
+        self.mode = mode
+        self.fps = fps
+        self.period = 1 / fps
+        self.sleep_margin = sleep_margin
+        self.physics_rate = fps if physics_rate is None else physics_rate # physics steps per second of real time
+        self.max_steps = max_steps # most steps run in one frame, after a stall the game slows down rather than jumping
+        self.accumulator = 0.0
+        self.clock = pygame.time.Clock()
+        # The first tick starts SDL's timer, pygame.time.get_ticks() returns 0 until then without pygame.init()
+        self.clock.tick()
+        self.last_frame = None
+        self.deadline = None
+
+        # Session stats
+        self.frame_times = [] # seconds between consecutive frames
+        self.latencies = [] # seconds from handling a click to the first presented frame showing the player move towards it
+        self.pending_click = None # (time of the click, its number)
+        self.no_clicks = 0 # clicks handled
+        self.stepped_click = 0 # number of the latest click the player has been stepped towards
+
+    # Arguments for pygame.display.set_mode
+    def display_flags(self):
+        if self.mode == 'vsync':
+            return pygame.SCALED, 1 # vsync needs a renderer, which SCALED provides
+        return 0, 0
+
+    # Wait for the next frame and return the time since the previous one (seconds)
+    def tick(self):
+        if self.mode == 'fixed':
+            self.clock.tick(self.fps)
+        elif self.mode == 'hybrid':
+            now = time.perf_counter()
+            if self.deadline is None or now - self.deadline > self.period:
+                self.deadline = now # fell too far behind, do not try to catch up
+            else:
+                # Sleep for most of the wait, then spin for the rest
+                remaining = self.deadline - now
+                if remaining > self.sleep_margin:
+                    time.sleep(remaining - self.sleep_margin)
+                while time.perf_counter() < self.deadline:
+                    pass
+            self.deadline += self.period
+
+        now = time.perf_counter()
+        dt = self.period if self.last_frame is None else now - self.last_frame
+        self.last_frame = now
+        self.frame_times.append(dt)
+        return dt
+
+    # Number of physics steps to run for a frame that took dt seconds
+    def physics_steps(self, dt):
+        self.accumulator = min(self.accumulator + dt * self.physics_rate, self.max_steps)
+        steps = int(self.accumulator)
+        self.accumulator -= steps
+        return steps
+
+    # Clear the stats (eg at the start of a new session)
+    def reset_stats(self):
+        self.frame_times = []
+        self.latencies = []
+        self.pending_click = None
+
+    # Record a click which sets a new target (call when the MOUSEBUTTONDOWN event is handled, the measurement starts then
+    # rather than when the event arrived)
+    def click(self):
+        self.no_clicks += 1
+        if self.pending_click is None:
+            self.pending_click = (time.perf_counter(), self.no_clicks)
+
+    # Record a physics step of the player towards its current target (the latest click's)
+    def stepped(self):
+        self.stepped_click = self.no_clicks
+
+    # Record a presented frame (call after pygame.display.update)
+    def presented(self):
+        if self.pending_click is not None and self.stepped_click >= self.pending_click[1]:
+            self.latencies.append(time.perf_counter() - self.pending_click[0])
+            self.pending_click = None
+
+    # Discard a click which can no longer move the player (eg the end of a scenario)
+    def cancel_click(self):
+        self.pending_click = None
+
+    # Summary of the session's frame times and latencies
+    def stats(self):
+        stats = {'Frame_mode': self.mode}
+        frame_times = self.frame_times[1:]
+        if len(frame_times) > 1:
+            frame_ms = [t * 1000 for t in frame_times]
+            stats['Frame_rate_mean'] = len(frame_times) / sum(frame_times)
+            stats['Frame_time_mean_ms'] = statistics.fmean(frame_ms)
+            stats['Frame_time_sd_ms'] = statistics.pstdev(frame_ms)
+            stats['Frame_time_p99_ms'] = statistics.quantiles(frame_ms, n = 100)[98]
+            stats['Frame_time_max_ms'] = max(frame_ms)
+        stats['Latency_samples'] = len(self.latencies)
+        if len(self.latencies) > 1:
+            latency_ms = [t * 1000 for t in self.latencies]
+            stats['Latency_mean_ms'] = statistics.fmean(latency_ms)
+            stats['Latency_sd_ms'] = statistics.pstdev(latency_ms)
+            stats['Latency_p95_ms'] = statistics.quantiles(latency_ms, n = 20)[18]
+            stats['Latency_max_ms'] = max(latency_ms)
+        return stats
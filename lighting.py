@@ -0,0 +1,138 @@
+import bisect
+import random
+import pygame
+
+'''
+Dynamic lighting with incremental lightmap updates.
+
+The dimmed overlay is kept in world coordinates as one tile per world segment instead of being rebuilt
+on the screen every frame. A tile is composited once when its segment is generated (filled with the
+dimness, then every light overlapping it subtracted with BLEND_RGBA_SUB, using the shared sprites
+from lights()). After that only the rectangles of lights that changed state are recomposited, and a
+frame with no changes only blits the visible tiles. Subtraction saturates at zero, so the lights
+overlapping a dirty rectangle can be added back in any order. Lights are placed in world coordinates;
+with a render scale the tiles and sprites are scaled once and the tile edges are rounded from the
+world edges, so neighbouring tiles neither overlap nor leave gaps.
+
+Light modes:
+    on        - always lit (the static lighting of the original treatments)
+    failed    - never lit
+    flicker   - switches on and off at random intervals, seeded so a replay sees the same pattern
+    proximity - lit while the player is within switch_on_distance pixels (x) of the lamp
+'''
+
+light_modes = ('on', 'failed', 'flicker', 'proximity')
+
+# Light class (one lamp, in world coordinates)
+class Light:
+    def __init__(self, sprite, x, y, mode = 'on', seed = 0, switch_on_distance = None):
+        if mode not in light_modes:
+            raise ValueError(f'Unknown light mode {mode!r}, expected one of {light_modes}')
+        self.sprite = sprite
+        self.rect = sprite.get_rect(topleft = (round(x), round(y)))
+        self.mode = mode
+        self.switch_on_distance = switch_on_distance
+        self.lit = mode == 'on'
+
+        # Flicker: times at which the light toggles, extended as time goes on
+        self.rng = random.Random(seed)
+        self.toggles = [0]
+
+    # Update the state for time t (seconds into the scenario), returns True if the light changed
+    def update(self, t, player_x):
+        if self.mode == 'flicker':
+            while self.toggles[-1] <= t:
+                on = len(self.toggles) % 2 == 1 # even toggles switch the light on
+                self.toggles.append(self.toggles[-1] + (self.rng.uniform(0.05, 0.8) if on else self.rng.uniform(0.03, 0.3)))
+            lit = bisect.bisect_right(self.toggles, t) % 2 == 1
+        elif self.mode == 'proximity':
+            lit = abs(player_x - self.rect.centerx) < self.switch_on_distance
+        else:
+            return False
+        changed = lit != self.lit
+        self.lit = lit
+        return changed
+
+# Lightmap class (tiles of the dimmed overlay, one per world segment)
+class Lightmap:
+    def __init__(self, origin_x, tile_width, height, dimness, scale = 1):
+        self.origin_x = int(origin_x)
+        self.tile_width = int(tile_width)
+        self.height = height
+        self.dimness = dimness
+        self.scale = scale
+        self.tiles = {} # segment index -> Surface
+        self.lights = [] # lights of the generated segments
+        self.sprites = {} # light sprite -> sprite at the render scale
+
+    def tile_x(self, index):
+        return self.origin_x + index * self.tile_width
+
+    # Left edge of a tile in render pixels
+    def tile_left(self, index):
+        return round(self.tile_x(index) * self.scale)
+
+    # World rectangle in render pixels
+    def scaled(self, rect):
+        left, top = round(rect.left * self.scale), round(rect.top * self.scale)
+        return pygame.Rect(left, top, round(rect.right * self.scale) - left, round(rect.bottom * self.scale) - top)
+
+    def scaled_sprite(self, sprite):
+        if self.scale == 1:
+            return sprite
+        if sprite not in self.sprites:
+            self.sprites[sprite] = pygame.transform.smoothscale(sprite, (round(sprite.get_width() * self.scale), round(sprite.get_height() * self.scale)))
+        return self.sprites[sprite]
+
+    # Tiles overlapped by a world rectangle
+    def tile_range(self, rect):
+        first = int((rect.left - self.origin_x) // self.tile_width)
+        last = int((rect.right - 1 - self.origin_x) // self.tile_width)
+        return range(first, last + 1)
+
+    def add_tile(self, index):
+        self.tiles[index] = pygame.Surface((self.tile_left(index + 1) - self.tile_left(index), round(self.height * self.scale)), pygame.SRCALPHA)
+        self.composite(pygame.Rect(self.tile_x(index), 0, self.tile_width, self.height))
+
+    def remove_tile(self, index):
+        del self.tiles[index]
+
+    def add_lights(self, lights):
+        self.lights.extend(lights)
+        for light in lights:
+            self.composite(light.rect)
+
+    def remove_lights(self, lights):
+        for light in lights:
+            self.lights.remove(light)
+
+    # Recomposite a world rectangle in every tile it overlaps
+    def composite(self, rect):
+        lights = [light for light in self.lights if light.lit and light.rect.colliderect(rect)]
+        for index in self.tile_range(rect):
+            tile = self.tiles.get(index)
+            if tile is None:
+                continue
+            tile_left = self.tile_left(index)
+            local = self.scaled(rect).move(-tile_left, 0).clip(tile.get_rect())
+            tile.set_clip(local)
+            tile.fill((0, 0, 0, self.dimness), local)
+            for light in lights:
+                position = self.scaled(light.rect).move(-tile_left, 0).topleft
+                tile.blit(self.scaled_sprite(light.sprite), position, special_flags = pygame.BLEND_RGBA_SUB)
+            tile.set_clip(None)
+
+    # Update the lights for time t and recomposite the ones that changed, returns the number of changes
+    def update(self, t, player_x):
+        changed = [light for light in self.lights if light.update(t, player_x)]
+        for light in changed:
+            self.composite(light.rect)
+        return len(changed)
+
+    # Blit the tiles on the screen (only the visible ones)
+    def draw(self, screen, camera_offset_x):
+        screen_width = screen.get_width()
+        for index, tile in self.tiles.items():
+            x = self.tile_left(index) - round(camera_offset_x * self.scale)
+            if -tile.get_width() < x < screen_width:
+                screen.blit(tile, (x, 0))
@@ -1,26 +1,46 @@
+from startup_timing import StartupTimer # first, so that the imports below are timed
 import pygame
 import random
 import math
 import csv
-import pandas as pd
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from frame_pacing import FramePacer
+from session_store import SessionStore
+from lighting import Light, Lightmap
+from telemetry import TelemetryPublisher
+from memory_monitor import MemoryMonitor, estimate_size, surface_size
+# pandas and the numpy based modules (crowd_parallel, occupancy, crowd_layouts) are imported where they are
+# first needed, so the consent screen does not wait for them
 
 # Participant number
 participant_number = 63
 
+# Kiosk mode runs sessions back to back in one process: participant numbers continue from the saved data,
+# treatments are counterbalanced by participant number and the fonts, light sprites and layouts are reused
+kiosk_mode = False
+
+# Start-up budget in seconds per phase (the timing report is printed once the consent screen is up)
+startup_budget = {'imports': 0.3, 'pygame_init': 0.5, 'first_screen': 0.2, 'crowd_workers': 1.0, 
+                  'asset_build': 0.5, 'crowd_generation': 1.0, 'navigation_field': 0.5, 'crowd_warmup': 2.0}
+startup_timer = StartupTimer(startup_budget)
+startup_timer.mark('imports')
+
 # Treatment possibilities
 treatment_scenarios = [('H1', 'H2', 'H3'), ('H1', 'H3', 'H2'), ('H2', 'H1', 'H3'), ('H2', 'H3', 'H1'), ('H3', 'H1', 'H2'), ('H3', 'H2', 'H1')]
 
-# Pick a random treatment scenario
+# Pick a random treatment scenario (kiosk mode uses counterbalanced_treatment instead)
 treatment = random.choice(treatment_scenarios)
 # treatment = ('H2', 'H3', 'H1')
 
 # Game variables/constants
 width, height = 1500, 840
-road_width = 3*width
 pavement_height = 210
 road_height = 420
 # curb_height = 10
-no_road_markings = 30
+road_marking_spacing = 150
 road_marking_width = 100
 road_marking_height = 30
 light_pole_height = 20
@@ -36,9 +56,19 @@ player_radius = 17.5
 player_velocity = [0,0]
 FPS = 60
 Timestep = 1/FPS
+frame_mode = 'fixed' # frame pacing: 'fixed' (clock.tick), 'vsync' or 'hybrid' (uncapped sleep then busy-wait)
+# Physics steps (of Timestep) per second of real time, the same at any frame rate. The original loop ticked the clock twice per
+# frame, so every participant recorded so far saw FPS/2 steps a second (the player and crowd at half their nominal speed).
+# FPS would run them at nominal speed, which changes the stimulus and so the protocol
+physics_rate = FPS / 2
+render_scale = 1 # draw at this fraction of width x height (eg 0.5 on fill-rate bound machines), the game still runs in width x height units
+render_present = 'scaled' # how a reduced render reaches the window: 'scaled' (pygame.SCALED, scaled by SDL's renderer, best with 1/2 or 1/3)
+                          # or 'smoothscale' (filtered on the CPU into a width x height window)
 no_pedestrians = 40
 x_closest_pedestrians = 20
-num_lights = 24
+parallel_crowd = False # step the crowds with the strip-partitioned stepper (for high-density conditions)
+crowd_workers = None # worker processes used by the stepper, None for one per core but one (0 steps the strips in this process, as do platforms without fork)
+crowd_capacity = 5000 # largest crowd the stepper can hold
 player_x = 20
 target_size = 30
 no_targets = 3   
@@ -48,10 +78,74 @@ target_colour = (0, 255, 0)
 dash_length = 10
 gap_length = 5
 
+# Streaming world variables (the street is split into segments holding one bright and one dim light each)
+segment_length = 375
+segments_ahead = 7 # segments generated ahead of the camera
+segments_behind = 2 # segments kept behind the camera before they are released
+finish_line_x = (2*width)-50 # increase to study longer routes
+road_start = -width/2
+road_end = finish_line_x + (width/2) + 50
+
 # Pedstrian target
 target_bottom = height - pavement_height
 H2_target_x = -100
-H3_target_x = (2*width)-50
+H3_target_x = finish_line_x
+
+# Scenario definitions (a new treatment only needs a new entry here)
+#   bright_side     - side of the road with the bright lights: 'bottom', 'top' or 'switch' (bottom, then top halfway along the road)
+#   crowd           - spawn zone (x_min, x_max) and target x of the crowd, or None for an empty street. Each segment spawns
+#                     the pedestrians of the crowd layout that start in it
+#   goal_x          - the scenario ends when the player passes this x (the dashed red line)
+#   log_pedestrians - save the pedestrian positions with the session
+#   dynamic_lights  - None for static lighting, or the share of lamps that have 'failed' and that 'flicker' and the
+#                     distance at which the other lamps switch on as the player approaches ('proximity', None keeps them on),
+#                     eg {'failed': 0.1, 'flicker': 0.1, 'proximity': 400}. Lamps are picked with the participant number as seed
+#   navigation      - None steers the crowd straight at its targets, or the settings of the lighting-aware navigation field
+#                     the crowd follows instead (see navigation.py): {'darkness_cost': k}, the extra cost of walking through
+#                     the dark relative to a lit cell (0 only follows the shortest route, higher values hug the lamps)
+scenario_specs = {'H1': {'bright_side': 'switch', 'crowd': None, 'goal_x': finish_line_x, 'log_pedestrians': False, 'dynamic_lights': None, 'navigation': None},
+                  'H2': {'bright_side': 'bottom', 'crowd': {'zone': (finish_line_x - (width/2) + 50, finish_line_x + 50), 'target_x': H2_target_x}, 
+                         'goal_x': finish_line_x, 'log_pedestrians': True, 'dynamic_lights': None, 'navigation': None},
+                  'H3': {'bright_side': 'top', 'crowd': {'zone': (-300, width/2 - 300), 'target_x': H3_target_x}, 
+                         'goal_x': finish_line_x, 'log_pedestrians': True, 'dynamic_lights': None, 'navigation': None}}
+
+# SQLite store of every session (see session_store.py), written alongside the CSV files
+# Pedestrian and player paths are stored compressed (see trajectory_compression.py): positions are quantised to
+# trajectory_resolution pixels and simplified to within trajectory_tolerance pixels for the pedestrians and
+# trajectory_player_tolerance pixels for the player (None keeps every sample)
+session_store_path = 'sessions.db'
+telemetry_name = 'virtual_experiment_telemetry' # shared-memory ring read by observer.py (see telemetry.py), None turns it off
+trajectory_resolution = 0.1
+trajectory_tolerance = 0.5
+trajectory_player_tolerance = 0.2
+
+# Memory monitor (see memory_monitor.py): a report every memory_report_interval seconds and a warning as soon as the
+# process uses more than memory_budget_mb. memory_trace traces the Python allocations with tracemalloc from the start
+# (much slower, otherwise tracing starts when the budget is crossed) so the reports list the lines whose allocations grow.
+# The reports and warnings are printed and kept with the session in the session_log table of the session store
+memory_budget_mb = 1500
+memory_report_interval = 30
+memory_trace = False
+
+# Proximity events of the crowded trials (see proximity_events.py): contacts, near misses (closer than near_miss_factor * 2r)
+# and times to collision under ttc_threshold seconds, between the player and the crowd and within the crowd
+near_miss_factor = 1.4
+ttc_threshold = 1.0
+
+# Crowd layouts (pregenerated by crowd_layouts.py and picked by index, so crowds are reproducible and balanced)
+# The participant number is used as the layout index for both H2 and H3
+crowd_layout_dir = 'crowd_layouts'
+
+# Crowd warm-up (see crowd_warmup.py): the layout of each crowded scenario is walked headlessly, while the instructions before
+# the scenario are read, until the crowd's speed and spacing have settled (at most crowd_warmup_max_time seconds), so every
+# trial starts with the crowd already walking. False starts the crowds at rest
+crowd_warmup = True
+crowd_warmup_max_time = 10
+
+# Navigation field (used by the scenarios with a 'navigation' spec): cell size in pixels, and how far down the field
+# (pixels) each pedestrian's target is placed every step
+navigation_cell_size = 15
+navigation_lookahead = 50
 
 '''
 Helbing's Social Force Model defines the following constants:
@@ -104,13 +198,46 @@ B_b = 30 # Characteristic distance between pedestrian and boundary
 
 pedestrian_constants = [m, v_0, T_alpha, A_s, B_s, r, A_b, B_b]
 
-# Initialize pygame
-pygame.init()
-screen = pygame.display.set_mode((width, height))
+# Initialize pygame (only the modules the game uses)
+pygame.display.init()
+pygame.font.init()
+frame_pacer = FramePacer(frame_mode, FPS, physics_rate)
+display_flags, vsync = frame_pacer.display_flags()
+render_size = (round(width * render_scale), round(height * render_scale))
+if render_scale == 1:
+    screen = pygame.display.set_mode((width, height), display_flags, vsync=vsync)
+    window = screen
+elif render_present == 'scaled':
+    screen = pygame.display.set_mode(render_size, display_flags | pygame.SCALED, vsync=vsync)
+    window = screen
+else:
+    # Draw into an offscreen surface, present() filters it into the window
+    window = pygame.display.set_mode((width, height), display_flags, vsync=vsync)
+    screen = pygame.Surface(render_size)
 pygame.display.set_caption('Virtual Experiment')
 game_start = pygame.time.get_ticks()
-clock = pygame.time.Clock()
-running = True
+startup_timer.mark('pygame_init')
+
+# Functions to convert window units (width x height, the units of the game and its data) to render pixels
+def scaled_point(x, y):
+    return round(x * render_scale), round(y * render_scale)
+
+def scaled_rect(rect):
+    left, top = scaled_point(rect[0], rect[1])
+    right, bottom = scaled_point(rect[0] + rect[2], rect[1] + rect[3])
+    return left, top, right - left, bottom - top
+
+# Function to convert a mouse position to window units
+def pointer_position(position):
+    if render_scale != 1 and render_present == 'scaled':
+        return position[0] / render_scale, position[1] / render_scale
+    return position
+
+# Function to show the frame drawn on screen
+def present():
+    if screen is not window:
+        pygame.transform.smoothscale(screen, window.get_size(), window)
+    pygame.display.update()
 
 # Player class
 class Player:
@@ -251,7 +378,8 @@ class Pedestrian:
         self.y = y
         self.radius = radius
     
-    def cal_social_force(self, pedestrian_coords, constants, closest_pedestrians = x_closest_pedestrians):
+    # player_position defaults to where the player is (the crowd warm-up passes the player's start position)
+    def cal_social_force(self, pedestrian_coords, constants, closest_pedestrians = x_closest_pedestrians, player_position = None):
         # Unpack constants
         A_s = constants[3]
         B_s = constants[4]
@@ -260,7 +388,7 @@ class Pedestrian:
         F_s = [0,0] # initalise force vector as 0
         r_alpha = (self.x, self.y) # position of the pedestrian alpha
 
-        pedestrian_coords.append((player.x, player.y)) # add player to the list of pedestrians
+        pedestrian_coords.append((player.x, player.y) if player_position is None else tuple(player_position)) # add player to the list of pedestrians
 
         # Sort the pedestrians by distance
         sorted_pedestrians = sorted(pedestrian_coords, key = lambda pedestrian: math.hypot(pedestrian[0] - r_alpha[0], pedestrian[1] - r_alpha[1]))
@@ -318,18 +446,20 @@ class Pedestrian:
         
         return F_b, x1, y1, x2, y2
 
-    def move_towards(self, target_x, target_y, velocity_x, velocity_y, pedestrian_coords, constants):
+    def move_towards(self, target_x, target_y, velocity_x, velocity_y, pedestrian_coords, constants, player_position = None):
         # Unpack constants
         m = constants[0]
         v_0 = constants[1]
         T_alpha = constants[2]
+        if player_position is None:
+            player_position = (player.x, player.y)
 
         # Initialize the new velocity
         new_velocity_x = velocity_x
         new_velocity_y = velocity_y
 
         # Calculate the social force
-        F_s = self.cal_social_force(pedestrian_coords, constants)
+        F_s = self.cal_social_force(pedestrian_coords, constants, player_position = player_position)
 
         # Calculate the boundary force
         F_b, x1, y1, x2, y2 = self.calculate_boundary_force(rectangle_corners, constants)
@@ -365,13 +495,19 @@ class Pedestrian:
             new_velocity_y = 0
 
         collision = False
+        nearest, nearest_distance, player_distance = -1, math.inf, math.inf
 
         # Check if the new position is inside any other pedestrian
-        pedestrian_coords.append((player.x, player.y)) # add the player to the list of pedestrians
-        for pedestrian in pedestrian_coords:
+        pedestrian_coords.append(tuple(player_position)) # add the player to the list of pedestrians
+        for j, pedestrian in enumerate(pedestrian_coords):
             if pedestrian == (self.x, self.y):
                 continue # skip the current pedestrian
             distance = math.hypot(new_x - pedestrian[0], new_y - pedestrian[1])
+            # Keep the closest pedestrian and the distance to the player for the proximity events
+            if j == len(pedestrian_coords) - 1:
+                player_distance = distance
+            elif distance < nearest_distance:
+                nearest, nearest_distance = j, distance
             if distance < 2*r:
                 collision = True 
                 normalised_velocity = [new_velocity_x / math.hypot(new_velocity_x, new_velocity_y),
@@ -392,6 +528,7 @@ class Pedestrian:
         if not collision:
             self.x = new_x
             self.y = new_y
+        self.proximity = (nearest, nearest_distance, player_distance, collision)
         
         velocity_mag = math.hypot(new_velocity_x, new_velocity_y)
         if velocity_mag > v_0:
@@ -401,149 +538,535 @@ class Pedestrian:
         return self.x, self.y, new_velocity_x, new_velocity_y
 
 
-# Generate pedestrian coordinates
-def generate_pedestrian_coords(no_pedestrians, width, height, player_x, player_y, treatment):
-    pedestrian_coords = []
-    min_distance = 2 * player_radius  
-
-    for i in range(no_pedestrians):
-        while True:  
-            if treatment == 'H2':
-                x = random.randint(width + (width/2), width*2)
-                y = random.randint((height - pavement_height) + 2*player_radius, height - 2*player_radius)
-            elif treatment == 'H3':
-                x = random.randint(-300, width/2 - 300)
-                y = random.randint((height - pavement_height) + 2*player_radius, height - 2*player_radius)
-
-            # Check if the new pedestrian is too close to any existing pedestrian
-            too_close = False
-            for ped_x, ped_y in pedestrian_coords:
-                distance = math.hypot(x - ped_x, y - ped_y)
-                if distance < min_distance:
-                    too_close = True
-                    break  # No need to check further; regenerate
-            
-            # Check against the player's position
-            if math.hypot(x - player_x, y - player_y) < min_distance:
-                too_close = True
-                continue
-
-            if not too_close:  # If the position is valid, add it to the list
-                pedestrian_coords.append((x, y))
-                break  # Exit the while loop and move to the next pedestrian
-
-    return pedestrian_coords
-
-# Function to create the lights surface
-def lights(glow_dim, glow_bright, treatment):
-    # Create lists for the light surfaces and their centres
-    light_surfaces = []
-    light_centres = []
-    split = int(num_lights/2)
+# numpy, imported by the first crowd rather than at start-up (a heavy import the first screen does not need)
+np = None
+
+# Function to import numpy once, for the crowds and navigation fields
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+# Crowd class (parallel lists of the pedestrians, their ids, coordinates, velocities and targets)
+class Crowd:
+    def __init__(self, spec):
+        self.pedestrians = []
+        self.ids = [] # spawn order, so a pedestrian keeps its id while others leave
+        self.coords = []
+        self.velocities = []
+        self.targets = []
+        self.no_spawned = 0
+        self.navigation = None # NavigationField the pedestrians follow instead of heading straight at their targets
+        self.proximity = [] # per pedestrian in the last step: id, x, y, v_x, v_y, closest id, distance to it, distance to the player, collision
+        load_numpy()
+        # The pedestrians walk from their spawn zone towards target_x and leave once they pass it
+        self.target_x = spec['target_x']
+        self.direction = 1 if spec['target_x'] > sum(spec['zone'])/2 else -1
+
+    def __len__(self):
+        return len(self.pedestrians)
+
+    def spawn(self, x, y, target, velocity = (0, 0)):
+        self.pedestrians.append(Pedestrian(x, y, player_radius))
+        self.ids.append(self.no_spawned)
+        self.no_spawned += 1
+        self.coords.append((x, y))
+        self.velocities.append(velocity)
+        self.targets.append(target)
+
+    def remove(self, i):
+        self.pedestrians.pop(i)
+        self.ids.pop(i)
+        self.coords.pop(i)
+        self.velocities.pop(i)
+        self.targets.pop(i)
+
+    # Move every pedestrian along the street by dx (the warm-up keeps the crowd in its own frame)
+    def shift(self, dx):
+        self.coords[:] = [(x + dx, y) for x, y in self.coords]
+        for pedestrian in self.pedestrians:
+            pedestrian.x += dx
+
+    # Move every pedestrian by one Timestep and remove the ones that have reached their target
+    # (towards the player at player_position, where the player is if None)
+    def step(self, stepper = None, player_position = None):
+        if player_position is None:
+            player_position = (player.x, player.y)
+
+        # With a navigation field each pedestrian heads for a point a little way down the field instead
+        targets = self.targets
+        if self.navigation is not None and len(self):
+            targets = self.navigation.waypoints(self.coords, navigation_lookahead).tolist()
+
+        if stepper is not None:
+            # Step the whole crowd at once with the parallel stepper
+            stepper.step(self, player_position, targets)
+            proximity = stepper.proximity(len(self)) if len(self) else []
+        else:
+            for i in range(len(self)):
+                prev_vel_x, prev_vel_y = self.velocities[i]
+                ped_target_x, ped_target_y = targets[i]
+
+                new_x, new_y, new_vel_x, new_vel_y = self.pedestrians[i].move_towards(
+                    ped_target_x, ped_target_y, prev_vel_x, prev_vel_y, self.coords, pedestrian_constants, player_position
+                )
+
+                self.coords[i] = (new_x, new_y)
+                self.velocities[i] = (new_vel_x, new_vel_y)
+            proximity = [pedestrian.proximity for pedestrian in self.pedestrians]
+
+        # Proximity of every pedestrian, with the closest pedestrian by id (taken before the pedestrians leave)
+        proximity = np.asarray(proximity, dtype = float).reshape(-1, 4)
+        ids = np.asarray(self.ids, dtype = float)
+        nearest_ids = np.where(proximity[:, 0] >= 0, ids[proximity[:, 0].astype(int)], -1)
+        self.proximity = np.column_stack([ids, np.reshape(self.coords, (-1, 2)), np.reshape(self.velocities, (-1, 2)), nearest_ids, proximity[:, 1:]])
+
+        for i in reversed(range(len(self))):
+            if (self.coords[i][0] - self.target_x) * self.direction > 0:
+                self.remove(i)
+
+# Streaming world class
+# Only the segments within the camera window (plus a margin) exist, so memory and per-frame cost
+# depend on the window rather than on the route length
+class World:
+    # occupancy lists the OccupancyGrids whose tiles are compacted as the segments are released
+    def __init__(self, bright_side, crowd = None, layout = None, dynamic_lights = None, seed = 0, occupancy = ()):
+        self.bright_side = bright_side
+        self.crowd = crowd
+        self.occupancy = list(occupancy)
+        self.dynamic_lights = dynamic_lights
+        self.seed = seed
+        # Dimmed overlay with the lights, in world coordinates, updated only where a light changes (see lighting.py)
+        self.lightmap = Lightmap(road_start, segment_length, height, dimness, render_scale) if bright_side is not None else None
+        self.segments = {} # active segments keyed by their index
+        self.spawned = set() # segments which have already spawned their pedestrians
+        self.no_segments = math.ceil((road_end - road_start) / segment_length)
+
+        self.place_layout(layout)
+
+    # Sort the pedestrians of a crowd layout into the segments they start in (before the segments are generated)
+    # Rows are x, y, target_x, target_y and optionally v_x, v_y (a warmed-up layout)
+    def place_layout(self, layout):
+        self.segment_layouts = [[] for index in range(self.no_segments)]
+        if layout is not None:
+            for row in layout.tolist():
+                index = int((row[0] - road_start) // segment_length)
+                self.segment_layouts[min(max(index, 0), self.no_segments - 1)].append(row)
+
+    def segment_bounds(self, index):
+        x1 = road_start + index * segment_length
+        return x1, x1 + segment_length
+
+    def generate_segment(self, index):
+        x1, x2 = self.segment_bounds(index)
+
+        # Road and road markings
+        road = (x1, pavement_height, segment_length, road_height)
+        road_markings = []
+        marking_x = math.ceil(x1 / road_marking_spacing) * road_marking_spacing
+        while marking_x < x2:
+            road_markings.append((marking_x, height/2 - road_marking_height/2, road_marking_width, road_marking_height))
+            marking_x += road_marking_spacing
+
+        # Lights
+        segment_lights = []
+        if self.bright_side is not None:
+            for k, (light_surf, (x, y)) in enumerate(light_positions((x1 + x2)/2, self.bright_side)):
+                segment_lights.append(Light(light_surf, x, y, *self.light_mode(index, k)))
+
+        # Pedestrians (only the first time the segment is generated)
+        if index not in self.spawned:
+            for x, y, target_x, target_y, *velocity in self.segment_layouts[index]:
+                self.crowd.spawn(x, y, (target_x, target_y), tuple(velocity) if velocity else (0, 0))
+            self.spawned.add(index)
+
+        return {'road': road, 'road_markings': road_markings, 'lights': segment_lights}
+
+    # Mode, seed and switch-on distance of light k of a segment (the same whatever order the segments are generated in)
+    def light_mode(self, index, k):
+        seed = f'{self.seed}-{index}-{k}'
+        if self.dynamic_lights is None:
+            return 'on', seed, None
+        draw = random.Random(seed).random()
+        if draw < self.dynamic_lights['failed']:
+            return 'failed', seed, None
+        if draw < self.dynamic_lights['failed'] + self.dynamic_lights['flicker']:
+            return 'flicker', seed, None
+        if self.dynamic_lights['proximity'] is not None:
+            return 'proximity', seed, self.dynamic_lights['proximity']
+        return 'on', seed, None
+
+    def update(self, camera_offset_x):
+        window_start = camera_offset_x - segments_behind * segment_length
+        window_end = camera_offset_x + width + segments_ahead * segment_length
+        first = max(0, int((window_start - road_start) // segment_length))
+        last = min(self.no_segments - 1, int((window_end - road_start) // segment_length))
+
+        # Release the segments that have left the window
+        for index in list(self.segments):
+            if index < first or index > last:
+                segment = self.segments.pop(index)
+                if self.lightmap is not None:
+                    self.lightmap.remove_lights(segment['lights'])
+                    self.lightmap.remove_tile(index)
+                for grid in self.occupancy:
+                    grid.release(*self.segment_bounds(index))
+
+        # Generate the segments that have entered the window
+        for index in range(first, last + 1):
+            if index not in self.segments:
+                self.segments[index] = self.generate_segment(index)
+                if self.lightmap is not None:
+                    self.lightmap.add_tile(index)
+                    self.lightmap.add_lights(self.segments[index]['lights'])
+
+        # Release the pedestrians that have fallen behind the window
+        if self.crowd is not None:
+            for i in reversed(range(len(self.crowd))):
+                if self.crowd.coords[i][0] < window_start:
+                    self.crowd.remove(i)
+
+    def draw_road(self, screen, camera_offset_x):
+        for segment in self.segments.values():
+            rect = segment['road']
+            pygame.draw.rect(screen, road_colour, scaled_rect((rect[0] - camera_offset_x, rect[1], rect[2], rect[3])))
+        self.draw_road_markings(screen, camera_offset_x)
+
+    def draw_road_markings(self, screen, camera_offset_x):
+        for segment in self.segments.values():
+            for rect in segment['road_markings']:
+                pygame.draw.rect(screen, road_marking_colour, scaled_rect((rect[0] - camera_offset_x, rect[1], rect[2], rect[3])))
+
+    # Update the dynamic lights for time t (seconds into the scenario)
+    def update_lights(self, t, player_x):
+        if self.lightmap is not None:
+            self.lightmap.update(t, player_x)
+
+    # Draw the dimmed overlay with the lights
+    def draw_lights(self, screen, camera_offset_x):
+        self.lightmap.draw(screen, camera_offset_x)
+
+# Scenario class (the assets and logs of one treatment, prepared in the background by preload_scenario)
+class Scenario:
+    def __init__(self, name, spec, layout_index, timer):
+        self.name = name
+        self.spec = spec
+
+        from crowd_layouts import load_layout
+        from occupancy import OccupancyGrid
+
+        # Crowd
+        self.crowd = None
+        self.layout_index = None
+        layout = None
+        if spec['crowd'] is not None:
+            with timer.phase('crowd_generation'):
+                layout, no_layouts = load_layout(crowd_layout_dir, crowd_layout_spec(name), layout_index)
+                self.layout_index = layout_index % no_layouts
+                self.crowd = Crowd(spec['crowd'])
+
+        with timer.phase('asset_build'):
+            # Lights and streaming world
+            get_light_sprites()
+            # Occupancy grids, tiled by segment so only the streamed segments are dense
+            self.occupancy = {agent: OccupancyGrid(road_start, road_end, 0, height, occupancy_cell_size, segment_length) for agent in ('player', 'pedestrians')}
+            self.world = World(spec['bright_side'], self.crowd, layout, spec['dynamic_lights'], layout_index, self.occupancy.values())
+
+            # Proximity events of the crowd
+            self.events = None
+            if self.crowd is not None:
+                from proximity_events import ProximityEvents
+                self.events = ProximityEvents(player_radius, near_miss_factor, ttc_threshold)
+
+        # Navigation field of the crowd, from the light layout of this world
+        if self.crowd is not None and spec['navigation'] is not None:
+            with timer.phase('navigation_field'):
+                self.crowd.navigation = navigation_field(self.world, spec)
+
+        # Walk the initial crowd to a steady state (this runs in the scenario loader, behind the instructions)
+        self.warmup_stats = None
+        if self.crowd is not None and crowd_warmup:
+            from crowd_warmup import warm_up
+            with timer.phase('crowd_warmup'):
+                # A crowd of its own, stepped exactly as the scenario will step it (model, stepper and navigation field)
+                crowd = Crowd(spec['crowd'])
+                crowd.navigation = self.crowd.navigation
+                for x, y, target_x, target_y in layout.tolist():
+                    crowd.spawn(x, y, (target_x, target_y))
+                stepper = crowd_stepper if parallel_crowd else None
+                start = (player_x, height - (pavement_height/2))
+                self.warmup_stats = warm_up(crowd, lambda: crowd.step(stepper, start), Timestep, crowd_warmup_max_time)
+                self.world.place_layout(np.column_stack([np.reshape(crowd.coords, (-1, 2)), np.reshape(crowd.targets, (-1, 2)),
+                                                         np.reshape(crowd.velocities, (-1, 2))]))
+
+        # Logs (trial_id is the trial's row in the session store, set when the scenario starts)
+        self.trial_id = None
+        self.log = {'start': None, 'end': None, 'player_position': [], 'pedestrian_positions': [], 
+                    'cross_road': 0, 'clicks': 0, 'click_position': []}
+
+    # Time taken to reach the goal (seconds)
+    def time(self):
+        return (self.log['end'] - self.log['start']) / 1000
+
+    # Drop the world and its lightmap tiles once the trial has ended and compact the occupancy grids (the logs, crowd,
+    # grids and stats stay for save_data)
+    def release(self):
+        self.world = None
+        for grid in self.occupancy.values():
+            grid.compact()
+
+# Function to prepare a scenario in the background thread
+def preload_scenario(name, layout_index, timer):
+    return scenario_loader.submit(Scenario, name, scenario_specs[name], layout_index, timer)
+
+# Function to find the next free participant number (one more than the highest saved session)
+def next_participant_number():
+    numbers = [int(filename[len('extra_data_'):-len('.csv')]) for filename in os.listdir('.') 
+               if filename.startswith('extra_data_') and filename[len('extra_data_'):-len('.csv')].isdigit()]
+    return max(numbers, default = 0) + 1
+
+# Function to register a new session in the store, returns (session id, participant number)
+# Kiosk sessions are numbered by the store as well, so kiosks sharing one database never reuse a number
+def new_session(participant_number):
+    if kiosk_mode:
+        participant_number = next_participant_number()
+    return session_store.new_session(participant_number, reserve = kiosk_mode)
+
+# Function to pick the treatment order of a participant (cycles through every ordering)
+def counterbalanced_treatment(participant_number):
+    return treatment_scenarios[participant_number % len(treatment_scenarios)]
+
+# Function to describe the crowd layouts of a scenario (see crowd_layouts.py)
+def crowd_layout_spec(name):
+    crowd = scenario_specs[name]['crowd']
+    return {'treatment': name,
+            'no_pedestrians': no_pedestrians,
+            'x_min': crowd['zone'][0],
+            'x_max': crowd['zone'][1],
+            'y_min': (height - pavement_height) + 2*player_radius,
+            'y_max': height - 2*player_radius,
+            'target_x': crowd['target_x'],
+            'target_y_min': target_bottom + player_radius,
+            'target_y_max': height - player_radius,
+            'min_distance': 2*player_radius,
+            'player_x': player_x,
+            'player_y': height - (pavement_height/2)}
+
+# Function to create the light surfaces (one bright and one dim sprite, shared by every light)
+def lights(glow_dim, glow_bright):
     light_radius_bright = glow_bright
     light_radius_dim = glow_dim
 
-    # Bright lights
-    for i in range(split):
-        layers = 70
-        light_surf = pygame.Surface((light_radius_bright*2, light_radius_bright*2), pygame.SRCALPHA)
-        for j in range(layers, 0, -1):
-            distance = j * light_radius_bright/layers
-            alpha = glow_bright/(math.pi * (distance) ** 2) * (90 * glow_bright)
-            alpha = max(0, min(255, alpha))
-            pygame.draw.circle(light_surf, (0, 0, 0, alpha), light_surf.get_rect().center, int(distance))
-        light_surfaces.append(light_surf)
-        x1 = (road_width/split) * (i - 2)
-        x2 = (road_width/split) * (i - 1)
-        x = (x1 + x2)/2
-        if treatment == 'H2':
-            light_centres.append((x - light_radius_bright, (height - pavement_height) - light_radius_bright))
-        elif treatment == 'H3':
-            light_centres.append((x - light_radius_bright, pavement_height - light_radius_bright))
+    # Bright light
+    layers = 70
+    light_surf_bright = pygame.Surface((light_radius_bright*2, light_radius_bright*2), pygame.SRCALPHA)
+    for j in range(layers, 0, -1):
+        distance = j * light_radius_bright/layers
+        alpha = glow_bright/(math.pi * (distance) ** 2) * (90 * glow_bright)
+        alpha = max(0, min(255, alpha))
+        pygame.draw.circle(light_surf_bright, (0, 0, 0, alpha), light_surf_bright.get_rect().center, int(distance))
     
-    # Dim lights
-    for i in range(split):
-        layers = 50
-        light_surf = pygame.Surface((light_radius_dim*2, light_radius_dim*2), pygame.SRCALPHA)
-        for j in range(layers, 0, -1):
-            distance = j * light_radius_dim/layers
-            alpha = glow_dim/(math.pi * (distance) ** 2) * (30 * glow_dim)
-            alpha = max(0, min(255, alpha))
-            pygame.draw.circle(light_surf, (0, 0, 0, alpha), light_surf.get_rect().center, int(distance))
-        light_surfaces.append(light_surf)
-        x1 = (road_width/split) * (i - 2)
-        x2 = (road_width/split) * (i - 1)
-        x = (x1 + x2)/2
-        if treatment == 'H2':
-            light_centres.append((x - light_radius_dim, pavement_height - light_radius_dim))
-        elif treatment == 'H3':
-            light_centres.append((x - light_radius_dim, (height - pavement_height) - light_radius_dim))
-
-    return light_surfaces, light_centres, light_radius_dim
+    # Dim light
+    layers = 50
+    light_surf_dim = pygame.Surface((light_radius_dim*2, light_radius_dim*2), pygame.SRCALPHA)
+    for j in range(layers, 0, -1):
+        distance = j * light_radius_dim/layers
+        alpha = glow_dim/(math.pi * (distance) ** 2) * (30 * glow_dim)
+        alpha = max(0, min(255, alpha))
+        pygame.draw.circle(light_surf_dim, (0, 0, 0, alpha), light_surf_dim.get_rect().center, int(distance))
+
+    return light_surf_bright, light_surf_dim
+
+# Function to get the shared light sprites (built by the first scenario that needs them)
+def get_light_sprites():
+    with light_sprites_lock:
+        if not light_sprites:
+            light_sprites.extend(lights(light_radius_dim, light_radius_bright))
+    return light_sprites
+
+# Function to place the bright and dim light of a segment centred on x
+def light_positions(x, bright_side):
+    if bright_side == 'switch':
+        bright_bottom = x < (road_start + road_end)/2
+    else:
+        bright_bottom = bright_side == 'bottom'
+    if bright_bottom:
+        bright_y = (height - pavement_height) - light_radius_bright
+        dim_y = pavement_height - light_radius_dim
+    else:
+        bright_y = pavement_height - light_radius_bright
+        dim_y = (height - pavement_height) - light_radius_dim
+    light_surf_bright, light_surf_dim = get_light_sprites()
+    return [(light_surf_bright, (x - light_radius_bright, bright_y)), (light_surf_dim, (x - light_radius_dim, dim_y))]
+
+# Function to build the lighting-aware navigation field of a crowded scenario (see navigation.py)
+def navigation_field(world, spec):
+    load_numpy()
+    from navigation import NavigationField
+    no_x = round((road_end - road_start) / navigation_cell_size)
+    no_y = round(height / navigation_cell_size)
+
+    # Darkness per cell: the dimmed overlay drawn at one pixel per cell, with every lamp that has not failed lit
+    darkness = np.zeros((no_y, no_x))
+    if lights_on and world.bright_side is not None:
+        lightmap = Lightmap(road_start, segment_length, height, dimness, 1/navigation_cell_size)
+        for index in range(world.no_segments):
+            x1, x2 = world.segment_bounds(index)
+            lightmap.add_tile(index)
+            lightmap.add_lights([Light(light_surf, x, y, 'failed' if world.light_mode(index, k)[0] == 'failed' else 'on')
+                                 for k, (light_surf, (x, y)) in enumerate(light_positions((x1 + x2)/2, world.bright_side))])
+        alpha = np.concatenate([pygame.surfarray.array_alpha(lightmap.tiles[index]) for index in range(world.no_segments)]).T
+        darkness = alpha[:no_y, :no_x] / dimness
+
+    # The pedestrians walk on the pavements
+    centres_y = (np.arange(no_y) + 0.5) * navigation_cell_size
+    on_pavement = (centres_y < pavement_height) | (centres_y > height - pavement_height)
+    walkable = np.repeat(on_pavement[:, None], no_x, axis = 1)
+
+    return NavigationField(darkness, walkable, road_start, 0, navigation_cell_size, spec['crowd']['target_x'],
+                           world.crowd.direction, spec['navigation']['darkness_cost'])
+
+# Function to get the sprite of an agent (a circle of a colour and radius in render pixels), anti-aliased once by
+# drawing it agent_supersampling times larger and scaling it down
+def agent_sprite(colour, radius):
+    colour = pygame.Color(colour)
+    key = (tuple(colour), radius)
+    if key not in agent_sprites:
+        size = math.ceil(2 * radius) + 2
+        large = pygame.Surface((size * agent_supersampling, size * agent_supersampling), pygame.SRCALPHA)
+        large.fill((colour.r, colour.g, colour.b, 0)) # transparent pixels of the same colour, so the edges do not darken
+        pygame.draw.circle(large, colour, large.get_rect().center, radius * agent_supersampling)
+        sprite = pygame.transform.smoothscale(large, (size, size)).convert_alpha()
+        # Run-length encoded, so the blit copies the opaque runs and only blends the anti-aliased edge
+        sprite.set_alpha(255, pygame.RLEACCEL)
+        agent_sprites[key] = sprite
+    return agent_sprites[key]
+
+# Function to draw agents (positions in window units) with one Surface.blits call, skipping the ones off the screen
+def draw_agents(screen, colour, positions, camera_offset_x):
+    sprite = agent_sprite(colour, player_radius * render_scale)
+    half = sprite.get_width() / 2
+    offset_x = camera_offset_x * render_scale + half - 0.5 # the 0.5 rounds the positions below
+    offset_y = half - 0.5
+    # Visible range of x in window units
+    low = camera_offset_x - 2*half / render_scale
+    high = camera_offset_x + screen.get_width() / render_scale + 2*half / render_scale
+    screen.blits([(sprite, (math.floor(x * render_scale - offset_x), math.floor(y * render_scale - offset_y)))
+                  for x, y in positions if low < x < high], doreturn = False)
+
+# Function to draw a frame of a scenario (also used by replay.py)
+def draw_scenario(screen, world, goal_x, player_y, pedestrian_coords, camera_offset_x):
+    # Draw the background
+    screen.fill(background_colour)
+
+    # Draw the road and road markings
+    world.draw_road(screen, camera_offset_x)
+
+    # # Draw the curb
+    # for rect in curbs:
+    #     pygame.draw.rect(screen, curb_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
+
+    # Draw the player (always in the middle of the screen)
+    draw_agents(screen, player_colour, [(width/2, player_y)], 0)
+
+    # Draw the pedestrians
+    draw_agents(screen, pedestrian_colour, pedestrian_coords, camera_offset_x)
+
+    if lights_on:
+        # Draw the dimmed overlay and lights onto the screen
+        world.draw_lights(screen, camera_offset_x)
+
+    # Draw the dashed line (target)
+    x_adjusted = goal_x - camera_offset_x
+    y = 0
+    while y < height:
+        pygame.draw.line(screen, player_colour, scaled_point(x_adjusted, y), scaled_point(x_adjusted, min(y+dash_length, height)))
+        y += dash_length + gap_length
+
+# Function returning a log for a session's messages, which prints them and keeps them in the session_log table
+def session_logger(session_id, source):
+    def log(message):
+        print(message)
+        session_store.add_log(session_id, source, message)
+    return log
+
+# Function to register the subsystems of a session with the memory monitor (Python sizes are estimates, see memory_monitor.py)
+def track_memory(scenarios):
+    memory_monitor.track('logging', lambda: estimate_size([scenario.log for scenario in scenarios.values()]) +
+                                            estimate_size(session_store.pending) + estimate_size(session_store.tracks))
+    memory_monitor.track('crowd', lambda: estimate_size([scenario.crowd for scenario in scenarios.values() if scenario.crowd is not None]))
+    memory_monitor.track('occupancy', lambda: estimate_size([scenario.occupancy for scenario in scenarios.values()]))
+
+    # Display, light sprites and lightmap tiles (each surface once, the screen may be the window)
+    def surfaces():
+        lightmaps = [scenario.world.lightmap for scenario in scenarios.values() if scenario.world is not None and scenario.world.lightmap is not None]
+        surfaces = [window, screen, *light_sprites, *agent_sprites.values()] + [surface for lightmap in lightmaps for surface in [*lightmap.tiles.values(), *lightmap.sprites.values()]]
+        return surface_size({id(surface): surface for surface in surfaces}.values())
+    memory_monitor.track('surfaces', surfaces)
 
 # Function to display instructions
 def display_instructions(screen, instructions_text):
     screen.fill(instruction_background_colour)
     for i, line in enumerate(instructions_text):
         text = instruction_font.render(line, True, instruction_text_colour)
-        text_rect = text.get_rect(center=(width // 2, 50 + i * 30))
+        text_rect = text.get_rect(center=scaled_point(width // 2, 50 + i * 30))
         screen.blit(text, text_rect)
-    pygame.display.update()
+    present()
+
+# Function to find the crowd layout index of a session (the same for every crowded scenario)
+def session_crowd_layout(scenarios):
+    return next((scenario.layout_index for scenario in scenarios.values() if scenario.layout_index is not None), None)
+
+# Function to collect the proximity event summaries of the crowded trials
+def proximity_stats(scenarios):
+    return {f'{name}_{key}': value for name, scenario in scenarios.items() if scenario.events is not None 
+            for key, value in scenario.events.summary().items()}
+
+# Function to collect the crowd warm-up stats of the crowded trials (simulated seconds and whether the crowd settled)
+def warmup_stats(scenarios):
+    return {f'{name}_warmup_{key}': value for name, scenario in scenarios.items() if scenario.warmup_stats is not None 
+            for key, value in scenario.warmup_stats.items()}
 
 # Function to save data
-def save_data(H1_time, H2_time, H3_time, player_position_H1, player_position_H2, player_position_H3, cross_road_H1, 
-            cross_road_H2, cross_road_H3, click_H1, click_H2, click_H3, click_position_H1, click_position_H2, 
-            click_position_H3, pedestrian_positions_H2, pedestrian_positions_H3, treatment):
-    # Prepare the data
-    position_data_H1 = {'H1_Player_position': player_position_H1}
-    position_data_H2 = {'H2_Player_position': player_position_H2}
-    position_data_H3 = {'H3_Player_position': player_position_H3}
-    pedestrian_positions_H2 = {'H2_Pedestrian_positions': pedestrian_positions_H2}
-    pedestrian_positions_H3 = {'H3_Pedestrian_positions': pedestrian_positions_H3}
-    extra_data = {'H1_time': [H1_time], 'H2_time': [H2_time], 'H3_time': [H3_time], 'Crossed_road_H1': [cross_road_H1], 
-            'Crossed_road_H2': [cross_road_H2], 'Crossed_road_H3': [cross_road_H3], 'Clicks_H1': [click_H1], 'Clicks_H2': [click_H2], 
-            'Clicks_H3': [click_H3], 'Treatment': [treatment]}
-    click_position_data_H1 = {'Click_position_H1': click_position_H1} 
-    click_position_data_H2 = {'Click_position_H2': click_position_H2}
-    click_position_data_H3 = {'Click_position_H3': click_position_H3}
-    
-    # Create dataframes
-    df_position_H1 = pd.DataFrame(position_data_H1)
-    df_position_H2 = pd.DataFrame(position_data_H2)
-    df_position_H3 = pd.DataFrame(position_data_H3)
-    df_pedestrian_positions_H2 = pd.DataFrame(pedestrian_positions_H2)
-    df_pedestrian_positions_H3 = pd.DataFrame(pedestrian_positions_H3)
-    df_extra = pd.DataFrame(extra_data)
-    df_click_position_H1 = pd.DataFrame(click_position_data_H1)
-    df_click_position_H2 = pd.DataFrame(click_position_data_H2)
-    df_click_position_H3 = pd.DataFrame(click_position_data_H3)
+def save_data(participant_number, scenarios, treatment, frame_stats, startup_stats, memory_stats):
+    import pandas as pd
+    from occupancy import save_occupancy
+
+    extra_data = {}
+    names = sorted(scenarios)
+    for name in names:
+        extra_data[f'{name}_time'] = [scenarios[name].time()]
+    for name in names:
+        extra_data[f'Crossed_road_{name}'] = [scenarios[name].log['cross_road']]
+    for name in names:
+        extra_data[f'Clicks_{name}'] = [scenarios[name].log['clicks']]
+    extra_data.update({key: [value] for key, value in proximity_stats(scenarios).items()}) # contacts and near misses
+    extra_data.update({key: [value] for key, value in warmup_stats(scenarios).items()}) # crowd warm-up
+    extra_data['Treatment'] = [treatment]
+    extra_data['Crowd_layout'] = [session_crowd_layout(scenarios)]
+    extra_data.update({key: [value] for key, value in frame_stats.items()}) # frame pacing and latency stats
+    extra_data.update({key: [value] for key, value in startup_stats.items()}) # start-up phase times
+    extra_data.update({key: [value] for key, value in memory_stats.items()}) # memory peaks
 
     # Save the data to CSV files with participant_number in the filename
-    df_position_H1.to_csv(f'position_data_H1_{participant_number}.csv', index=False)
-    df_position_H2.to_csv(f'position_data_H2_{participant_number}.csv', index=False)
-    df_position_H3.to_csv(f'position_data_H3_{participant_number}.csv', index=False)
-    df_pedestrian_positions_H2.to_csv(f'pedestrian_positions_H2_{participant_number}.csv', index=False)
-    df_pedestrian_positions_H3.to_csv(f'pedestrian_positions_H3_{participant_number}.csv', index=False)
-    df_extra.to_csv(f'extra_data_{participant_number}.csv', index=False)
-    df_click_position_H1.to_csv(f'click_position_data_H1_{participant_number}.csv', index=False)
-    df_click_position_H2.to_csv(f'click_position_data_H2_{participant_number}.csv', index=False)
-    df_click_position_H3.to_csv(f'click_position_data_H3_{participant_number}.csv', index=False)
-
-
-# Create dimmed overlay surface
-dimness = 220
-dim_surf = pygame.Surface((width, height), pygame.SRCALPHA)
-dim_surf.fill((0, 0, 0, dimness))
+    for name in names:
+        log = scenarios[name].log
+        pd.DataFrame({f'{name}_Player_position': log['player_position']}).to_csv(f'position_data_{name}_{participant_number}.csv', index=False)
+        if scenarios[name].spec['log_pedestrians']:
+            pd.DataFrame({f'{name}_Pedestrian_positions': log['pedestrian_positions']}).to_csv(
+                f'pedestrian_positions_{name}_{participant_number}.csv', index=False)
+        pd.DataFrame({f'Click_position_{name}': log['click_position']}).to_csv(f'click_position_data_{name}_{participant_number}.csv', index=False)
+    pd.DataFrame(extra_data).to_csv(f'extra_data_{participant_number}.csv', index=False)
 
-# Create the road (x1, y1, width, height)
-rectangles = [
-    (-width/2, pavement_height, road_width, road_height)
-]
+    # Save the occupancy grids
+    save_occupancy(f'occupancy_{participant_number}.npz', 
+                   {(name, agent): grid for name in names for agent, grid in scenarios[name].occupancy.items()})
 
-# Create the road markings
-road_markings = []
-for i in range(no_road_markings):
-    road_markings.append((((i - 5)*150), height/2 - road_marking_height/2, road_marking_width, road_marking_height))
+
+# Dimness of the overlay (alpha), the lights are subtracted from it
+dimness = 220
 
 # Create the targets
 targets = []
@@ -554,8 +1077,8 @@ for i in range(no_targets):
         targets.append(((i+1)*500, pavement_height, target_size, target_size))
 
 # Create the pavements
-rectangle_corners = [((-width/2)-500, 0, (2*width)+(width/2)+200, pavement_height),
-                     ((-width/2)-500, (height - pavement_height), (2*width)+(width/2)+200, height)]
+rectangle_corners = [(road_start-500, 0, road_end+200, pavement_height),
+                     (road_start-500, (height - pavement_height), road_end+200, height)]
 
 # # Create the curbs
 # curbs = [((-width/2)-500, pavement_height - curb_height, (2*width)+(width/2)+200, curb_height),
@@ -638,53 +1161,37 @@ final_screen_text = ['Thank you for participating in the study!',
                      '',
                      'You may now close the window to exit the simulation.']
 
-instruction_font = pygame.font.Font(None, 30)
+kiosk_final_screen_text = final_screen_text[:-1] + ['Please let the experimenter know that you have finished.']
+
+instruction_font = pygame.font.Font(None, round(30 * render_scale))
 
-# Create Player 
+# Create Player (reset at the start of every session)
 player = Player(player_x, height - (pavement_height/2), player_radius)
-target_x, target_y = player.x, player.y
-moving = False
-
-# Display the instructions and decide which screen to show
-display_instructions(screen, instructions_text_1)
-instruction_1_active = True
-instruction_2_active = False
-initial_navigation = False
-instruction_3_active = False
-instruction_4_active = False
-instruction_5_active = False
-flags_treatment = {'H1': False, 'H2': False, 'H3': False}
-final_screen = False
-lights_on = True
 
-# Generate pedestrian coordinates, thier velocities and create pedestrians
-pedestrian_coords_H2 = generate_pedestrian_coords(no_pedestrians, width, height, player_x, height - (pavement_height/2), 'H2')
-pedestrian_coords_H3 = generate_pedestrian_coords(no_pedestrians, width, height, player_x, pavement_height/2, 'H3')
-pedestrian_velocities_H2 = [(0, 0) for i in range(no_pedestrians)]
-pedestrian_velocities_H3 = [(0, 0) for i in range(no_pedestrians)]
-pedestrians_H2 = [Pedestrian(pedestrian_coords_H2[i][0], pedestrian_coords_H2[i][1], player_radius) for i in range(no_pedestrians)]
-pedestrians_H3 = [Pedestrian(pedestrian_coords_H3[i][0], pedestrian_coords_H3[i][1], player_radius) for i in range(no_pedestrians)]
-pedestrian_target_H2 = [(H2_target_x, random.randint(int(target_bottom + player_radius), int(height - player_radius))) for i in range(no_pedestrians)]
-pedestrian_target_H3 = [(H3_target_x, random.randint(int(target_bottom + player_radius), int(height - player_radius))) for i in range(no_pedestrians)]
+scenario_instructions = [instructions_text_3, instructions_text_4, instructions_text_5] # shown before each scenario
+lights_on = True
 
 pedestrian_coords_initial = []
 
-# Camera offset
-camera_offset_x = 0
+# Light sprites
+light_radius_dim, light_radius_bright = 100, 200
+light_sprites = []
+light_sprites_lock = threading.Lock()
+
+# Agent sprites, keyed by colour and radius (render pixels)
+agent_sprites = {}
+agent_supersampling = 4
 
-# Generate the lights
-light_surfaces_H2, light_centres_H2, light_radius_dim_H2 = lights(100, 200, 'H2')
-light_surfaces_H3, light_centres_H3, light_radius_dim_H3 = lights(100, 200, 'H3')
+# Scenarios are prepared in a background thread while the participant reads the instructions before them
+scenario_loader = ThreadPoolExecutor(max_workers = 1)
 
-# Generate the lights for H1
-light_centres_H1 = [list(coords) for coords in light_centres_H2]
-top_centre = light_centres_H1[0][1]
-bottom_centre = light_centres_H1[12][1]
-for i in range(int(num_lights/4)):
-    top_right_index = int((num_lights/4) + i)
-    bottom_right_index = int((3*num_lights/4) + i)
-    light_centres_H1[top_right_index] = (light_centres_H1[top_right_index][0], bottom_centre - light_radius_dim_H2)
-    light_centres_H1[bottom_right_index] = (light_centres_H1[bottom_right_index][0], top_centre + light_radius_dim_H2)
+# Session store, telemetry ring and memory monitor (opened when the sessions are run)
+session_store = None
+telemetry = None
+memory_monitor = None
+
+# Parallel crowd stepper (started once the consent screen has been accepted)
+crowd_stepper = None
 
 # # Create the light poles
 # light_poles = []
@@ -694,507 +1201,321 @@ for i in range(int(num_lights/4)):
 #     else:
 #         light_poles.append((light_centres_H2[i][0] - light_pole_width/2, height - 210 - light_pole_height/2, light_pole_width, light_pole_height))
 
-# Start times
-H1_start = None
-H2_start = None
-H3_start = None
-
 # Data collection parameters
 data_interval = 0.5
-data_timer = 0
-player_position_H1 = []
-player_position_H2 = []
-player_position_H3 = []
-pedestrian_positions_H2 = []
-pedestrian_positions_H3 = []
-cross_road_H1 = 0
-cross_road_H2 = 0
-cross_road_H3 = 0
-bottom = True
-click_H1 = 0
-click_H2 = 0
-click_H3 = 0
-click_position_H1 = []
-click_position_H2 = []
-click_position_H3 = []
-current_target_index = 0
-
-# Main loop
-while running:
-
-    clock.tick(FPS) # cap the frame rate to 60fps
-    # Set the clock/delta time in seconds since the last frame, used for framerate independent physics
-    dt = clock.tick(FPS) / 1000
-
-    data_timer += dt
-
-    # EVENTS
-    for event in pygame.event.get():
-        # Pygame.QUIT event means that the user has clicked the close button
-        if event.type == pygame.QUIT:
-            running = False
+occupancy_cell_size = 20
+
+# Function to start the parallel crowd stepper (once per process)
+def start_crowd_stepper(timer):
+    global crowd_stepper
+    if crowd_stepper is None:
+        from crowd_parallel import CrowdStepper
+        with timer.phase('crowd_workers'):
+            crowd_stepper = CrowdStepper(crowd_capacity, pedestrian_constants, rectangle_corners, height/2, Timestep, crowd_workers)
+
+# Function to run one participant's session, returns (completed, quit)
+# Only the per-session state lives here, the fonts, light sprites, crowd layouts and workers are reused
+def run_session(participant_number, session_id, treatment, timer):
+    # Reset the player
+    player.x, player.y = player_x, height - (pavement_height/2)
+    player_velocity = [0, 0]
+    target_x, target_y = player.x, player.y
+    moving = False
+    frame_pacer.reset_stats()
+    if telemetry is not None:
+        telemetry.session(participant_number, treatment)
+
+    # Display the instructions and decide which screen to show
+    display_instructions(screen, instructions_text_1)
+    timer.mark('first_screen')
+    # The phase times are in the session data, the report only when a phase went over its budget
+    if timer.over_budget():
+        session_logger(session_id, 'startup')(timer.report())
+    instruction_1_active = True
+    instruction_2_active = False
+    initial_navigation = False
+    scenario_instruction_active = False
+    scenario_number = 0 # position in treatment of the current (or next) scenario
+    active_scenario = None
+    final_screen = False
+
+    # Camera offset
+    camera_offset_x = 0
+
+    # World for the initial navigation (road markings only)
+    world_initial = World(None)
+
+    # Scenarios of this session
+    scenarios = {}
+    scenario_preload = None
+    if memory_monitor is not None:
+        memory_monitor.reset_stats()
+        memory_monitor.log = session_logger(session_id, 'memory')
+        track_memory(scenarios)
+
+    # Data collection
+    data_timer = 0
+    bottom = True
+    current_target_index = 0
+
+    # Main loop
+    running = True
+    while running:
+
+        # Wait for the next frame, dt is the time in seconds since the last frame
+        dt = frame_pacer.tick()
+        physics_steps = frame_pacer.physics_steps(dt)
+        if memory_monitor is not None:
+            memory_monitor.update()
+
+        data_timer += dt
+
+        # EVENTS
+        for event in pygame.event.get():
+            # Pygame.QUIT event means that the user has clicked the close button
+            if event.type == pygame.QUIT:
+                running = False
         
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_1_active:
-            instruction_1_active = False
-            instruction_2_active = True
-
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_2_active:
-            instruction_2_active = False
-            initial_navigation = True
-
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_3_active:
-            instruction_3_active = False
-            flags_treatment[treatment[0]] = True
-
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_4_active:
-            instruction_4_active = False
-            flags_treatment[treatment[1]] = True
-        
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_5_active:
-            instruction_5_active = False
-            flags_treatment[treatment[2]] = True
-
-        # Move player using the mouse
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            target_x, target_y = pygame.mouse.get_pos()
-            target_x += camera_offset_x
-            moving = True
-            # print(f'Player position: {player.x, player.y}')
-            if flags_treatment['H1']:
-                click_H1 += 1
-                click_position_H1.append((target_x, target_y))
-            elif flags_treatment['H2']:
-                click_H2 += 1
-                click_position_H2.append((target_x, target_y))
-            elif flags_treatment['H3']:
-                click_H3 += 1
-                click_position_H3.append((target_x, target_y))
-
-    if instruction_1_active:
-        continue
-
-    if instruction_2_active:
-        display_instructions(screen, instructions_text_2)
-        continue
-
-    if initial_navigation:
-        if moving:
-            player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
-                target_x, target_y, player_velocity[0], player_velocity[1], dt, pedestrian_coords_initial, pedestrian_constants)
-            player_velocity = [player_new_vel_x, player_new_vel_y]
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_1_active:
+                instruction_1_active = False
+                instruction_2_active = True
+                # Start the crowd workers behind the consent screen
+                if parallel_crowd:
+                    start_crowd_stepper(timer)
+
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and instruction_2_active:
+                instruction_2_active = False
+                initial_navigation = True
+
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and scenario_instruction_active:
+                scenario_instruction_active = False
+                # Waits only if the background preparation has not finished yet
+                active_scenario = scenario_preload.result()
+                scenarios[active_scenario.name] = active_scenario
+                active_scenario.log['start'] = pygame.time.get_ticks()
+                active_scenario.trial_id = session_store.new_trial(session_id, participant_number, active_scenario.name, scenario_number, 
+                                                                   active_scenario.layout_index)
+                # Generate the segments around the starting position
+                active_scenario.world.update(player.x - width/2)
+
+            # Start the next session (kiosk mode)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE and final_screen and kiosk_mode:
+                return True, False
+
+            # Move player using the mouse
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                target_x, target_y = pointer_position(pygame.mouse.get_pos())
+                target_x += camera_offset_x
+                moving = True
+                if telemetry is not None:
+                    telemetry.click(target_x, target_y)
+                # Start the latency measurement if the click can move the player (from now, pygame events have no timestamp)
+                if initial_navigation or active_scenario is not None:
+                    frame_pacer.click()
+                # print(f'Player position: {player.x, player.y}')
+                if active_scenario is not None:
+                    active_scenario.log['clicks'] += 1
+                    active_scenario.log['click_position'].append((target_x, target_y))
+                    session_store.add_click(active_scenario.trial_id, (pygame.time.get_ticks() - active_scenario.log['start']) / 1000, target_x, target_y)
+
+        if instruction_1_active:
+            continue
+
+        if instruction_2_active:
+            display_instructions(screen, instructions_text_2)
+            continue
+
+        if initial_navigation:
+            for step in range(physics_steps if moving else 0):
+                player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
+                    target_x, target_y, player_velocity[0], player_velocity[1], dt, pedestrian_coords_initial, pedestrian_constants)
+                player_velocity = [player_new_vel_x, player_new_vel_y]
+                frame_pacer.stepped()
             
-            if math.hypot(target_x - player.x, target_y - player.y) < 1:
-                moving = False
-
-        # Check if the player has reached the target
-        init_target_x = targets[current_target_index][0] + target_size/2
-        init_target_y = targets[current_target_index][1] + target_size/2
-        if math.hypot(init_target_x - player.x, init_target_y - player.y) < target_size/2:
-            current_target_index += 1
-
-        camera_offset_x = player.x - width/2
-
-        # Draw the background
-        screen.fill(road_colour)
-
-        # Draw the road markings
-        for rect in road_markings:
-            pygame.draw.rect(screen, road_marking_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the current target
-        if current_target_index < no_targets:
-            pygame.draw.rect(screen, target_colour, (targets[current_target_index][0] - camera_offset_x, targets[current_target_index][1], 
-                                                    targets[current_target_index][2], targets[current_target_index][3]))
-        
-        # Draw the player
-        pygame.draw.circle(screen, player_colour, (int(width/2), int(player.y)), player_radius)
-
-        pygame.display.update()
-
-        # Check if the player has reached the final target
-        if current_target_index > no_targets-1:
-            initial_navigation = False
-            instruction_3_active = True
-
-            # Reset the player's position
-            player.x, player.y = player_x, height - (pavement_height/2)
-            # Reset the player's target
-            target_x, target_y = player.x, player.y
-            # Reset the player's velocity
-            player_velocity = [0, 0]
-
-    if instruction_3_active:
-        display_instructions(screen, instructions_text_3)
-        continue    
-
-    if flags_treatment['H1']:
-        if H1_start is None:
-            H1_start = pygame.time.get_ticks()
-
-        if moving:
-            player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
-                target_x, target_y, player_velocity[0], player_velocity[1], dt, pedestrian_coords_initial, pedestrian_constants)
-            player_velocity = [player_new_vel_x, player_new_vel_y]
-
-            if math.hypot(target_x - player.x, target_y - player.y) < 1:
-                moving = False
-            
-        if bottom:
-            if player.y < pavement_height:
-                cross_road_H1 += 1
-                bottom = False
-
-        elif not bottom:
-            if player.y > height - pavement_height:
-                cross_road_H1 += 1
-                bottom = True
+                if math.hypot(target_x - player.x, target_y - player.y) < 1:
+                    moving = False
+                    break
 
-        if data_timer >= data_interval:
-            player_position_H1.append((player.x, player.y))
-            data_timer = 0
-
-        camera_offset_x = player.x - width/2
-
-        # Draw the background
-        screen.fill(background_colour)
-
-        # Draw the road
-        for rect in rectangles:
-            pygame.draw.rect(screen, road_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the road markings
-        for rect in road_markings:
-            pygame.draw.rect(screen, road_marking_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # # Draw the curb
-        # for rect in curbs:
-        #     pygame.draw.rect(screen, curb_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # # Draw the light poles
-        # for rect in light_poles:
-        #     pygame.draw.rect(screen, light_pole_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the player
-        pygame.draw.circle(screen, player_colour, (int(width/2), int(player.y)), player_radius)
-
-        if lights_on:
-            # Reset the dimmed overlay
-            dim_surf.fill((0, 0, 0, dimness))
-
-            # Add the lights
-            for light_surf, (x,y) in zip(light_surfaces_H2, light_centres_H1):
-                adjusted_x = x - camera_offset_x
-                dim_surf.blit(light_surf, (adjusted_x, y), special_flags=pygame.BLEND_RGBA_SUB)
-            # Draw the dimmed overlay and lights onto the screen
-            screen.blit(dim_surf, (0, 0))
-
-        # Draw the dashed line (target)
-        x_adjusted = (width*2)-50 - camera_offset_x
-        y = 0
-        while y < height:
-            pygame.draw.line(screen, player_colour, (x_adjusted, y), (x_adjusted, min(y+dash_length, height)))
-            y += dash_length + gap_length
-
-        pygame.display.update()
-
-        if player.x > (2*width)-50:
-            H1_end = pygame.time.get_ticks()
-            flags_treatment['H1'] = False
-            if treatment[0] == 'H1':
-                instruction_4_active = True
-            elif treatment[1] == 'H1':
-                instruction_5_active = True
-            elif treatment[2] == 'H1':
-                final_screen = True
-
-            # Reset the player's position
-            player.x, player.y = player_x, height - (pavement_height/2)
-            # Reset the player's target
-            target_x, target_y = player.x, player.y
-            # Reset the player's velocity
-            player_velocity = [0, 0]
-            # Reset the bottom flag
-            bottom = True
-        continue
-
-    if instruction_4_active:
-        display_instructions(screen, instructions_text_4)
-        continue  
-    
-    if flags_treatment['H2']:
-        if H2_start is None:
-            H2_start = pygame.time.get_ticks()
-
-        if moving:
-            player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
-                target_x, target_y, player_velocity[0], player_velocity[1], dt, pedestrian_coords_H2, pedestrian_constants)
-            player_velocity = [player_new_vel_x, player_new_vel_y]
-
-            if math.hypot(target_x - player.x, target_y - player.y) < 1:
-                moving = False
-        
-        if bottom:
-            if player.y < pavement_height:
-                cross_road_H2 += 1
-                bottom = False
-
-        elif not bottom:
-            if player.y > height - pavement_height:
-                cross_road_H2 += 1
-                bottom = True
-        
-        # Save the player and pedestrian positions
-        if data_timer >= data_interval:
-            player_position_H2.append((player.x, player.y))
-            pedestrian_positions_H2.append([(pedestrian.x, pedestrian.y) for pedestrian in pedestrians_H2])
-            data_timer = 0
-
-        camera_offset_x = player.x - width/2
-
-        # Pick screen colour
-        screen.fill(background_colour)
+            # Check if the player has reached the target
+            init_target_x = targets[current_target_index][0] + target_size/2
+            init_target_y = targets[current_target_index][1] + target_size/2
+            if math.hypot(init_target_x - player.x, init_target_y - player.y) < target_size/2:
+                current_target_index += 1
 
-        # Draw the road
-        for rect in rectangles:
-            pygame.draw.rect(screen, road_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
+            camera_offset_x = player.x - width/2
+            world_initial.update(camera_offset_x)
 
-        # Draw the road markings
-        for rect in road_markings:
-            pygame.draw.rect(screen, road_marking_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
+            # Draw the background
+            screen.fill(road_colour)
 
-        # # Draw the curb
-        # for rect in curbs:
-        #     pygame.draw.rect(screen, curb_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
+            # Draw the road markings
+            world_initial.draw_road_markings(screen, camera_offset_x)
 
-        # # Draw the light poles
-        # for rect in light_poles:
-        #     pygame.draw.rect(screen, light_pole_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the player
-        pygame.draw.circle(screen, player_colour, (int(width/2), int(player.y)), player_radius)
+            # Draw the current target
+            if current_target_index < no_targets:
+                pygame.draw.rect(screen, target_colour, scaled_rect((targets[current_target_index][0] - camera_offset_x, targets[current_target_index][1], 
+                                                                     targets[current_target_index][2], targets[current_target_index][3])))
         
-        # List of pedestrians that have reached their target/left the screen
-        pedestrians_to_remove = []  
-
-        # Update the pedestrians
-        for i in range(no_pedestrians):
-            pedestrian = pedestrians_H2[i]
-
-            screen_x = pedestrian.x - camera_offset_x
-
-            # Draw the pedestrians
-            pygame.draw.circle(screen, pedestrian_colour, (int(screen_x), int(pedestrian.y)), player_radius)
-
-            prev_vel_x, prev_vel_y = pedestrian_velocities_H2[i][0], pedestrian_velocities_H2[i][1]
-            ped_target_x, ped_target_y = pedestrian_target_H2[i]
-
-            new_x, new_y, new_vel_x, new_vel_y = pedestrian.move_towards(
-                ped_target_x, ped_target_y, prev_vel_x, prev_vel_y, pedestrian_coords_H2, pedestrian_constants
-            )
-
-            pedestrian_coords_H2[i] = (new_x, new_y)
-            pedestrian_velocities_H2[i] = (new_vel_x, new_vel_y)
-
-            # Check if the pedestrian has reached the target
-            # distance_to_target = math.hypot(new_x - ped_target_x, new_y - ped_target_y) 
-            if new_x < H2_target_x:
-                pedestrians_to_remove.append(i)
-            
-        # Remove the pedestrians that have reached their target/left the screen
-        for i in reversed(pedestrians_to_remove):
-            pedestrian_coords_H2.pop(i)
-            pedestrian_velocities_H2.pop(i)
-            pedestrians_H2.pop(i)
-            pedestrian_target_H2.pop(i)
-            no_pedestrians -= 1
-
-        if lights_on:
-            # Reset the dimmed overlay
-            dim_surf.fill((0, 0, 0, dimness))
-
-            # Add the lights
-            for light_surf, (x,y) in zip(light_surfaces_H2, light_centres_H2):
-                adjusted_x = x - camera_offset_x
-                dim_surf.blit(light_surf, (adjusted_x, y), special_flags=pygame.BLEND_RGBA_SUB)
-            # Draw the dimmed overlay and lights onto the screen
-            screen.blit(dim_surf, (0, 0))
-
-        # Draw the dashed line (target)
-        x_adjusted = (width*2)-50 - camera_offset_x
-        y = 0
-        while y < height:
-            pygame.draw.line(screen, player_colour, (x_adjusted, y), (x_adjusted, min(y+dash_length, height)))
-            y += dash_length + gap_length
-
-        pygame.display.update()
-
-        if player.x > (2*width)-50:
-            H2_end = pygame.time.get_ticks()
-            flags_treatment['H2'] = False
-            if treatment[0] == 'H2':
-                instruction_4_active = True
-            elif treatment[1] == 'H2':
-                instruction_5_active = True
-            elif treatment[2] == 'H2':
-                final_screen = True
+            # Draw the player
+            draw_agents(screen, player_colour, [(width/2, player.y)], 0)
+
+            present()
+            frame_pacer.presented()
+            if telemetry is not None:
+                telemetry.frame(dt, (player.x, player.y), player_velocity, None, scenario_number)
+
+            # Check if the player has reached the final target
+            if current_target_index > no_targets-1:
+                initial_navigation = False
+                scenario_instruction_active = True
+                # Start preparing the first scenario while the instructions are read
+                scenario_preload = preload_scenario(treatment[scenario_number], participant_number, timer)
+
+                # Reset the player's position
+                player.x, player.y = player_x, height - (pavement_height/2)
+                # Reset the player's target
+                target_x, target_y = player.x, player.y
+                # Reset the player's velocity
+                player_velocity = [0, 0]
+                # Drop any click still waiting to be presented
+                frame_pacer.cancel_click()
+
+        if scenario_instruction_active:
+            display_instructions(screen, scenario_instructions[scenario_number])
+            continue
+
+        # Scenario runner (the same frame loop for every treatment, driven by scenario_specs)
+        if active_scenario is not None:
+            scenario = active_scenario
+            log = scenario.log
+            crowd = scenario.crowd
+
+            for step in range(physics_steps if moving else 0):
+                player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
+                    target_x, target_y, player_velocity[0], player_velocity[1], dt, 
+                    crowd.coords if crowd is not None else pedestrian_coords_initial, pedestrian_constants)
+                player_velocity = [player_new_vel_x, player_new_vel_y]
+                frame_pacer.stepped()
+
+                if math.hypot(target_x - player.x, target_y - player.y) < 1:
+                    moving = False
+                    break
             
-            # Reset the player's position
-            player.x, player.y = player_x, height - (pavement_height/2)
-            # Reset the player's target
-            target_x, target_y = player.x, player.y
-            # Reset the player's velocity
-            player_velocity = [0, 0]
-            # Reset the bottom flag
-            bottom = True
-            # Reset the number of pedestrians
-            no_pedestrians = 40
-        continue
-
-    if instruction_5_active:
-        display_instructions(screen, instructions_text_5)
-        continue
-
-    if flags_treatment['H3']:
-        if H3_start is None:
-            H3_start = pygame.time.get_ticks()
-
-        if moving:
-            player_new_x, player_new_y, player_new_vel_x, player_new_vel_y = player.move_towards(
-                target_x, target_y, player_velocity[0], player_velocity[1], dt, pedestrian_coords_H3, pedestrian_constants)
-            player_velocity = [player_new_vel_x, player_new_vel_y]
-
-            if math.hypot(target_x - player.x, target_y - player.y) < 1:
-                moving = False
-        
-        if bottom:
-            if player.y < pavement_height:
-                cross_road_H3 += 1
-                bottom = False
-
-        elif not bottom:
-            if player.y > height - pavement_height:
-                cross_road_H3 += 1
+            if bottom:
+                if player.y < pavement_height:
+                    log['cross_road'] += 1
+                    bottom = False
+
+            elif not bottom:
+                if player.y > height - pavement_height:
+                    log['cross_road'] += 1
+                    bottom = True
+
+            # Save the player and pedestrian positions
+            if data_timer >= data_interval:
+                log['player_position'].append((player.x, player.y))
+                seconds = (pygame.time.get_ticks() - log['start']) / 1000
+                session_store.add_sample(scenario.trial_id, seconds, player.x, player.y)
+                if scenario.spec['log_pedestrians']:
+                    log['pedestrian_positions'].append([(pedestrian.x, pedestrian.y) for pedestrian in crowd.pedestrians])
+                    session_store.add_pedestrians(scenario.trial_id, seconds, crowd.ids, log['pedestrian_positions'][-1])
+                data_timer = 0
+
+            # Accumulate the occupancy
+            scenario.occupancy['player'].add((player.x, player.y), player_velocity, dt)
+            if crowd is not None:
+                scenario.occupancy['pedestrians'].add(crowd.coords, crowd.velocities, dt)
+
+            camera_offset_x = player.x - width/2
+            scenario.world.update(camera_offset_x)
+            scenario.world.update_lights((pygame.time.get_ticks() - log['start']) / 1000, player.x)
+
+            draw_scenario(screen, scenario.world, scenario.spec['goal_x'], player.y, 
+                          crowd.coords if crowd is not None else pedestrian_coords_initial, camera_offset_x)
+
+            # Update the pedestrians and detect the contacts and near misses of each step
+            if crowd is not None:
+                seconds = (pygame.time.get_ticks() - log['start']) / 1000
+                for step in range(physics_steps):
+                    crowd.step(crowd_stepper)
+                    for event in scenario.events.update(seconds, crowd.proximity, (player.x, player.y), player_velocity):
+                        session_store.add_event(scenario.trial_id, *event)
+
+            present()
+            frame_pacer.presented()
+            if telemetry is not None:
+                telemetry.frame(dt, (player.x, player.y), player_velocity, scenario.name, scenario_number, 
+                                crowd.proximity if crowd is not None else None)
+
+            if player.x > scenario.spec['goal_x']:
+                log['end'] = pygame.time.get_ticks()
+                session_store.end_trial(scenario.trial_id, scenario.time(), log['cross_road'], log['clicks'])
+                scenario.release()
+                active_scenario = None
+                scenario_number += 1
+                if scenario_number < len(treatment):
+                    scenario_instruction_active = True
+                    # Start preparing the next scenario while the instructions are read
+                    scenario_preload = preload_scenario(treatment[scenario_number], participant_number, timer)
+                else:
+                    final_screen = True
+                    # Save the data as soon as the session is complete
+                    memory_stats = memory_monitor.stats() if memory_monitor is not None else {}
+                    save_data(participant_number, scenarios, treatment, frame_pacer.stats(), timer.stats(), memory_stats)
+                    session_store.end_session(session_id, treatment, session_crowd_layout(scenarios), 
+                                              {**frame_pacer.stats(), **timer.stats(), **memory_stats, **proximity_stats(scenarios), 
+                                               **warmup_stats(scenarios)})
+
+                # Reset the player's position
+                player.x, player.y = player_x, height - (pavement_height/2)
+                # Reset the player's target
+                target_x, target_y = player.x, player.y
+                # Reset the player's velocity
+                player_velocity = [0, 0]
+                # Drop any click still waiting to be presented
+                frame_pacer.cancel_click()
+                # Reset the bottom flag
                 bottom = True
-                
-        # Save the player and pedestrian positions
-        if data_timer >= data_interval:
-            player_position_H3.append((player.x, player.y))
-            pedestrian_positions_H3.append([(pedestrian.x, pedestrian.y) for pedestrian in pedestrians_H3])
-            data_timer = 0
-
-        camera_offset_x = player.x - width/2
-
-        # Pick screen colour
-        screen.fill(background_colour)
-
-        # Draw the road
-        for rect in rectangles:
-            pygame.draw.rect(screen, road_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the road markings
-        for rect in road_markings:
-            pygame.draw.rect(screen, road_marking_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # # Draw the curb
-        # for rect in curbs:
-        #     pygame.draw.rect(screen, curb_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # # Draw the light poles
-        # for rect in light_poles:
-        #     pygame.draw.rect(screen, light_pole_colour, (rect[0] - camera_offset_x, rect[1], rect[2], rect[3]))
-
-        # Draw the player
-        pygame.draw.circle(screen, player_colour, (int(width/2), int(player.y)), player_radius)
-        
-        # List of pedestrians that have reached their target/left the screen
-        pedestrians_to_remove = []  
-
-        # Update the pedestrians
-        for i in range(no_pedestrians):
-            pedestrian = pedestrians_H3[i]
-
-            screen_x = pedestrian.x - camera_offset_x
-
-            # Draw the pedestrians
-            pygame.draw.circle(screen, pedestrian_colour, (int(screen_x), int(pedestrian.y)), player_radius)
-
-            prev_vel_x, prev_vel_y = pedestrian_velocities_H3[i][0], pedestrian_velocities_H3[i][1]
-            ped_target_x, ped_target_y = pedestrian_target_H3[i]
-
-            new_x, new_y, new_vel_x, new_vel_y = pedestrian.move_towards(
-                ped_target_x, ped_target_y, prev_vel_x, prev_vel_y, pedestrian_coords_H3, pedestrian_constants
-            )
-
-            pedestrian_coords_H3[i] = (new_x, new_y)
-            pedestrian_velocities_H3[i] = (new_vel_x, new_vel_y)
-
-            # Check if the pedestrian has reached the target
-            if new_x > H3_target_x:
-                pedestrians_to_remove.append(i)
-            
-        # Remove the pedestrians that have reached their target/left the screen
-        for i in reversed(pedestrians_to_remove):
-            pedestrian_coords_H3.pop(i)
-            pedestrian_velocities_H3.pop(i)
-            pedestrians_H3.pop(i)
-            pedestrian_target_H3.pop(i)
-            no_pedestrians -= 1
-
-        if lights_on:
-            # Reset the dimmed overlay
-            dim_surf.fill((0, 0, 0, dimness))
-
-            # Add the lights
-            for light_surf, (x,y) in zip(light_surfaces_H3, light_centres_H3):
-                adjusted_x = x - camera_offset_x
-                dim_surf.blit(light_surf, (adjusted_x, y), special_flags=pygame.BLEND_RGBA_SUB)
-            # Draw the dimmed overlay and lights onto the screen
-            screen.blit(dim_surf, (0, 0))
-
-        # Draw the dashed line (target)
-        x_adjusted = (width*2)-50 - camera_offset_x
-        y = 0
-        while y < height:
-            pygame.draw.line(screen, player_colour, (x_adjusted, y), (x_adjusted, min(y+dash_length, height)))
-            y += dash_length + gap_length
-        
-        pygame.display.update()
-
-        if player.x > (2*width)-50:
-            H3_end = pygame.time.get_ticks()
-            flags_treatment['H3'] = False
-            if treatment[0] == 'H3':
-                instruction_4_active = True
-            elif treatment[1] == 'H3':
-                instruction_5_active = True
-            elif treatment[2] == 'H3':
-                final_screen = True
-            
-            # Reset the player's position
-            player.x, player.y = player_x, height - (pavement_height/2)
-            # Reset the player's target
-            target_x, target_y = player.x, player.y
-            # Reset the player's velocity
-            player_velocity = [0, 0]
-            # Reset the bottom flag
-            bottom = True
-            # Reset the number of pedestrians
-            no_pedestrians = 40
-        continue
-
-    if final_screen:
-        display_instructions(screen, final_screen_text)
-        H1_time = (H1_end - H1_start) / 1000
-        H2_time = (H2_end - H2_start) / 1000
-        H3_time = (H3_end - H3_start) / 1000
-
-    # Update the display
-    pygame.display.update()
-
-# Save the data
-save_data(H1_time, H2_time, H3_time, player_position_H1, player_position_H2, player_position_H3, cross_road_H1, 
-            cross_road_H2, cross_road_H3, click_H1, click_H2, click_H3, click_position_H1, click_position_H2, 
-            click_position_H3, pedestrian_positions_H2, pedestrian_positions_H3, treatment)
-
-# Quit pygame
-pygame.quit()
+            continue
+
+        if final_screen:
+            display_instructions(screen, kiosk_final_screen_text if kiosk_mode else final_screen_text)
+
+        # Update the display
+        present()
+
+    return final_screen, True
+
+# Run the sessions (the module is also imported by replay.py for its renderer)
+if __name__ == '__main__':
+    session_store = SessionStore(session_store_path, track_resolution = trajectory_resolution, track_tolerance = trajectory_tolerance,
+                                 player_track_tolerance = trajectory_player_tolerance)
+    if telemetry_name is not None:
+        try:
+            telemetry = TelemetryPublisher(telemetry_name)
+        except FileExistsError as error:
+            print(f'{error}, running without telemetry (set telemetry_name to watch this game)')
+    memory_monitor = MemoryMonitor(memory_budget_mb, memory_report_interval, memory_trace)
+    session_id, participant_number = new_session(participant_number)
+    if kiosk_mode:
+        treatment = counterbalanced_treatment(participant_number)
+    timer = startup_timer
+    while True:
+        completed, quit = run_session(participant_number, session_id, treatment, timer)
+        if quit or not kiosk_mode:
+            break
+        # Next participant, only the per-session state is rebuilt
+        session_id, participant_number = new_session(participant_number)
+        treatment = counterbalanced_treatment(participant_number)
+        timer = StartupTimer(startup_budget, start = time.perf_counter())
+
+    # Stop the scenario loader and the crowd workers, write any rows still buffered by the session store and remove the telemetry ring
+    scenario_loader.shutdown(cancel_futures = True)
+    if crowd_stepper is not None:
+        crowd_stepper.close()
+    session_store.close()
+    if telemetry is not None:
+        telemetry.close()
+
+    # Quit pygame
+    pygame.quit()
@@ -0,0 +1,194 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+'''
+Memory monitor for long sessions.
+
+Every report_interval seconds the monitor samples:
+    rss        - resident memory of the process (psutil when installed, otherwise /proc/self/statm,
+                 the Windows process counters or, failing those, the peak from getrusage)
+    python     - memory allocated by Python objects, traced with tracemalloc (when tracing)
+    subsystems - the size of each registered subsystem (eg logging buffers, crowd state, surfaces),
+                 from a function returning bytes. Python containers are measured with estimate_size,
+                 which samples the elements of long containers instead of walking all of them, so a
+                 report stays cheap however long the session has run
+Each report is passed to log (print by default, the game also keeps them in the session store), followed
+by the source lines whose traced allocations grew the most since the previous report (a steady grower
+there is usually a leak). Grouping the traces by line takes seconds once there are a few hundred thousand
+of them, so it runs in a background thread rather than in the frame, and its result is logged by the next
+update. When the RSS crosses the budget a warning is logged at once rather than at the next report. The
+peaks go into the session data.
+
+Tracing every allocation slows the game loop down a lot (about 2.5x in a headless session), so unless
+trace is set the monitor only starts tracemalloc once the budget has been crossed, and the reports
+after that point at the growing lines.
+'''
+
+# psutil Process of this process, or None when psutil is not installed
+def psutil_process():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process()
+
+# Resident memory of this process in bytes (None if it cannot be read), process is the psutil_process() when there is one
+def rss(process = None):
+    if process is not None:
+        return process.memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                                             'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # bytes on macOS, kilobytes elsewhere
+    except ImportError:
+        return None
+
+# Approximate deep size of a Python object in bytes, measuring at most samples elements per container
+def estimate_size(obj, samples = 8):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'base'): # numpy array (getsizeof only counts the data it owns)
+        return size if obj.base is None else size + obj.nbytes
+    if isinstance(obj, dict):
+        elements = list(obj.values()) + list(obj.keys())
+    elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == 'deque':
+        elements = obj if isinstance(obj, (list, tuple)) else list(obj)
+    elif hasattr(obj, '__dict__'):
+        return size + estimate_size(vars(obj), samples)
+    else:
+        return size
+    if len(elements) <= samples:
+        return size + sum(estimate_size(element, samples) for element in elements)
+    step = len(elements) / samples
+    measured = sum(estimate_size(elements[int(k * step)], samples) for k in range(samples))
+    return size + measured * len(elements) / samples
+
+# Bytes of pixel data held by pygame surfaces
+def surface_size(surfaces):
+    return sum(surface.get_pitch() * surface.get_height() for surface in surfaces)
+
+# Memory monitor class
+class MemoryMonitor:
+    def __init__(self, budget_mb, report_interval = 30, trace = False, top_lines = 3, log = print):
+        self.budget = budget_mb * 1024**2
+        self.report_interval = report_interval
+        self.trace = False
+        self.top_lines = top_lines
+        self.log = log # called with each report and warning
+        self.process = psutil_process() # looked up once, not at every poll
+        self.subsystems = {} # name -> function returning its size in bytes
+        self.line_sizes = {} # traced bytes per source line at the previous report
+        self.growth_thread = None
+        self.growth = None # lines found by the growth thread, logged by the next update
+        if trace:
+            self.start_tracing()
+        self.start = time.perf_counter()
+        self.reset_stats()
+
+    def start_tracing(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace = True
+        self.line_sizes = self.traced_lines(tracemalloc.take_snapshot())
+
+    # Traced bytes per source line (the snapshot itself is dropped, only these totals are kept between reports)
+    def traced_lines(self, snapshot):
+        return {statistic.traceback[0]: statistic.size for statistic in snapshot.statistics('lineno')}
+
+    # Find the lines whose allocations grew the most since the previous report
+    def report_growth(self, snapshot):
+        line_sizes = self.traced_lines(snapshot)
+        growth = sorted(((size - self.line_sizes.get(frame, 0), frame) for frame, size in line_sizes.items()), key = lambda item: -item[0])
+        lines = [f'    +{size_diff / 1024:.0f} KB  {os.path.basename(frame.filename)}:{frame.lineno}'
+                 for size_diff, frame in growth[:self.top_lines] if size_diff >= 1024]
+        if lines:
+            self.growth = 'Memory growth since the previous report:\n' + '\n'.join(lines)
+        self.line_sizes = line_sizes
+
+    # Register (or replace) the size function of a subsystem
+    def track(self, name, size):
+        self.subsystems[name] = size
+
+    # Clear the peaks (eg at the start of a new session)
+    def reset_stats(self):
+        self.last_report = self.last_budget_check = time.perf_counter()
+        self.peaks = {}
+        self.warnings = 0
+        self.over_budget = False
+        if self.trace:
+            tracemalloc.reset_peak()
+
+    def record_peak(self, name, value):
+        if value is not None:
+            self.peaks[name] = max(self.peaks.get(name, 0), value)
+
+    # Call once per frame, checks the budget every second and reports every report_interval seconds
+    def update(self):
+        now = time.perf_counter()
+        if self.growth is not None:
+            growth, self.growth = self.growth, None
+            self.log(growth)
+        if now - self.last_report >= self.report_interval:
+            self.last_report = self.last_budget_check = now
+            self.log(self.report(now))
+        elif now - self.last_budget_check >= 1:
+            self.last_budget_check = now
+            self.check_budget(rss(self.process))
+
+    # Log a warning when the RSS goes over the budget (once per crossing)
+    def check_budget(self, resident):
+        self.record_peak('rss', resident)
+        if resident is None:
+            return
+        if resident > self.budget and not self.over_budget:
+            self.warnings += 1
+            self.log(f'WARNING: memory use {resident / 1024**2:.0f} MB is over the budget of {self.budget / 1024**2:.0f} MB')
+            if not self.trace:
+                self.start_tracing()
+        self.over_budget = resident > self.budget
+
+    def report(self, now = None):
+        now = time.perf_counter() if now is None else now
+        resident = rss(self.process)
+        self.check_budget(resident)
+        parts = [f'Memory at {now - self.start:.0f} s: RSS ' + (f'{resident / 1024**2:.0f} MB' if resident is not None else 'unknown') +
+                 f' (budget {self.budget / 1024**2:.0f} MB)']
+        if self.trace:
+            python, python_peak = tracemalloc.get_traced_memory()
+            self.record_peak('python', python_peak)
+            parts.append(f'Python {python / 1024**2:.1f} MB')
+        for name, size in self.subsystems.items():
+            value = size()
+            self.record_peak(name, value)
+            parts.append(f'{name} {value / 1024**2:.1f} MB')
+
+        # Growing lines (skipped if the previous report is still being grouped)
+        if self.trace and (self.growth_thread is None or not self.growth_thread.is_alive()):
+            self.growth_thread = threading.Thread(target = self.report_growth, args = (tracemalloc.take_snapshot(),), daemon = True)
+            self.growth_thread.start()
+        return ', '.join(parts)
+
+    # Peaks for the session data
+    def stats(self):
+        stats = {f'Memory_{name}_peak_mb': value / 1024**2 for name, value in self.peaks.items()}
+        stats['Memory_budget_warnings'] = self.warnings
+        return stats
@@ -0,0 +1,110 @@
+import heapq
+import math
+import numpy as np
+
+'''
+Lighting-aware navigation field.
+
+Instead of steering straight at their target, pedestrians can follow a cost field computed once per
+scenario over the walkable area. The street is covered with square cells, each with a darkness from 0
+(fully lit) to 1 (the dimmed overlay with no light on it). Moving through a cell costs its length times
+1 + darkness_cost * darkness, so with darkness_cost > 0 the cheapest route to the goal bends towards
+the lamps. The cost to reach the goal from every cell comes from one Dijkstra run over the 8-connected
+cell grid, seeded with every walkable cell past the goal line (the crowd leaves the street there).
+
+The desired direction of a pedestrian is the normalised negative gradient of that cost at its cell,
+precomputed for every cell, so steering is a lookup however many pedestrians there are. Cells that
+cannot reach the goal (and the cells past it) point along the crowd's direction.
+'''
+
+neighbour_steps = [(dx, dy, math.hypot(dx, dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+# Navigation field class
+class NavigationField:
+    def __init__(self, darkness, walkable, x_min, y_min, cell_size, goal_x, direction, darkness_cost = 1.0):
+        self.darkness = np.asarray(darkness, dtype = float) # (no_y, no_x)
+        self.walkable = np.asarray(walkable, dtype = bool)
+        self.no_y, self.no_x = self.darkness.shape
+        self.x_min, self.y_min, self.cell_size = x_min, y_min, cell_size
+        self.goal_x = goal_x
+        self.direction = direction # +1 if the goal is to the right, -1 to the left
+        self.darkness_cost = darkness_cost
+
+        self.cost = self.cost_to_goal()
+        self.direction_x, self.direction_y = self.gradient_directions()
+
+    # Cells whose centre is past the goal line
+    def goal_cells(self):
+        centres = self.x_min + (np.arange(self.no_x) + 0.5) * self.cell_size
+        past = (centres - self.goal_x) * self.direction >= 0
+        if not past.any(): # the goal line is beyond the grid, use its last column
+            past[-1 if self.direction > 0 else 0] = True
+        return self.walkable & past[None, :]
+
+    # Dijkstra from the goal cells, returns the cost to the goal per cell (inf where it cannot be reached)
+    def cost_to_goal(self):
+        weight = (1 + self.darkness_cost * self.darkness) * self.cell_size
+        walkable = self.walkable.tolist()
+        weight = weight.tolist()
+        cost = [[math.inf] * self.no_x for j in range(self.no_y)]
+        heap = []
+        for j, i in zip(*np.nonzero(self.goal_cells())):
+            cost[j][i] = 0.0
+            heap.append((0.0, int(j), int(i)))
+        heapq.heapify(heap)
+
+        while heap:
+            c, j, i = heapq.heappop(heap)
+            if c > cost[j][i]:
+                continue
+            for dx, dy, length in neighbour_steps:
+                nj, ni = j + dy, i + dx
+                if 0 <= nj < self.no_y and 0 <= ni < self.no_x and walkable[nj][ni]:
+                    # Cost of the step is the mean weight of the two cells times the distance
+                    new_cost = c + length * (weight[j][i] + weight[nj][ni]) / 2
+                    if new_cost < cost[nj][ni]:
+                        cost[nj][ni] = new_cost
+                        heapq.heappush(heap, (new_cost, nj, ni))
+        return np.array(cost)
+
+    # Unit vectors down the cost gradient per cell (one-sided differences next to unwalkable cells)
+    def gradient_directions(self):
+        reachable = np.isfinite(self.cost)
+        cost = np.where(reachable, self.cost, np.nan) # differences with unreachable cells are nan
+        gradients = []
+        for axis in (1, 0):
+            forward = np.full(cost.shape, np.nan)
+            backward = np.full(cost.shape, np.nan)
+            if axis == 1:
+                forward[:, :-1] = cost[:, 1:] - cost[:, :-1]
+                backward[:, 1:] = cost[:, 1:] - cost[:, :-1]
+            else:
+                forward[:-1, :] = cost[1:, :] - cost[:-1, :]
+                backward[1:, :] = cost[1:, :] - cost[:-1, :]
+            gradient = np.where(np.isnan(forward), backward, np.where(np.isnan(backward), forward, (forward + backward) / 2))
+            gradients.append(np.nan_to_num(gradient))
+
+        direction_x, direction_y = -gradients[0], -gradients[1]
+        norm = np.hypot(direction_x, direction_y)
+        steering = reachable & (norm > 0) & ~self.goal_cells()
+        direction_x = np.where(steering, direction_x / np.where(norm > 0, norm, 1), self.direction)
+        direction_y = np.where(steering, direction_y / np.where(norm > 0, norm, 1), 0)
+        return direction_x, direction_y
+
+    # Cell indices of positions (N, 2), clamped to the grid
+    def cells(self, positions):
+        positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+        i = np.clip(((positions[:, 0] - self.x_min) // self.cell_size).astype(int), 0, self.no_x - 1)
+        j = np.clip(((positions[:, 1] - self.y_min) // self.cell_size).astype(int), 0, self.no_y - 1)
+        return j, i
+
+    # Desired directions e_i (N, 2) of agents at positions (N, 2)
+    def directions(self, positions):
+        j, i = self.cells(positions)
+        return np.column_stack([self.direction_x[j, i], self.direction_y[j, i]])
+
+    # Points lookahead pixels down the field from positions (N, 2), used as the agents' targets so that
+    # both crowd steppers steer along the field unchanged
+    def waypoints(self, positions, lookahead):
+        positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+        return positions + self.directions(positions) * lookahead
@@ -0,0 +1,143 @@
+import argparse
+import collections
+import statistics
+import time
+import pygame
+from telemetry import TelemetryReader
+
+'''
+Live session dashboard for the experimenter.
+
+Runs as its own process and reads the telemetry ring published by main_moving_final.py (see
+telemetry.py), so none of this drawing happens in the participant's process.
+
+    python observer.py
+
+It shows the participant and treatment order, the current treatment, the player on a map of the
+street, the crowd summary, the latest clicks and the recent frame times.
+'''
+
+# Street extents of the map, mirrors the road variables in main_moving_final.py (window units)
+road_start, road_end, street_height, pavement_height = -750, 3750, 840, 210
+
+background_colour = '#222233'
+text_colour = '#AACCFF'
+warning_colour = (255, 120, 80)
+
+# Dashboard class
+class Dashboard:
+    def __init__(self, fps, history = 600):
+        self.fps = fps
+        self.session = None
+        self.frame = None
+        self.frame_times = collections.deque(maxlen = history) # ms
+        self.clicks = collections.deque(maxlen = 8)
+        self.last_record = None # time the last record was received (observer clock)
+
+    def add(self, kind, record):
+        self.last_record = time.perf_counter()
+        if kind == 'session':
+            self.session = record
+            self.frame_times.clear()
+            self.clicks.clear()
+        elif kind == 'frame':
+            self.frame = record
+            self.frame_times.append(record['frame_ms'])
+        elif kind == 'click':
+            self.clicks.append(record)
+
+    def draw(self, screen, font, dropped):
+        screen.fill(background_colour)
+        width = screen.get_width()
+        lines = []
+        if self.session is None:
+            lines.append('Waiting for a session...')
+        else:
+            lines.append(f"Participant {self.session['participant']}   order {self.session['treatment'].decode()}")
+        if self.frame is not None:
+            frame = self.frame
+            treatment = frame['treatment'].decode()
+            lines.append(f"Treatment {treatment if treatment != '--' else 'none (instructions / practice)'}   scenario {frame['scenario'] + 1}")
+            lines.append(f"Player x {frame['x']:7.1f}  y {frame['y']:6.1f}   speed {(frame['velocity_x']**2 + frame['velocity_y']**2) ** 0.5:6.1f}")
+            nearest = f"{frame['nearest']:.1f}" if frame['nearest'] >= 0 else '-'
+            lines.append(f"Crowd {frame['crowd']} pedestrians   mean speed {frame['crowd_speed']:.1f}   nearest {nearest}")
+            lines.append(f"Telemetry lag {(time.perf_counter() - frame['time']) * 1000:6.1f} ms   dropped records {dropped}")
+        for i, line in enumerate(lines):
+            screen.blit(font.render(line, True, text_colour), (20, 15 + i * 26))
+
+        # Map of the street with the player and the latest clicks
+        map_rect = pygame.Rect(20, 160, width - 40, 120)
+        scale_x = map_rect.width / (road_end - road_start)
+        scale_y = map_rect.height / street_height
+        pygame.draw.rect(screen, (60, 60, 60), map_rect)
+        pygame.draw.rect(screen, (20, 20, 20), (map_rect.x, map_rect.y + pavement_height * scale_y, map_rect.width, (street_height - 2*pavement_height) * scale_y))
+        for click in self.clicks:
+            pygame.draw.circle(screen, (0, 255, 0), (map_rect.x + (click['x'] - road_start) * scale_x, map_rect.y + click['y'] * scale_y), 3, 1)
+        if self.frame is not None:
+            pygame.draw.circle(screen, (255, 0, 0), (map_rect.x + (self.frame['x'] - road_start) * scale_x, map_rect.y + self.frame['y'] * scale_y), 5)
+
+        # Frame times (the line is the frame budget)
+        graph = pygame.Rect(20, 310, width - 40, 120)
+        pygame.draw.rect(screen, (10, 10, 20), graph)
+        budget = 1000 / self.fps
+        top = 3 * budget
+        pygame.draw.line(screen, text_colour, (graph.x, graph.bottom - graph.height * budget / top), (graph.right, graph.bottom - graph.height * budget / top))
+        if len(self.frame_times) > 1:
+            step = graph.width / (self.frame_times.maxlen - 1)
+            points = [(graph.x + i * step, graph.bottom - graph.height * min(ms, top) / top) for i, ms in enumerate(self.frame_times)]
+            pygame.draw.lines(screen, warning_colour, False, points)
+            frame_times = list(self.frame_times)
+            summary = f'Frame time mean {statistics.fmean(frame_times):.1f} ms   max {max(frame_times):.1f} ms   budget {budget:.1f} ms'
+            screen.blit(font.render(summary, True, text_colour), (graph.x, graph.bottom + 8))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Live dashboard of the running session')
+    parser.add_argument('--name', default = 'virtual_experiment_telemetry', help = 'telemetry ring name (telemetry_name in main_moving_final.py)')
+    parser.add_argument('--fps', type = int, default = 60, help = 'frame rate of the game')
+    args = parser.parse_args()
+
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((900, 470))
+    pygame.display.set_caption('Session observer')
+    font = pygame.font.Font(None, 26)
+    clock = pygame.time.Clock()
+    dashboard = Dashboard(args.fps)
+    reader = None
+
+    running = True
+    while running:
+        clock.tick(30)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+
+        # Attach to the ring once the game has created it
+        if reader is None:
+            try:
+                reader = TelemetryReader(args.name)
+            except FileNotFoundError:
+                pass
+        # When nothing has arrived for a while, check whether a restarted game has replaced the ring
+        elif time.perf_counter() - (dashboard.last_record or 0) > 2:
+            try:
+                fresh = TelemetryReader(args.name)
+                if fresh.written() != reader.written():
+                    reader.close()
+                    reader = fresh
+                else:
+                    fresh.close()
+            except FileNotFoundError:
+                pass
+            dashboard.last_record = time.perf_counter()
+
+        if reader is not None:
+            for kind, record in reader.poll():
+                dashboard.add(kind, record)
+        dashboard.draw(screen, font, reader.dropped if reader is not None else 0)
+        pygame.display.update()
+
+    if reader is not None:
+        reader.close()
+    pygame.quit()
@@ -0,0 +1,161 @@
+import numpy as np
+
+'''
+Online occupancy accumulators.
+
+Every grid covers the street with square cells and keeps, per cell:
+    samples    - number of position samples that fell in the cell
+    dwell      - time spent in the cell (sum of the frame times, in seconds)
+    velocity_x - sum of the x velocities sampled in the cell
+    velocity_y - sum of the y velocities sampled in the cell
+
+The street is split along x into tiles of tile_width (the game uses its segments). A tile's dense arrays
+are allocated when the first sample falls in it, and release() (called as the world releases the
+segment) compacts it into sparse form, the flat indices and sums of the cells that have samples. So the
+memory of a grid follows the streamed segments and the visited cells rather than the length of the
+route, and merging two grids costs the number of their visited cells.
+
+Samples are binned with np.add.at, so a batch (eg the whole crowd for one frame) costs O(1) per sample.
+Grids with the same extent add up cell by cell, so cohort heatmaps come from summing the small sparse
+arrays saved with each session instead of rescanning the position data.
+'''
+
+fields = ('samples', 'dwell', 'velocity_x', 'velocity_y')
+
+# Occupancy grid class
+class OccupancyGrid:
+    def __init__(self, x_min, x_max, y_min, y_max, cell_size, tile_width = None):
+        self.extent = (x_min, x_max, y_min, y_max, cell_size)
+        self.no_x = int(np.ceil((x_max - x_min) / cell_size))
+        self.no_y = int(np.ceil((y_max - y_min) / cell_size))
+        # Columns of cells per tile (one tile for the whole street without a tile_width)
+        self.tile_columns = self.no_x if tile_width is None else max(1, int(np.ceil(tile_width / cell_size)))
+        self.tiles = {} # tile index -> {field: (no_y * tile_columns,) array}, the tiles still being filled
+        self.cells = np.zeros(0, dtype = np.int64) # sorted flat indices (y * no_x + x) of the visited cells of the removed tiles
+        self.values = {field: np.zeros(0) for field in fields} # sums of those cells
+
+    # Bin a batch of positions (N, 2) and velocities (N, 2) that were each held for dt seconds
+    def add(self, positions, velocities, dt):
+        positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+        velocities = np.asarray(velocities, dtype = float).reshape(-1, 2)
+        if len(positions) == 0:
+            return
+        x_min, x_max, y_min, y_max, cell_size = self.extent
+        cell_x = np.floor((positions[:, 0] - x_min) / cell_size).astype(int)
+        cell_y = np.floor((positions[:, 1] - y_min) / cell_size).astype(int)
+
+        # Ignore the samples outside the grid
+        inside = (cell_x >= 0) & (cell_x < self.no_x) & (cell_y >= 0) & (cell_y < self.no_y)
+        cell_x, cell_y, velocities = cell_x[inside], cell_y[inside], velocities[inside]
+        tile, column = np.divmod(cell_x, self.tile_columns)
+
+        # Usually one or two tiles per batch
+        for index in np.unique(tile).tolist():
+            if index not in self.tiles:
+                self.tiles[index] = {field: np.zeros(self.no_y * self.tile_columns) for field in fields}
+            arrays = self.tiles[index]
+            in_tile = tile == index
+            cells = cell_y[in_tile] * self.tile_columns + column[in_tile]
+            np.add.at(arrays['samples'], cells, 1)
+            np.add.at(arrays['dwell'], cells, dt)
+            np.add.at(arrays['velocity_x'], cells, velocities[in_tile, 0])
+            np.add.at(arrays['velocity_y'], cells, velocities[in_tile, 1])
+
+    # Visited cells of a tile as (flat indices, {field: sums})
+    def tile_cells(self, index):
+        arrays = self.tiles[index]
+        local = np.flatnonzero(arrays['samples'])
+        row, column = np.divmod(local, self.tile_columns)
+        return row * self.no_x + index * self.tile_columns + column, {field: arrays[field][local] for field in fields}
+
+    # Add sparse cells (flat indices, {field: sums}) to the compacted cells
+    def add_cells(self, cells, values):
+        cells, inverse = np.unique(np.concatenate([self.cells, cells]), return_inverse = True)
+        self.values = {field: np.bincount(inverse, np.concatenate([self.values[field], values[field]]), minlength = len(cells))
+                       for field in fields}
+        self.cells = cells
+
+    # Compact the tiles within x1 <= x < x2 (eg a segment the world has released)
+    def release(self, x1, x2):
+        x_min, _, _, _, cell_size = self.extent
+        tile_width = self.tile_columns * cell_size
+        for index in [index for index in self.tiles if x_min + index * tile_width < x2 and x_min + (index + 1) * tile_width > x1]:
+            self.add_cells(*self.tile_cells(index))
+            del self.tiles[index]
+
+    # Compact every tile (eg at the end of a trial)
+    def compact(self):
+        for index in list(self.tiles):
+            self.add_cells(*self.tile_cells(index))
+            del self.tiles[index]
+        return self
+
+    # Visited cells as (flat indices, {field: sums}), the tiles still being filled included
+    def sparse(self):
+        if not self.tiles:
+            return self.cells, self.values
+        merged = OccupancyGrid(*self.extent)
+        merged.add_cells(self.cells, self.values)
+        for index in self.tiles:
+            merged.add_cells(*self.tile_cells(index))
+        return merged.cells, merged.values
+
+    # Add another grid with the same extent to this one
+    def merge(self, other):
+        if other.extent != self.extent:
+            raise ValueError(f'Cannot merge occupancy grids with extents {self.extent} and {other.extent}')
+        self.add_cells(*other.sparse())
+        return self
+
+    # Return a field as a 2D (no_y, no_x) array
+    def grid(self, field):
+        cells, values = self.sparse()
+        dense = np.zeros(self.no_x * self.no_y)
+        dense[cells] = values[field]
+        return dense.reshape(self.no_y, self.no_x)
+
+    # Mean velocity per cell (0 where there are no samples)
+    def mean_velocity(self):
+        samples = np.maximum(self.grid('samples'), 1)
+        return self.grid('velocity_x') / samples, self.grid('velocity_y') / samples
+
+# Save a dictionary of grids keyed by (treatment, agent) to a .npz file (the visited cells only)
+def save_occupancy(filename, grids):
+    arrays = {}
+    for (treatment, agent), grid in grids.items():
+        cells, values = grid.sparse()
+        arrays[f'{treatment}_{agent}_extent'] = np.array(grid.extent, dtype = float)
+        arrays[f'{treatment}_{agent}_cells'] = cells
+        for field in fields:
+            arrays[f'{treatment}_{agent}_{field}'] = values[field]
+    np.savez_compressed(filename, **arrays)
+
+# Load the grids saved by save_occupancy (or the dense grids saved before the cells were)
+def load_occupancy(filename):
+    grids = {}
+    with np.load(filename) as data:
+        for key in data.files:
+            if not key.endswith('_extent'):
+                continue
+            treatment, agent = key[:-len('_extent')].split('_', 1)
+            x_min, x_max, y_min, y_max, cell_size = data[key].tolist()
+            grid = OccupancyGrid(x_min, x_max, y_min, y_max, cell_size)
+            if f'{treatment}_{agent}_cells' in data.files:
+                cells = data[f'{treatment}_{agent}_cells']
+                grid.add_cells(cells, {field: data[f'{treatment}_{agent}_{field}'] for field in fields})
+            else:
+                cells = np.flatnonzero(data[f'{treatment}_{agent}_samples'])
+                grid.add_cells(cells, {field: data[f'{treatment}_{agent}_{field}'][cells] for field in fields})
+            grids[(treatment, agent)] = grid
+    return grids
+
+# Sum the grids of several sessions (eg every participant of a cohort)
+def merge_occupancy(filenames):
+    merged = {}
+    for filename in filenames:
+        for key, grid in load_occupancy(filename).items():
+            if key in merged:
+                merged[key].merge(grid)
+            else:
+                merged[key] = grid
+    return merged
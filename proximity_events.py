@@ -0,0 +1,112 @@
+import math
+import numpy as np
+
+'''
+Contact, near-miss and time-to-collision events.
+
+Every crowd step reports, per pedestrian, its closest other pedestrian and the distance to it, its
+distance to the player and whether its move collided (the overlap that Pedestrian.move_towards resolves
+by holding the pedestrian back). Both the scalar loop and the parallel stepper read these off the
+distances of their collision check, so the detector adds no pass over the pairs of the crowd. From
+them it emits pair events:
+    contact   - the move overlapped the pair (closer than 2r)
+    near_miss - closer than near_miss_factor * 2r
+    ttc       - at the current velocities the pair would touch within ttc_threshold seconds
+A pair is a pedestrian and its closest pedestrian, or a pedestrian and the player (agent -1). An event is
+emitted when a pair first enters a state, and the pair's episode lasts until it has been out of every
+state for gap seconds, so a pair hovering around a threshold counts once. The parallel stepper only
+sees neighbours within B_s in x, so near_miss_factor * 2r should stay below B_s.
+
+Per trial the events are counted by kind, for the player and within the crowd, along with the closest
+approach to the player, the shortest time to collision with the player and the time the player spent
+in a near miss.
+'''
+
+kinds = ('contact', 'near_miss', 'ttc')
+
+# Seconds until discs of radius r at relative positions p (N, 2) with relative velocities v (N, 2) touch
+# (0 if they already overlap, inf if they are not closing)
+def time_to_collision(p, v, r):
+    a = (v**2).sum(axis = 1)
+    b = 2 * (p * v).sum(axis = 1)
+    c = (p**2).sum(axis = 1) - (2*r)**2
+    discriminant = b**2 - 4*a*c
+    closing = (a > 0) & (b < 0) & (discriminant >= 0)
+    t = np.where(closing, (-b - np.sqrt(np.maximum(discriminant, 0))) / (2 * np.where(a > 0, a, 1)), np.inf)
+    return np.where(c <= 0, 0.0, t)
+
+# Proximity event detector class (one per trial)
+class ProximityEvents:
+    def __init__(self, radius, near_miss_factor = 1.4, ttc_threshold = 1.0, gap = 0.25):
+        self.radius = radius
+        self.near_miss_distance = near_miss_factor * 2 * radius
+        self.ttc_threshold = ttc_threshold
+        self.gap = gap
+        self.active = {} # pair -> [kinds seen in the episode, last time the pair was in a state]
+        self.events = [] # (time, kind, agent a, agent b, distance, time to collision)
+        self.player_min_distance = math.inf
+        self.player_min_ttc = math.inf
+        self.player_near_miss_seconds = 0.0
+        self.last_time = None
+
+    # Process one crowd step at time t (seconds into the trial), returns the new events
+    # proximity is the (N, 9) array of Crowd.step: id, x, y, v_x, v_y, closest id (-1 for none), distance to it,
+    # distance to the player, collision
+    def update(self, t, proximity, player, player_velocity):
+        dt = 0.0 if self.last_time is None else t - self.last_time
+        self.last_time = t
+        new_events = []
+        if len(proximity):
+            ids = proximity[:, 0]
+            positions, velocities = proximity[:, 1:3], proximity[:, 3:5]
+            nearest, nearest_distance, player_distance = proximity[:, 5], proximity[:, 6], proximity[:, 7]
+            collision = proximity[:, 8] > 0
+
+            # Time to collision with the closest pedestrian (the ids are in spawn order, so sorted) and with the player
+            has_nearest = nearest >= 0
+            other = np.clip(np.searchsorted(ids, nearest), 0, len(ids) - 1)
+            nearest_ttc = np.where(has_nearest, time_to_collision(positions[other] - positions, velocities[other] - velocities, self.radius), np.inf)
+            player_ttc = time_to_collision(np.asarray(player, dtype = float) - positions, np.asarray(player_velocity, dtype = float) - velocities, self.radius)
+
+            pairs = {}
+            for agent, distance, ttc, contact, flagged in (
+                    (nearest, nearest_distance, nearest_ttc, collision & (nearest_distance < 2 * self.radius), has_nearest),
+                    (np.full(len(ids), -1.0), player_distance, player_ttc, collision & (player_distance < 2 * self.radius), np.ones(len(ids), dtype = bool))):
+                near = distance < self.near_miss_distance
+                closing = ttc < self.ttc_threshold
+                for k in np.nonzero(flagged & (contact | near | closing))[0].tolist():
+                    pair = (int(min(ids[k], agent[k])), int(max(ids[k], agent[k])))
+                    state = pairs.setdefault(pair, [set(), math.inf, math.inf])
+                    state[0].update(kind for kind, flag in zip(kinds, (contact[k], near[k], closing[k])) if flag)
+                    state[1] = min(state[1], float(distance[k]))
+                    state[2] = min(state[2], float(ttc[k]))
+
+            for pair, (pair_kinds, distance, ttc) in pairs.items():
+                episode = self.active.setdefault(pair, [set(), t])
+                for kind in kinds:
+                    if kind in pair_kinds and kind not in episode[0]:
+                        new_events.append((t, kind, *pair, distance, ttc if math.isfinite(ttc) else None))
+                episode[0].update(pair_kinds)
+                episode[1] = t
+
+            # Player measures
+            self.player_min_distance = min(self.player_min_distance, float(player_distance.min()))
+            self.player_min_ttc = min(self.player_min_ttc, float(player_ttc.min()))
+            if any(pair[0] == -1 and 'near_miss' in pair_kinds for pair, (pair_kinds, _, _) in pairs.items()):
+                self.player_near_miss_seconds += dt
+
+        # End the episodes of the pairs that have been out of every state for gap seconds
+        for pair in [pair for pair, (_, last) in self.active.items() if t - last > self.gap]:
+            del self.active[pair]
+        self.events.extend(new_events)
+        return new_events
+
+    # Aggregates of the trial
+    def summary(self):
+        summary = {f'{who}_{kind}': 0 for who in ('player', 'crowd') for kind in kinds}
+        for _, kind, a, _, _, _ in self.events:
+            summary[f"{'player' if a == -1 else 'crowd'}_{kind}"] += 1
+        summary['player_min_distance'] = self.player_min_distance if math.isfinite(self.player_min_distance) else None
+        summary['player_min_ttc'] = self.player_min_ttc if math.isfinite(self.player_min_ttc) else None
+        summary['player_near_miss_seconds'] = self.player_near_miss_seconds
+        return summary
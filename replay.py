@@ -0,0 +1,217 @@
+import argparse
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+from trajectory_compression import decode_track, interpolate_track
+
+'''
+Session replay viewer.
+
+Plays back a session from the session store with the game's own renderer (road, markings, lights and
+crowd from main_moving_final.py). The trials of the session are laid end to end on one timeline, and
+their durations (trials table) form the time index: seeking finds the trial with a binary search and
+then only the chunk of samples, clicks and pedestrian tracks around the playhead is read, with the
+(trial_id, time) indexes. Decoded chunks are kept in a small LRU cache, so memory stays bounded
+however long the recording is.
+
+    python replay.py sessions.db --participant 63
+
+Controls:
+    space          play / pause
+    left / right   step one frame back / forward (pauses)
+    page up / down seek 10 seconds back / forward
+    up / down      double / halve the speed (0.25x to 32x)
+    click the bar  seek
+    escape         quit
+'''
+
+speeds = [0.25, 0.5, 1, 2, 4, 8, 16, 32]
+
+# Session replay class (the time index and the data near the playhead, independent of pygame)
+class SessionReplay:
+    def __init__(self, database, session_id, chunk_seconds = 10, cached_chunks = 6):
+        self.connection = sqlite3.connect(f'file:{database}?mode=ro', uri = True)
+        self.chunk_seconds = chunk_seconds
+        self.cached_chunks = cached_chunks
+        self.chunks = OrderedDict() # (trial id, chunk index) -> chunk, least recently used first
+        row = self.connection.execute('SELECT participant FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            self.connection.close()
+            raise ValueError(f'No session {session_id} in {database}')
+        self.participant = row[0]
+
+        # Time index: the start of each trial on the session timeline
+        self.trials = []
+        offset = 0
+        for trial_id, treatment, seconds in self.connection.execute(
+                'SELECT id, treatment, time FROM trials WHERE session_id = ? ORDER BY position', (session_id,)).fetchall():
+            if seconds is None: # unfinished trial, it lasts until its last sample
+                (seconds,) = self.connection.execute('SELECT MAX(time) FROM (SELECT MAX(time) AS time FROM samples WHERE trial_id = ? UNION ALL '
+                                                     'SELECT MAX(last_time) FROM tracks WHERE trial_id = ? AND pedestrian = -1)',
+                                                     (trial_id, trial_id)).fetchone()
+            self.trials.append({'id': trial_id, 'treatment': treatment, 'start': offset, 'duration': seconds or 0})
+            offset += seconds or 0
+        self.duration = offset
+        self.starts = np.array([trial['start'] for trial in self.trials])
+
+    # Trial playing at session time t and the time within it
+    def locate(self, t):
+        if not self.trials:
+            raise ValueError('The session has no recorded trials')
+        t = min(max(t, 0), self.duration)
+        trial = self.trials[max(0, int(np.searchsorted(self.starts, t, side = 'right')) - 1)]
+        return trial, t - trial['start']
+
+    # Samples, clicks and pedestrian tracks of a trial around one chunk (with a margin for interpolation)
+    def chunk(self, trial_id, index):
+        key = (trial_id, index)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+        margin = self.chunk_seconds / 2
+        start, end = index * self.chunk_seconds - margin, (index + 1) * self.chunk_seconds + margin
+        samples = np.array(self.connection.execute('SELECT time, x, y FROM samples WHERE trial_id = ? AND time BETWEEN ? AND ? ORDER BY time',
+                                                   (trial_id, start, end)).fetchall()).reshape(-1, 3)
+        # Or the player's compressed track (all of its kept points, a straight walk may keep only its ends)
+        player = self.connection.execute('SELECT data FROM tracks WHERE trial_id = ? AND pedestrian = -1', (trial_id,)).fetchone()
+        if player is not None:
+            times, positions = decode_track(player[0])
+            samples = np.column_stack([times, positions])
+        clicks = np.array(self.connection.execute('SELECT time, x, y FROM clicks WHERE trial_id = ? AND time BETWEEN ? AND ? ORDER BY time',
+                                                  (trial_id, start, end)).fetchall()).reshape(-1, 3)
+
+        # Compressed tracks overlapping the chunk, or the raw snapshots in it
+        tracks = {pedestrian: decode_track(data) for pedestrian, data in self.connection.execute(
+            'SELECT pedestrian, data FROM tracks WHERE trial_id = ? AND pedestrian >= 0 AND first_time <= ? AND last_time >= ?', (trial_id, end, start))}
+        rows = self.connection.execute('SELECT pedestrian, time, x, y FROM pedestrian_snapshots WHERE trial_id = ? AND time BETWEEN ? AND ? '
+                                       'ORDER BY pedestrian, time', (trial_id, start, end)).fetchall()
+        if rows:
+            rows = np.array(rows)
+            for pedestrian in np.unique(rows[:, 0]):
+                track = rows[rows[:, 0] == pedestrian]
+                tracks[int(pedestrian)] = (track[:, 1], track[:, 2:4])
+
+        self.chunks[key] = {'samples': samples, 'clicks': clicks, 'tracks': tracks}
+        if len(self.chunks) > self.cached_chunks:
+            self.chunks.popitem(last = False)
+        return self.chunks[key]
+
+    # State at session time t: trial, player position, pedestrian positions and the clicks of the last second
+    def state(self, t):
+        trial, local_t = self.locate(t)
+        chunk = self.chunk(trial['id'], int(local_t // self.chunk_seconds))
+
+        player = None
+        samples = chunk['samples']
+        if len(samples):
+            player = tuple(interpolate_track(samples[:, 0], samples[:, 1:3], [local_t])[0])
+
+        pedestrians = []
+        for times, positions in chunk['tracks'].values():
+            if times[0] <= local_t <= times[-1]:
+                pedestrians.append(tuple(interpolate_track(times, positions, [local_t])[0]))
+
+        clicks = chunk['clicks']
+        recent = clicks[(clicks[:, 0] <= local_t) & (clicks[:, 0] > local_t - 1)] if len(clicks) else clicks
+        return trial, local_t, player, pedestrians, [tuple(click[1:3]) for click in recent]
+
+# Latest session of a participant with at least one trial (every launch registers a session, even one left at the consent screen)
+def latest_session(database, participant):
+    with sqlite3.connect(f'file:{database}?mode=ro', uri = True) as connection:
+        row = connection.execute('SELECT MAX(id) FROM sessions WHERE participant = ? AND id IN (SELECT session_id FROM trials)', (participant,)).fetchone()
+    if row[0] is None:
+        raise ValueError(f'No session of participant {participant} with recorded trials in {database}')
+    return row[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay a recorded session')
+    parser.add_argument('database', nargs = '?', default = 'sessions.db')
+    group = parser.add_mutually_exclusive_group(required = True)
+    group.add_argument('--participant', type = int, help = "replay the participant's latest session")
+    group.add_argument('--session', type = int, help = 'session id')
+    parser.add_argument('--start', type = float, default = 0, help = 'start time (seconds into the session)')
+    parser.add_argument('--speed', type = float, default = 1, choices = speeds)
+    args = parser.parse_args()
+
+    try:
+        session_id = args.session if args.session is not None else latest_session(args.database, args.participant)
+        replay = SessionReplay(args.database, session_id)
+    except ValueError as error:
+        raise SystemExit(error)
+    if replay.duration == 0:
+        raise SystemExit(f'Session {session_id} has nothing to replay (no recorded trials)')
+
+    # The game module opens the window and provides the renderer
+    import pygame
+    import main_moving_final as game
+    pygame.display.set_caption(f'Replay of participant {replay.participant} (session {session_id})')
+    screen = game.screen
+    font = pygame.font.Font(None, round(26 * game.render_scale))
+    bar = pygame.Rect(20, game.height - 30, game.width - 40, 10) # in window units, like everything drawn through the game's helpers
+
+    playhead = min(max(args.start, 0), replay.duration)
+    speed = args.speed
+    playing = True
+    worlds = {} # trial id -> World (only the trial on screen is kept)
+    player_y = game.height - (game.pavement_height/2)
+
+    running = True
+    while running:
+        dt = game.frame_pacer.tick()
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                running = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                playing = not playing
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                playing = False
+                playhead += game.Timestep if event.key == pygame.K_RIGHT else -game.Timestep
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_PAGEUP, pygame.K_PAGEDOWN):
+                playhead += 10 if event.key == pygame.K_PAGEDOWN else -10
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_UP, pygame.K_DOWN):
+                index = speeds.index(speed) + (1 if event.key == pygame.K_UP else -1)
+                speed = speeds[min(max(index, 0), len(speeds) - 1)]
+            elif event.type == pygame.MOUSEBUTTONDOWN and bar.inflate(0, 20).collidepoint(game.pointer_position(event.pos)):
+                playhead = (game.pointer_position(event.pos)[0] - bar.x) / bar.width * replay.duration
+
+        if playing:
+            playhead += dt * speed
+            if playhead >= replay.duration:
+                playing = False
+        playhead = min(max(playhead, 0), replay.duration)
+
+        trial, local_t, player, pedestrians, clicks = replay.state(playhead)
+        if player is not None:
+            player_x, player_y = player
+        else:
+            player_x = game.player_x
+        spec = game.scenario_specs[trial['treatment']]
+        if trial['id'] not in worlds:
+            worlds = {trial['id']: game.World(spec['bright_side'], dynamic_lights = spec['dynamic_lights'], seed = replay.participant)}
+        world = worlds[trial['id']]
+
+        camera_offset_x = player_x - game.width/2
+        world.update(camera_offset_x)
+        world.update_lights(local_t, player_x)
+        game.draw_scenario(screen, world, spec['goal_x'], player_y, pedestrians, camera_offset_x)
+
+        # Clicks of the last second
+        for x, y in clicks:
+            pygame.draw.circle(screen, game.target_colour, game.scaled_point(x - camera_offset_x, y), 6 * game.render_scale, max(1, round(2 * game.render_scale)))
+
+        # Timeline with the trial boundaries, and the status line
+        pygame.draw.rect(screen, game.instruction_background_colour, game.scaled_rect(bar))
+        pygame.draw.rect(screen, game.instruction_text_colour, game.scaled_rect((bar.x, bar.y, bar.width * playhead / max(replay.duration, 1e-9), bar.height)))
+        for start in replay.starts[1:]:
+            x = bar.x + bar.width * start / max(replay.duration, 1e-9)
+            pygame.draw.line(screen, game.player_colour, game.scaled_point(x, bar.y - 4), game.scaled_point(x, bar.bottom + 4))
+        status = (f'Participant {replay.participant}   {trial["treatment"]} {local_t:6.2f} s   '
+                  f'session {playhead:7.2f} / {replay.duration:.2f} s   {speed}x   {"playing" if playing else "paused"}')
+        screen.blit(font.render(status, True, game.road_marking_colour), game.scaled_point(bar.x, bar.y - 26))
+
+        game.present()
+
+    pygame.quit()
@@ -0,0 +1,168 @@
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+'''
+Resampling statistics for the treatment and order effects.
+
+Every participant plays each treatment once, in one of the six counterbalanced orders, so an outcome
+(time, crossings or clicks) is a participants x treatments matrix. load_trials reads it from the
+session store (the latest completed session of each participant).
+
+Tests (the statistic is the between-group sum of squares of the group means, weighted by group size):
+    treatment - the outcomes of each participant are permuted across the treatments
+    position  - order within the session (1st, 2nd, 3rd trial): the treatment means are removed first,
+                then the residuals of each participant are permuted across the positions
+    sequence  - which of the orders was played: the order labels are permuted across participants,
+                compared on the participant means
+Bootstrap confidence intervals resample the participants with replacement (percentile intervals of the
+treatment means, the position means and the pairwise treatment differences).
+
+Resamples are drawn in chunks as whole index matrices (eg chunk_size x participants x treatments
+permutations from one argsort) and the chunks are spread over a process pool. Each chunk has its own
+seed spawned from the analysis seed, so the results depend on the seed and the chunk size, not on the
+number of workers.
+
+    python resampling_stats.py sessions.db --resamples 100000 --seed 1
+'''
+
+outcomes = ('time', 'crossings', 'clicks')
+
+# Load the outcomes of the latest completed session of every participant that played all the treatments
+def load_trials(database, treatments = ('H1', 'H2', 'H3')):
+    with sqlite3.connect(f'file:{database}?mode=ro', uri = True) as connection:
+        rows = connection.execute(
+            'SELECT trials.participant, sessions.treatment, trials.treatment, trials.position, trials.time, trials.crossings, trials.clicks '
+            'FROM trials JOIN sessions ON sessions.id = trials.session_id '
+            'WHERE sessions.id IN (SELECT MAX(id) FROM sessions WHERE completed = 1 GROUP BY participant) '
+            'ORDER BY trials.participant').fetchall()
+
+    sessions = {}
+    for participant, sequence, treatment, position, *values in rows:
+        if treatment in treatments and None not in values:
+            sessions.setdefault(participant, {'sequence': sequence, 'trials': {}})['trials'][treatment] = (position, values)
+    complete = [participant for participant, session in sessions.items() if len(session['trials']) == len(treatments)]
+
+    data = {'participants': np.array(complete, dtype = int),
+            'treatments': tuple(treatments),
+            'sequences': np.array([sessions[participant]['sequence'] for participant in complete]),
+            'positions': np.array([[sessions[participant]['trials'][treatment][0] for treatment in treatments] for participant in complete], dtype = int).reshape(-1, len(treatments))}
+    for k, outcome in enumerate(outcomes):
+        data[outcome] = np.array([[sessions[participant]['trials'][treatment][1][k] for treatment in treatments] for participant in complete], dtype = float).reshape(-1, len(treatments))
+    return data
+
+# Between-group sum of squares of group means (..., groups) with group sizes (groups,)
+def between_ss(means, sizes):
+    grand = (means * sizes).sum(axis = -1, keepdims = True) / sizes.sum()
+    return (sizes * (means - grand) ** 2).sum(axis = -1)
+
+# Reorder the columns of a (participants, treatments) matrix into the order the participant played them
+def by_position(matrix, positions):
+    ordered = np.empty_like(matrix)
+    np.put_along_axis(ordered, positions, matrix, axis = 1)
+    return ordered
+
+# Permutation chunk: the statistic for size permutations of each row of matrix across its columns
+def permute_within_chunk(matrix, seed, size):
+    rng = np.random.default_rng(seed)
+    index = np.argsort(rng.random((size, *matrix.shape)), axis = 2)
+    permuted = np.take_along_axis(np.broadcast_to(matrix, index.shape), index, axis = 2)
+    return between_ss(permuted.mean(axis = 1), np.full(matrix.shape[1], matrix.shape[0]))
+
+# Permutation chunk: the statistic for size permutations of the group labels across the values
+def permute_labels_chunk(values, labels, seed, size):
+    rng = np.random.default_rng(seed)
+    no_groups = labels.max() + 1
+    sizes = np.bincount(labels, minlength = no_groups)
+    permuted = labels[np.argsort(rng.random((size, len(labels))), axis = 1)]
+    one_hot = permuted[..., None] == np.arange(no_groups)
+    sums = np.einsum('bpg,p->bg', one_hot, values)
+    return between_ss(sums / np.maximum(sizes, 1), sizes)
+
+# Bootstrap chunk: column means of size resamples of the rows of matrix (with replacement)
+def bootstrap_chunk(matrix, seed, size):
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, len(matrix), size = (size, len(matrix)))
+    return matrix[index].mean(axis = 1)
+
+# Run n_resamples of a chunk function (called as function(*args, seed, size)) over a process pool
+# (workers 0 runs the chunks in this process, None uses every core)
+def resample(function, args, n_resamples, seed, chunk_size = 10000, workers = None):
+    sizes = [chunk_size] * (n_resamples // chunk_size) + ([n_resamples % chunk_size] if n_resamples % chunk_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 0 or len(sizes) == 1:
+        results = [function(*args, chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as pool:
+            results = list(pool.map(function, *zip(*[(*args, chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)])))
+    return np.concatenate(results)
+
+# Permutation p-value (the observed statistic counts as one of the resamples)
+def p_value(observed, resampled):
+    return (1 + np.count_nonzero(resampled >= observed - 1e-12 * abs(observed))) / (1 + len(resampled))
+
+# Treatment effect on an outcome
+def treatment_test(data, outcome, n_resamples = 10000, seed = 0, chunk_size = 10000, workers = None):
+    matrix = data[outcome]
+    observed = between_ss(matrix.mean(axis = 0), np.full(matrix.shape[1], len(matrix)))
+    resampled = resample(permute_within_chunk, (matrix,), n_resamples, seed, chunk_size, workers)
+    return {'statistic': observed, 'p_value': p_value(observed, resampled), 'means': dict(zip(data['treatments'], matrix.mean(axis = 0)))}
+
+# Position (1st, 2nd, 3rd trial) effect on an outcome, after removing the treatment means
+def position_test(data, outcome, n_resamples = 10000, seed = 0, chunk_size = 10000, workers = None):
+    matrix = data[outcome]
+    residuals = by_position(matrix - matrix.mean(axis = 0), data['positions'])
+    observed = between_ss(residuals.mean(axis = 0), np.full(residuals.shape[1], len(residuals)))
+    resampled = resample(permute_within_chunk, (residuals,), n_resamples, seed, chunk_size, workers)
+    return {'statistic': observed, 'p_value': p_value(observed, resampled), 'means': by_position(matrix, data['positions']).mean(axis = 0)}
+
+# Sequence (which counterbalanced order was played) effect on the participant means of an outcome
+def sequence_test(data, outcome, n_resamples = 10000, seed = 0, chunk_size = 10000, workers = None):
+    sequences, labels = np.unique(data['sequences'], return_inverse = True)
+    values = data[outcome].mean(axis = 1)
+    sizes = np.bincount(labels, minlength = len(sequences))
+    observed = between_ss(np.bincount(labels, values, len(sequences)) / np.maximum(sizes, 1), sizes)
+    resampled = resample(permute_labels_chunk, (values, labels), n_resamples, seed, chunk_size, workers)
+    return {'statistic': observed, 'p_value': p_value(observed, resampled),
+            'means': {sequence: values[labels == k].mean() for k, sequence in enumerate(sequences)}}
+
+# Percentile bootstrap intervals of the treatment means, the position means and the pairwise treatment differences
+def bootstrap_intervals(data, outcome, n_resamples = 10000, seed = 0, confidence = 0.95, chunk_size = 10000, workers = None):
+    treatments = data['treatments']
+    matrix = np.hstack([data[outcome], by_position(data[outcome], data['positions'])])
+    means = resample(bootstrap_chunk, (matrix,), n_resamples, seed, chunk_size, workers)
+    tails = [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100]
+
+    intervals = {}
+    for k, treatment in enumerate(treatments):
+        intervals[treatment] = (matrix[:, k].mean(), *np.percentile(means[:, k], tails))
+    for k in range(len(treatments)):
+        intervals[f'position {k + 1}'] = (matrix[:, len(treatments) + k].mean(), *np.percentile(means[:, len(treatments) + k], tails))
+    for a in range(len(treatments)):
+        for b in range(a + 1, len(treatments)):
+            difference = means[:, a] - means[:, b]
+            intervals[f'{treatments[a]} - {treatments[b]}'] = (matrix[:, a].mean() - matrix[:, b].mean(), *np.percentile(difference, tails))
+    return intervals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Permutation tests and bootstrap intervals for the treatment and order effects')
+    parser.add_argument('database', nargs = '?', default = 'sessions.db')
+    parser.add_argument('--outcomes', nargs = '+', default = list(outcomes), choices = outcomes)
+    parser.add_argument('--resamples', type = int, default = 100000)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--confidence', type = float, default = 0.95)
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (0 runs in this process, default every core)')
+    args = parser.parse_args()
+
+    data = load_trials(args.database)
+    print(f"{len(data['participants'])} participants, {len(np.unique(data['sequences']))} orders, {args.resamples} resamples, seed {args.seed}")
+    for outcome in args.outcomes:
+        print(f'\n{outcome}')
+        for name, test in (('treatment', treatment_test), ('position', position_test), ('sequence', sequence_test)):
+            result = test(data, outcome, args.resamples, args.seed, workers = args.workers)
+            print(f"  {name:10} SS {result['statistic']:12.4f}   p {result['p_value']:.5f}")
+        for name, (estimate, low, high) in bootstrap_intervals(data, outcome, args.resamples, args.seed, args.confidence, workers = args.workers).items():
+            print(f'  {name:10} {estimate:12.4f}   {args.confidence:.0%} CI [{low:.4f}, {high:.4f}]')
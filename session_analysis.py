@@ -0,0 +1,183 @@
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+'''
+Per-session metrics from the CSV files, with an incremental cache.
+
+The metrics of a participant's session are derived from the files save_data writes for it
+(extra_data_<p>.csv and the position, pedestrian and click CSVs of each treatment). Per treatment:
+    time, crossings, clicks   - as saved at the end of the trial
+    path_length, mean_speed   - of the player samples (px, px/s)
+    min_distance              - closest approach of any pedestrian to the player (crowded trials)
+    mean_nearest_distance     - mean distance from the player to the nearest pedestrian
+    close_fraction            - fraction of the samples with a pedestrian within close_distance px
+
+Parsing the position columns is most of the cost, so the results are cached in an SQLite file
+(analysis_cache.db) keyed by a SHA-256 of the session's files and by the metric code version, a hash
+of the source of the metric functions. A rerun only recomputes the sessions that are new or whose files
+changed; files with the same size and modification time as last time are not even rehashed. Editing a
+metric function changes the version, and the cached results of the old version are dropped when the
+cache is opened.
+
+    python session_analysis.py . --out metrics.csv
+'''
+
+close_distance = 50
+sample_interval = 0.5 # seconds between position samples (data_interval in the game)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    participant INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    code_version TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    metrics TEXT NOT NULL
+)
+'''
+
+# Files of a participant's session (those that exist)
+def session_files(directory, participant):
+    prefixes = ('extra_data_', 'position_data_', 'pedestrian_positions_', 'click_position_data_')
+    suffix = f'_{participant}.csv'
+    return sorted(os.path.join(directory, filename) for filename in os.listdir(directory)
+                  if filename.startswith(prefixes) and filename.endswith(suffix))
+
+# Participants with a saved session in a directory
+def saved_participants(directory):
+    return sorted(int(filename[len('extra_data_'):-len('.csv')]) for filename in os.listdir(directory)
+                  if filename.startswith('extra_data_') and filename[len('extra_data_'):-len('.csv')].isdigit())
+
+# Cheap check for unchanged files: names, sizes and modification times
+def fingerprint(files):
+    return json.dumps([(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in files])
+
+# SHA-256 of the names and contents of the files
+def content_hash(files):
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(os.path.basename(path).encode() + b'\0')
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+# Column of tuples (or lists of tuples) written by pandas as strings
+def parse_column(path):
+    import pandas as pd
+    column = pd.read_csv(path).iloc[:, 0]
+    return [ast.literal_eval(value) for value in column]
+
+# Metrics of the player path (N, 2) sampled every sample_interval seconds
+def path_metrics(player):
+    if len(player) < 2:
+        return {'path_length': 0.0, 'mean_speed': 0.0}
+    length = float(np.hypot(*np.diff(player, axis = 0).T).sum())
+    return {'path_length': length, 'mean_speed': length / ((len(player) - 1) * sample_interval)}
+
+# Distances from the player to the crowd at each sample (player (N, 2), pedestrians a list of N crowds)
+def proximity_metrics(player, pedestrians):
+    nearest = []
+    for position, crowd in zip(player, pedestrians):
+        if len(crowd):
+            nearest.append(np.hypot(*(np.asarray(crowd, dtype = float) - position).T).min())
+    if not nearest:
+        return {'min_distance': None, 'mean_nearest_distance': None, 'close_fraction': None}
+    nearest = np.array(nearest)
+    return {'min_distance': float(nearest.min()), 'mean_nearest_distance': float(nearest.mean()),
+            'close_fraction': float((nearest < close_distance).mean())}
+
+# Metrics of a participant's session
+def session_metrics(directory, participant):
+    import pandas as pd
+    extra = pd.read_csv(os.path.join(directory, f'extra_data_{participant}.csv')).iloc[0]
+    treatments = sorted(column[len('Crossed_road_'):] for column in extra.index if column.startswith('Crossed_road_'))
+    metrics = {'participant': participant, 'treatment_order': extra.get('Treatment')}
+    for name in treatments:
+        values = {'time': float(extra[f'{name}_time']), 'crossings': int(extra[f'Crossed_road_{name}']), 'clicks': int(extra[f'Clicks_{name}'])}
+        player = np.array(parse_column(os.path.join(directory, f'position_data_{name}_{participant}.csv')), dtype = float).reshape(-1, 2)
+        values.update(path_metrics(player))
+        pedestrian_file = os.path.join(directory, f'pedestrian_positions_{name}_{participant}.csv')
+        if os.path.exists(pedestrian_file):
+            values.update(proximity_metrics(player, parse_column(pedestrian_file)))
+        metrics.update({f'{name}_{key}': value for key, value in values.items()})
+    return metrics
+
+# Version of the metric code (changes whenever one of these functions is edited)
+metric_functions = (parse_column, path_metrics, proximity_metrics, session_metrics)
+code_version = hashlib.sha256(''.join(inspect.getsource(function) for function in metric_functions).encode()
+                              + repr((close_distance, sample_interval)).encode()).hexdigest()[:16]
+
+# Analysis cache class
+class AnalysisCache:
+    def __init__(self, path = 'analysis_cache.db'):
+        self.connection = sqlite3.connect(path, isolation_level = None)
+        self.connection.execute(schema)
+        evicted = self.connection.execute('DELETE FROM results WHERE code_version != ?', (code_version,)).rowcount
+        if evicted:
+            print(f'Metric code changed, dropped {evicted} cached sessions')
+
+    # Cached (content hash, fingerprint, metrics) of a participant
+    def get(self, participant):
+        row = self.connection.execute('SELECT content_hash, fingerprint, metrics FROM results WHERE participant = ?', (participant,)).fetchone()
+        return None if row is None else (row[0], row[1], json.loads(row[2]))
+
+    def put(self, participant, digest, files_fingerprint, metrics):
+        self.connection.execute('INSERT OR REPLACE INTO results (participant, content_hash, code_version, fingerprint, metrics) VALUES (?, ?, ?, ?, ?)',
+                                (participant, digest, code_version, files_fingerprint, json.dumps(metrics)))
+
+    def close(self):
+        self.connection.close()
+
+# Metrics of every saved session in a directory, recomputing only the new or changed ones
+# (workers 0 computes them in this process, None uses every core), returns (metrics, number recomputed)
+def analyse(directory = '.', cache_path = 'analysis_cache.db', workers = None):
+    cache = AnalysisCache(cache_path)
+    results = {}
+    stale = []
+    for participant in saved_participants(directory):
+        files = session_files(directory, participant)
+        files_fingerprint = fingerprint(files)
+        cached = cache.get(participant)
+        if cached is not None and cached[1] == files_fingerprint:
+            results[participant] = cached[2]
+            continue
+        digest = content_hash(files)
+        if cached is not None and cached[0] == digest:
+            cache.put(participant, digest, files_fingerprint, cached[2]) # touched but unchanged
+            results[participant] = cached[2]
+            continue
+        stale.append((participant, digest, files_fingerprint))
+
+    if workers == 0 or len(stale) <= 1:
+        computed = [session_metrics(directory, participant) for participant, _, _ in stale]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            computed = list(pool.map(session_metrics, [directory] * len(stale), [participant for participant, _, _ in stale]))
+    for (participant, digest, files_fingerprint), metrics in zip(stale, computed):
+        cache.put(participant, digest, files_fingerprint, metrics)
+        results[participant] = metrics
+    cache.close()
+    return [results[participant] for participant in sorted(results)], len(stale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Per-session metrics from the saved CSV files (cached)')
+    parser.add_argument('directory', nargs = '?', default = '.')
+    parser.add_argument('--cache', default = 'analysis_cache.db')
+    parser.add_argument('--out', default = 'session_metrics.csv')
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes for the recomputed sessions (0 runs in this process)')
+    args = parser.parse_args()
+
+    import pandas as pd
+    start = time.perf_counter()
+    metrics, recomputed = analyse(args.directory, args.cache, args.workers)
+    pd.DataFrame(metrics).to_csv(args.out, index = False)
+    print(f'{len(metrics)} sessions ({recomputed} recomputed, {len(metrics) - recomputed} cached) in {time.perf_counter() - start:.2f} s, written to {args.out}')
@@ -0,0 +1,314 @@
+import argparse
+import itertools
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+
+'''
+SQLite session store.
+
+Every session is written to one database next to the CSV files, so cohort questions are single SQL
+statements instead of loops over hundreds of files, eg all H2 trials with more than one crossing:
+    SELECT participant, crossings, time FROM trials WHERE treatment = 'H2' AND crossings > 1
+
+Tables:
+    sessions             - one row per session (participant, scenario order, frame and start-up stats)
+    trials               - one row per scenario played (time taken, roads crossed, clicks)
+    samples              - player positions, every data_interval (without a track_resolution)
+    clicks               - click targets
+    pedestrian_snapshots - pedestrian positions, every data_interval (one row per pedestrian)
+    tracks               - paths compressed by trajectory_compression.py, one row per pedestrian and one for the
+                           player (pedestrian -1, simplified with its own player_track_tolerance), used instead
+                           of pedestrian_snapshots and samples when the store is given a track_resolution
+    proximity_events     - contacts, near misses and short times to collision (see proximity_events.py), between
+                           a pedestrian and the player (agent_a -1) or between two pedestrians
+    session_log          - messages of a session's monitors (eg the memory reports and warnings), time in Unix seconds
+Times in samples, clicks and pedestrian_snapshots are seconds since the start of the trial. The sample
+tables repeat the participant and treatment of their trial so they can be indexed on (participant,
+treatment, time) and (treatment, time) as well as (trial_id, time), which replay.py uses to seek.
+
+The database runs in WAL mode, so several kiosks on one machine can write to it while it is read.
+Rows are buffered and written with executemany in one transaction per batch. Pedestrians are identified
+by the id they were given when they spawned, which stays the same while others leave the crowd.
+
+Query the store from the command line:
+    python session_store.py sessions.db "SELECT treatment, AVG(time) FROM trials GROUP BY treatment"
+'''
+
+schema = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    participant INTEGER NOT NULL,
+    started REAL NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    treatment TEXT,
+    crowd_layout INTEGER,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    crowd_layout INTEGER,
+    time REAL,
+    crossings INTEGER,
+    clicks INTEGER
+);
+CREATE TABLE IF NOT EXISTS samples (
+    trial_id INTEGER NOT NULL REFERENCES trials (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    time REAL NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clicks (
+    trial_id INTEGER NOT NULL REFERENCES trials (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    time REAL NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pedestrian_snapshots (
+    trial_id INTEGER NOT NULL REFERENCES trials (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    time REAL NOT NULL,
+    pedestrian INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    trial_id INTEGER NOT NULL REFERENCES trials (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    pedestrian INTEGER NOT NULL,
+    first_time REAL NOT NULL,
+    last_time REAL NOT NULL,
+    points INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS proximity_events (
+    trial_id INTEGER NOT NULL REFERENCES trials (id),
+    participant INTEGER NOT NULL,
+    treatment TEXT NOT NULL,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    agent_a INTEGER NOT NULL,
+    agent_b INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    ttc REAL
+);
+CREATE TABLE IF NOT EXISTS session_log (
+    session_id INTEGER NOT NULL REFERENCES sessions (id),
+    time REAL NOT NULL,
+    source TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_participant ON sessions (participant);
+CREATE INDEX IF NOT EXISTS trials_participant ON trials (participant, treatment);
+CREATE INDEX IF NOT EXISTS trials_treatment ON trials (treatment, crossings);
+CREATE INDEX IF NOT EXISTS samples_trial ON samples (trial_id, time);
+CREATE INDEX IF NOT EXISTS samples_participant ON samples (participant, treatment, time);
+CREATE INDEX IF NOT EXISTS samples_treatment ON samples (treatment, time);
+CREATE INDEX IF NOT EXISTS clicks_trial ON clicks (trial_id, time);
+CREATE INDEX IF NOT EXISTS clicks_participant ON clicks (participant, treatment, time);
+CREATE INDEX IF NOT EXISTS clicks_treatment ON clicks (treatment, time);
+CREATE INDEX IF NOT EXISTS pedestrian_snapshots_trial ON pedestrian_snapshots (trial_id, time);
+CREATE INDEX IF NOT EXISTS pedestrian_snapshots_participant ON pedestrian_snapshots (participant, treatment, time);
+CREATE INDEX IF NOT EXISTS pedestrian_snapshots_treatment ON pedestrian_snapshots (treatment, time);
+CREATE INDEX IF NOT EXISTS tracks_trial ON tracks (trial_id, first_time, last_time);
+CREATE INDEX IF NOT EXISTS tracks_participant ON tracks (participant, treatment);
+CREATE INDEX IF NOT EXISTS tracks_treatment ON tracks (treatment);
+CREATE INDEX IF NOT EXISTS proximity_events_trial ON proximity_events (trial_id, time);
+CREATE INDEX IF NOT EXISTS proximity_events_treatment ON proximity_events (treatment, kind);
+CREATE INDEX IF NOT EXISTS session_log_session ON session_log (session_id, time);
+'''
+
+# Columns of the buffered tables
+row_columns = {'samples': ('trial_id', 'participant', 'treatment', 'time', 'x', 'y'),
+               'clicks': ('trial_id', 'participant', 'treatment', 'time', 'x', 'y'),
+               'pedestrian_snapshots': ('trial_id', 'participant', 'treatment', 'time', 'pedestrian', 'x', 'y'),
+               'tracks': ('trial_id', 'participant', 'treatment', 'pedestrian', 'first_time', 'last_time', 'points', 'data'),
+               'proximity_events': ('trial_id', 'participant', 'treatment', 'time', 'kind', 'agent_a', 'agent_b', 'distance', 'ttc'),
+               'session_log': ('session_id', 'time', 'source', 'message')}
+
+# Session store class
+class SessionStore:
+    # With a track_resolution (pixels) the pedestrian and player paths are compressed into tracks, simplified with
+    # track_tolerance and player_track_tolerance
+    def __init__(self, path, batch_size = 500, timeout = 30, track_resolution = None, track_tolerance = None, player_track_tolerance = None):
+        # Transactions are explicit, timeout is how long a writer waits for another kiosk's transaction
+        self.connection = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        with self.transaction():
+            for statement in schema.split(';'):
+                if statement.strip():
+                    self.connection.execute(statement)
+        self.batch_size = batch_size
+        self.pending = {table: [] for table in row_columns}
+        self.no_pending = 0
+        self.trials = {} # trial id -> (participant, treatment)
+        self.track_resolution = track_resolution
+        self.track_tolerance = track_tolerance
+        self.player_track_tolerance = player_track_tolerance
+        self.tracks = {} # trial id -> {pedestrian id (-1 for the player): ([times], [positions])}, until the trial ends
+
+    # Write transaction (BEGIN IMMEDIATE takes the write lock up front, so concurrent kiosks queue here)
+    @contextmanager
+    def transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    # Register a session and return (session id, participant number). With reserve the number is raised
+    # above every stored participant, in the same transaction as the insert, so two kiosks never share one
+    def new_session(self, participant, reserve = False):
+        with self.transaction() as connection:
+            if reserve:
+                (highest,) = connection.execute('SELECT MAX(participant) FROM sessions').fetchone()
+                if highest is not None:
+                    participant = max(participant, highest + 1)
+            cursor = connection.execute('INSERT INTO sessions (participant, started) VALUES (?, ?)', (participant, time.time()))
+        return cursor.lastrowid, participant
+
+    # Mark a session as complete
+    def end_session(self, session_id, treatment, crowd_layout, stats):
+        self.flush()
+        with self.transaction() as connection:
+            connection.execute('UPDATE sessions SET completed = 1, treatment = ?, crowd_layout = ?, stats = ? WHERE id = ?',
+                               (','.join(treatment), crowd_layout, json.dumps(stats), session_id))
+
+    # Register a trial (one scenario of a session) and return its id
+    def new_trial(self, session_id, participant, treatment, position, crowd_layout):
+        with self.transaction() as connection:
+            cursor = connection.execute('INSERT INTO trials (session_id, participant, treatment, position, crowd_layout) VALUES (?, ?, ?, ?, ?)',
+                                        (session_id, participant, treatment, position, crowd_layout))
+        self.trials[cursor.lastrowid] = (participant, treatment)
+        return cursor.lastrowid
+
+    # Record the results of a trial and write its buffered rows
+    def end_trial(self, trial_id, seconds, crossings, clicks):
+        self.compress_tracks(trial_id)
+        self.flush()
+        with self.transaction() as connection:
+            connection.execute('UPDATE trials SET time = ?, crossings = ?, clicks = ? WHERE id = ?', (seconds, crossings, clicks, trial_id))
+
+    def add_sample(self, trial_id, seconds, x, y):
+        if self.track_resolution is not None:
+            times, positions = self.tracks.setdefault(trial_id, {}).setdefault(-1, ([], []))
+            times.append(seconds)
+            positions.append((x, y))
+            return
+        self.buffer('samples', (trial_id, *self.trials[trial_id], seconds, x, y))
+
+    def add_click(self, trial_id, seconds, x, y):
+        self.buffer('clicks', (trial_id, *self.trials[trial_id], seconds, x, y))
+
+    # Record a proximity event (agent_a is -1 for the player, ttc None if the pair was not closing)
+    def add_event(self, trial_id, seconds, kind, agent_a, agent_b, distance, ttc):
+        self.buffer('proximity_events', (trial_id, *self.trials[trial_id], seconds, kind, agent_a, agent_b, distance, ttc))
+
+    # Record a message of a session (source names what sent it, eg 'memory')
+    def add_log(self, session_id, source, message):
+        self.buffer('session_log', (session_id, time.time(), source, message))
+
+    # Record the positions (x, y) of every pedestrian, given with their ids, at one time
+    def add_pedestrians(self, trial_id, seconds, ids, positions):
+        if self.track_resolution is not None:
+            tracks = self.tracks.setdefault(trial_id, {})
+            for pedestrian, position in zip(ids, positions):
+                times, track_positions = tracks.setdefault(pedestrian, ([], []))
+                times.append(seconds)
+                track_positions.append(position)
+            return
+        participant, treatment = self.trials[trial_id]
+        self.pending['pedestrian_snapshots'].extend((trial_id, participant, treatment, seconds, pedestrian, x, y) 
+                                                    for pedestrian, (x, y) in zip(ids, positions))
+        self.no_pending += len(positions)
+        if self.no_pending >= self.batch_size:
+            self.flush()
+
+    # Compress the pedestrian paths of a trial into the tracks table
+    def compress_tracks(self, trial_id):
+        if trial_id not in self.tracks:
+            return
+        from trajectory_compression import encode_track
+        participant, treatment = self.trials[trial_id]
+        for pedestrian, (times, positions) in self.tracks.pop(trial_id).items():
+            tolerance = self.player_track_tolerance if pedestrian == -1 else self.track_tolerance
+            data = encode_track(times, positions, self.track_resolution, tolerance = tolerance)
+            self.pending['tracks'].append((trial_id, participant, treatment, pedestrian, times[0], times[-1], len(times), data))
+            self.no_pending += 1
+
+    # Pedestrian paths of a trial, {pedestrian id: (times, (N, 2) positions)}, from tracks or pedestrian_snapshots
+    def pedestrian_tracks(self, trial_id):
+        import numpy as np
+        from trajectory_compression import decode_track
+        tracks = {pedestrian: decode_track(data) for pedestrian, data in 
+                  self.query('SELECT pedestrian, data FROM tracks WHERE trial_id = ? AND pedestrian >= 0', (trial_id,))}
+        rows = self.query('SELECT pedestrian, time, x, y FROM pedestrian_snapshots WHERE trial_id = ? ORDER BY pedestrian, time', (trial_id,))
+        for pedestrian, group in itertools.groupby(rows, key = lambda row: row[0]):
+            track = np.array([row[1:] for row in group])
+            tracks[pedestrian] = (track[:, 0], track[:, 1:])
+        return tracks
+
+    # Player path of a trial, (times, (N, 2) positions), from its track or the samples
+    def player_track(self, trial_id):
+        import numpy as np
+        from trajectory_compression import decode_track
+        rows = self.query('SELECT data FROM tracks WHERE trial_id = ? AND pedestrian = -1', (trial_id,))
+        if rows:
+            return decode_track(rows[0][0])
+        track = np.array(self.query('SELECT time, x, y FROM samples WHERE trial_id = ? ORDER BY time', (trial_id,))).reshape(-1, 3)
+        return track[:, 0], track[:, 1:]
+
+    def buffer(self, table, row):
+        self.pending[table].append(row)
+        self.no_pending += 1
+        if self.no_pending >= self.batch_size:
+            self.flush()
+
+    # Write the buffered rows in one transaction
+    def flush(self):
+        if self.no_pending == 0:
+            return
+        with self.transaction() as connection:
+            for table, rows in self.pending.items():
+                if rows:
+                    columns = row_columns[table]
+                    connection.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+        self.pending = {table: [] for table in row_columns}
+        self.no_pending = 0
+
+    # Read-only query
+    def query(self, sql, parameters = ()):
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        for trial_id in list(self.tracks):
+            self.compress_tracks(trial_id)
+        self.flush()
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Query the session store')
+    parser.add_argument('database')
+    parser.add_argument('sql')
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f'file:{args.database}?mode=ro', uri = True)
+    cursor = connection.execute(args.sql)
+    print('\t'.join(column[0] for column in cursor.description))
+    for row in cursor:
+        print('\t'.join(str(value) for value in row))
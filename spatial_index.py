@@ -0,0 +1,187 @@
+import argparse
+import sqlite3
+from contextlib import contextmanager
+import numpy as np
+from trajectory_compression import decode_track, interpolate_track
+
+'''
+Spatial index of every recorded position.
+
+The index is its own SQLite database next to the session store, holding an R*Tree (SQLite's rtree
+module) over all player samples and pedestrian positions of the finished trials, each tagged with its
+trial, participant, treatment, agent ('player' or 'pedestrian'), pedestrian id and time. Box queries
+descend the tree, so they take logarithmic time in the number of points plus the number of matches;
+radius queries are box queries filtered on the exact distance, and nearest queries grow a box around
+the point until it holds enough points or covers the extent of every indexed point (kept in the extent
+table by update(), so a query never scans the points).
+
+update() indexes the trials that have finished since the last update, so new sessions are added
+without rebuilding (the trials already indexed are listed in indexed_trials). Compressed tracks (the
+pedestrians', and the player's as pedestrian -1) are resampled every track_interval seconds, like the
+samples they were made from.
+
+    python spatial_index.py update sessions.db
+    python spatial_index.py radius 1125 630 50 --treatment H2 --agent player
+    python spatial_index.py nearest 1200 700 --k 5
+'''
+
+schema = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS points USING rtree (
+    id, min_x, max_x, min_y, max_y,
+    +trial_id INTEGER, +participant INTEGER, +treatment TEXT, +agent TEXT, +pedestrian INTEGER, +time REAL, +x REAL, +y REAL
+);
+CREATE TABLE IF NOT EXISTS indexed_trials (
+    trial_id INTEGER PRIMARY KEY,
+    points INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extent (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    min_x REAL NOT NULL,
+    max_x REAL NOT NULL,
+    min_y REAL NOT NULL,
+    max_y REAL NOT NULL
+);
+'''
+
+# Columns of the rows returned by the queries
+columns = ('participant', 'treatment', 'trial_id', 'agent', 'pedestrian', 'time', 'x', 'y')
+
+# Spatial index class
+class SpatialIndex:
+    def __init__(self, path = 'spatial_index.db', track_interval = 0.5):
+        self.connection = sqlite3.connect(path, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        with self.transaction():
+            for statement in schema.split(';'):
+                if statement.strip():
+                    self.connection.execute(statement)
+            # Indexes built before the extent table was added
+            if self.connection.execute('SELECT COUNT(*) FROM extent').fetchone()[0] == 0:
+                self.connection.execute('INSERT INTO extent SELECT 0, MIN(min_x), MAX(max_x), MIN(min_y), MAX(max_y) FROM points '
+                                        'HAVING COUNT(*) > 0')
+        self.track_interval = track_interval
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    # Index the trials of a session store that have finished since the last update, returns the number of points added
+    def update(self, store_path):
+        store = sqlite3.connect(f'file:{store_path}?mode=ro', uri = True)
+        indexed = {row[0] for row in self.connection.execute('SELECT trial_id FROM indexed_trials')}
+        trials = [row for row in store.execute('SELECT id, participant, treatment FROM trials WHERE time IS NOT NULL ORDER BY id')
+                  if row[0] not in indexed]
+
+        added = 0
+        for trial_id, participant, treatment in trials:
+            tag = (trial_id, participant, treatment)
+            rows = [(*tag, 'player', -1, t, x, y) for t, x, y in store.execute('SELECT time, x, y FROM samples WHERE trial_id = ?', (trial_id,))]
+            rows += [(*tag, 'pedestrian', pedestrian, t, x, y) for pedestrian, t, x, y in
+                     store.execute('SELECT pedestrian, time, x, y FROM pedestrian_snapshots WHERE trial_id = ?', (trial_id,))]
+            for pedestrian, first_time, last_time, data in store.execute('SELECT pedestrian, first_time, last_time, data FROM tracks WHERE trial_id = ?', (trial_id,)):
+                times = np.append(np.arange(first_time, last_time, self.track_interval), last_time)
+                positions = interpolate_track(*decode_track(data), times)
+                agent = 'player' if pedestrian == -1 else 'pedestrian'
+                rows += [(*tag, agent, pedestrian, t, x, y) for t, (x, y) in zip(times.tolist(), positions.tolist())]
+
+            # One transaction per trial, so an interrupted update resumes from the next trial
+            with self.transaction() as connection:
+                connection.executemany('INSERT INTO points (min_x, max_x, min_y, max_y, trial_id, participant, treatment, agent, pedestrian, time, x, y) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                       [(x, x, y, y, trial_id, participant, treatment, agent, pedestrian, t, x, y)
+                                        for trial_id, participant, treatment, agent, pedestrian, t, x, y in rows])
+                connection.execute('INSERT INTO indexed_trials (trial_id, points) VALUES (?, ?)', (trial_id, len(rows)))
+                if rows:
+                    xs = [row[6] for row in rows]
+                    ys = [row[7] for row in rows]
+                    connection.execute('INSERT INTO extent VALUES (0, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                                       'min_x = MIN(min_x, excluded.min_x), max_x = MAX(max_x, excluded.max_x), '
+                                       'min_y = MIN(min_y, excluded.min_y), max_y = MAX(max_y, excluded.max_y)',
+                                       (min(xs), max(xs), min(ys), max(ys)))
+            added += len(rows)
+        store.close()
+        return added
+
+    # Filters on the tags (None matches everything)
+    def conditions(self, treatment, agent, participant):
+        sql, parameters = '', []
+        for column, value in (('treatment', treatment), ('agent', agent), ('participant', participant)):
+            if value is not None:
+                sql += f' AND {column} = ?'
+                parameters.append(value)
+        return sql, parameters
+
+    # Points with x_min <= x <= x_max and y_min <= y <= y_max (the tree stores float32 boxes rounded outward, so it is
+    # searched for overlapping boxes and the exact coordinates are filtered afterwards)
+    def box(self, x_min, x_max, y_min, y_max, treatment = None, agent = None, participant = None):
+        sql, parameters = self.conditions(treatment, agent, participant)
+        return self.connection.execute(f'SELECT {", ".join(columns)} FROM points WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?'
+                                       f' AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?{sql}',
+                                       (x_min, x_max, y_min, y_max, x_min, x_max, y_min, y_max, *parameters)).fetchall()
+
+    # Points within radius of (x, y)
+    def radius(self, x, y, radius, treatment = None, agent = None, participant = None):
+        return [row for row in self.box(x - radius, x + radius, y - radius, y + radius, treatment, agent, participant)
+                if (row[6] - x)**2 + (row[7] - y)**2 <= radius**2]
+
+    # The k points nearest to (x, y), closest first (fewer if fewer match the filters)
+    def nearest(self, x, y, k = 1, treatment = None, agent = None, participant = None, start_radius = 16):
+        extent = self.connection.execute('SELECT min_x, max_x, min_y, max_y FROM extent').fetchone()
+        if extent is None:
+            return []
+        x_min, x_max, y_min, y_max = extent
+        largest = max(abs(x - x_min), abs(x - x_max), abs(y - y_min), abs(y - y_max)) * 2**0.5 + 1
+
+        # Grow the radius until k points lie within it (the points in the box but outside the circle may not be the nearest),
+        # or until it covers every indexed point
+        radius = start_radius
+        while True:
+            rows = self.radius(x, y, radius, treatment, agent, participant)
+            if len(rows) >= k or radius >= largest:
+                break
+            radius *= 2
+        return sorted(rows, key = lambda row: (row[6] - x)**2 + (row[7] - y)**2)[:k]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Spatial index of the recorded positions')
+    parser.add_argument('--index', default = 'spatial_index.db')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    update = commands.add_parser('update', help = 'index the trials finished since the last update')
+    update.add_argument('store', nargs = '?', default = 'sessions.db')
+    for name, arguments in (('box', ('x_min', 'x_max', 'y_min', 'y_max')), ('radius', ('x', 'y', 'radius')), ('nearest', ('x', 'y'))):
+        command = commands.add_parser(name)
+        for argument in arguments:
+            command.add_argument(argument, type = float)
+        command.add_argument('--treatment')
+        command.add_argument('--agent', choices = ('player', 'pedestrian'))
+        command.add_argument('--participant', type = int)
+        if name == 'nearest':
+            command.add_argument('--k', type = int, default = 1)
+    args = parser.parse_args()
+
+    index = SpatialIndex(args.index)
+    if args.command == 'update':
+        print(f'Indexed {index.update(args.store)} new points')
+    else:
+        filters = {'treatment': args.treatment, 'agent': args.agent, 'participant': args.participant}
+        if args.command == 'box':
+            rows = index.box(args.x_min, args.x_max, args.y_min, args.y_max, **filters)
+        elif args.command == 'radius':
+            rows = index.radius(args.x, args.y, args.radius, **filters)
+        else:
+            rows = index.nearest(args.x, args.y, args.k, **filters)
+        print('\t'.join(columns))
+        for row in rows:
+            print('\t'.join(str(value) for value in row))
+        print(f'{len(rows)} points, participants {sorted({row[0] for row in rows})}')
+    index.close()
@@ -0,0 +1,58 @@
+import time
+from contextlib import contextmanager
+
+'''
+Start-up timing report.
+
+Phases are either marked in sequence (mark ends the phase that started at the previous mark) or timed
+with the phase context manager, which also works for assets built in the background. Each phase is
+compared against its budget (seconds) so regressions show up in the report and in the session data.
+'''
+
+# Import this module first, the imports phase is measured from here
+process_start = time.perf_counter()
+
+# Start-up timer class
+class StartupTimer:
+    def __init__(self, budget, start = None):
+        self.budget = budget
+        self.start = process_start if start is None else start
+        self.last_mark = self.start
+        self.phases = {} # phase name -> seconds
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    # End the phase that started at the previous mark
+    def mark(self, name):
+        now = time.perf_counter()
+        self.add(name, now - self.last_mark)
+        self.last_mark = now
+
+    # Time a block of code (eg an asset built in the background thread)
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    # Phases which went over their budget
+    def over_budget(self):
+        return [name for name, seconds in self.phases.items() if name in self.budget and seconds > self.budget[name]]
+
+    def report(self):
+        lines = ['Start-up timing:']
+        for name, seconds in self.phases.items():
+            budget = self.budget.get(name)
+            if budget is None:
+                lines.append(f'    {name:<18} {seconds*1000:8.1f} ms')
+            else:
+                status = 'OVER BUDGET' if seconds > budget else 'ok'
+                lines.append(f'    {name:<18} {seconds*1000:8.1f} ms  (budget {budget*1000:.0f} ms, {status})')
+        return '\n'.join(lines)
+
+    # Phase times for the session data
+    def stats(self):
+        return {f'Startup_{name}_ms': seconds * 1000 for name, seconds in self.phases.items()}
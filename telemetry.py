@@ -0,0 +1,155 @@
+import math
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+'''
+Live telemetry ring.
+
+The game publishes compact binary records into a shared-memory ring buffer, so an observer process
+(observer.py) can follow a session without touching the participant's window. Publishing is a
+struct.pack_into into the ring and never waits for the observer: when nobody reads, or the reader
+falls more than a ring behind, old records are simply overwritten.
+
+Layout: a 64 byte header (magic, version, slot size, number of slots, number of records written, pid
+of the game) followed by fixed-size slots. Record n is in slot n % no_slots and the write count is
+updated after the record, so a reader knows which slots are complete. With count records written the
+writer may be filling the slot of record count - no_slots, so a reader only trusts the records after
+it, and checks the count again after reading to drop the records that were overwritten meanwhile.
+
+A second game on the same machine does not take over a ring whose game is still running: the
+publisher raises FileExistsError and the game runs without telemetry (give each kiosk its own
+telemetry_name to watch them all). A ring left behind by a game that did not shut down is replaced.
+
+Records (times are time.perf_counter() of the game, which the observer shares on one machine):
+    frame   - frame time, player position and velocity, treatment ('--' outside the scenarios),
+              scenario number, crowd size, mean crowd speed and distance to the nearest pedestrian (read off
+              Crowd.proximity, the velocities and player distances of the crowd's last step)
+    click   - click target in window units
+    session - participant number and treatment order
+'''
+
+magic = b'TELE'
+version = 2
+header_format = '<4sHHIQI'
+header_size = 64
+count_offset = struct.calcsize('<4sHHI')
+pid_offset = struct.calcsize('<4sHHIQ')
+slot_size = 64
+record_types = {'frame': (1, '<Bdfffff2sBHff', ('time', 'frame_ms', 'x', 'y', 'velocity_x', 'velocity_y', 'treatment', 'scenario',
+                                                 'crowd', 'crowd_speed', 'nearest')),
+                'click': (2, '<Bdff', ('time', 'x', 'y')),
+                'session': (3, '<BdI6s', ('time', 'participant', 'treatment'))}
+record_kinds = {code: (kind, record_format, fields) for kind, (code, record_format, fields) in record_types.items()}
+
+# Attach to an existing ring without taking ownership of it
+def attach(name):
+    block = shared_memory.SharedMemory(name = name)
+    # Only the game unlinks the ring (the resource tracker would unlink it when a reader exits on POSIX)
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+# Whether the game process that created a ring is still running
+def process_alive(pid):
+    if pid == 0:
+        return False
+    if os.name != 'posix':
+        return True # on Windows the mapping only exists while a process holds it open
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Telemetry publisher class (owns the ring)
+class TelemetryPublisher:
+    def __init__(self, name, no_slots = 4096):
+        try:
+            self.block = shared_memory.SharedMemory(name = name, create = True, size = header_size + no_slots * slot_size)
+        except FileExistsError:
+            existing = attach(name)
+            pid = struct.unpack_from('<I', existing.buf, pid_offset)[0] if len(existing.buf) >= header_size else 0
+            if process_alive(pid):
+                existing.close()
+                raise FileExistsError(f'Telemetry ring {name} is in use by process {pid}')
+            # Left behind by a session that did not shut down, replace it
+            existing.close()
+            existing.unlink()
+            self.block = shared_memory.SharedMemory(name = name, create = True, size = header_size + no_slots * slot_size)
+        self.no_slots = no_slots
+        self.count = 0
+        struct.pack_into(header_format, self.block.buf, 0, magic, version, slot_size, no_slots, 0, os.getpid())
+
+    def publish(self, kind, *values):
+        code, record_format, fields = record_types[kind]
+        struct.pack_into(record_format, self.block.buf, header_size + (self.count % self.no_slots) * slot_size, code, *values)
+        self.count += 1
+        struct.pack_into('<Q', self.block.buf, count_offset, self.count)
+
+    # proximity is the (N, 9) array of Crowd.step (None without a crowd), the crowd summary is read off its velocities and
+    # distances to the player with array operations, so publishing stays cheap however large the crowd
+    def frame(self, frame_time, player, velocity, treatment, scenario, proximity = None):
+        crowd, crowd_speed, nearest = 0, 0, -1
+        if proximity is not None and len(proximity):
+            crowd = len(proximity)
+            crowd_speed = float(((proximity[:, 3:5]**2).sum(axis = 1)**0.5).mean())
+            nearest = float(proximity[:, 7].min())
+            if not math.isfinite(nearest):
+                nearest = -1
+        self.publish('frame', time.perf_counter(), frame_time * 1000, player[0], player[1], velocity[0], velocity[1],
+                     (treatment or '--').encode(), scenario, crowd, crowd_speed, nearest)
+
+    def click(self, x, y):
+        self.publish('click', time.perf_counter(), x, y)
+
+    def session(self, participant, treatment):
+        self.publish('session', time.perf_counter(), participant, ''.join(treatment).encode())
+
+    def close(self):
+        self.block.close()
+        self.block.unlink()
+
+# Telemetry reader class (used by the observer process)
+class TelemetryReader:
+    def __init__(self, name):
+        self.block = attach(name)
+        header = struct.unpack_from(header_format, self.block.buf, 0)
+        if header[0] != magic or header[1] != version:
+            raise ValueError(f'{name} is not a version {version} telemetry ring')
+        self.no_slots = header[3]
+        self.next = 0 # next record to read
+        self.dropped = 0
+
+    def written(self):
+        return struct.unpack_from('<Q', self.block.buf, count_offset)[0]
+
+    # Records written since the last poll, as (kind, {field: value})
+    def poll(self):
+        count = self.written()
+        if count < self.next: # the game restarted the ring
+            self.next = 0
+        if count - self.next >= self.no_slots: # the oldest slot may be being rewritten
+            self.dropped += count - self.no_slots + 1 - self.next
+            self.next = count - self.no_slots + 1
+
+        records = []
+        for n in range(self.next, count):
+            offset = header_size + (n % self.no_slots) * slot_size
+            kind, record_format, fields = record_kinds[self.block.buf[offset]]
+            values = struct.unpack_from(record_format, self.block.buf, offset)[1:]
+            records.append((n, kind, dict(zip(fields, values))))
+
+        # Drop the records overwritten while they were read
+        first_valid = self.written() - self.no_slots + 1
+        kept = [(kind, record) for n, kind, record in records if n >= first_valid]
+        self.dropped += len(records) - len(kept)
+        self.next = count
+        return kept
+
+    def close(self):
+        self.block.close()
@@ -0,0 +1,54 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import main_moving_final as game
+from crowd_layouts import generate_layout
+from crowd_warmup import crowd_metrics, warm_up
+
+# Crowd of a generated H2 layout, and the player's start position
+def layout_crowd(seed = 0):
+    crowd = game.Crowd(game.scenario_specs['H2']['crowd'])
+    for x, y, target_x, target_y in generate_layout(seed, game.crowd_layout_spec('H2')).tolist():
+        crowd.spawn(x, y, (target_x, target_y))
+    return crowd, (game.player_x, game.height - (game.pavement_height/2))
+
+# Mean speed and spacing of the crowd's next steps
+def step_metrics(crowd, step, no_steps):
+    metrics = []
+    for _ in range(no_steps):
+        step()
+        metrics.append(crowd_metrics(crowd))
+    return np.mean(metrics, axis = 0)
+
+# The scalar warm-up settles the crowd, and the scenario's scalar steps carry on from that steady state
+def test_scalar_warm_up_converges_to_the_scalar_steady_state():
+    crowd, start = layout_crowd()
+    step = lambda: crowd.step(None, start)
+    tolerance = 0.02
+    stats = warm_up(crowd, step, game.Timestep, max_time = 10, tolerance = tolerance)
+    assert stats['converged'] and stats['seconds'] < 10
+    assert stats['mean_speed'] > 0 and stats['mean_spacing'] > 2 * game.player_radius
+
+    # Every pedestrian starts the trial moving
+    assert len(crowd) == game.no_pedestrians
+    assert np.hypot(*np.reshape(crowd.velocities, (-1, 2)).T).min() > 0
+
+    # A window of scalar steps before and after the warm-up's last one agree to within the tolerance
+    window = round(0.5 / game.Timestep)
+    speed, spacing = step_metrics(crowd, step, window)
+    later_speed, later_spacing = step_metrics(crowd, step, window)
+    assert abs(later_speed - speed) <= tolerance * speed
+    assert abs(later_spacing - spacing) <= tolerance * spacing
+
+# The warm-up leaves the crowd where the layout put it (it runs in the crowd's own frame)
+def test_warm_up_stays_in_the_crowd_frame():
+    crowd, start = layout_crowd(1)
+    before = np.reshape(crowd.coords, (-1, 2))[:, 0].mean()
+    warm_up(crowd, lambda: crowd.step(None, start), game.Timestep, max_time = 2)
+    after = np.reshape(crowd.coords, (-1, 2))[:, 0].mean()
+    assert abs(after - before) < 1e-6
+    assert np.allclose([pedestrian.x for pedestrian in crowd.pedestrians], np.reshape(crowd.coords, (-1, 2))[:, 0])
@@ -0,0 +1,37 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_pacing import FramePacer
+
+# A click ends on the first presented frame after the player was stepped towards it, not on earlier frames of the walk
+def test_latency_waits_for_a_step_towards_the_click():
+    pacer = FramePacer('fixed', 60)
+    pacer.click()
+    pacer.stepped()
+    pacer.presented()
+    assert len(pacer.latencies) == 1
+
+    # Walking towards the first target: frames presented before a step towards the new click do not count
+    pacer.click()
+    pacer.presented()
+    pacer.presented()
+    assert len(pacer.latencies) == 1
+    pacer.stepped()
+    pacer.presented()
+    assert len(pacer.latencies) == 2
+
+    # A cancelled click is never measured
+    pacer.click()
+    pacer.cancel_click()
+    pacer.stepped()
+    pacer.presented()
+    assert len(pacer.latencies) == 2
+
+# The physics advances physics_rate steps per second whatever the frame time
+def test_physics_steps_follow_real_time():
+    for frame_time in (1/144, 1/60, 1/24):
+        pacer = FramePacer('fixed', 60, physics_rate = 30)
+        steps = sum(pacer.physics_steps(frame_time) for _ in range(round(10 / frame_time)))
+        assert abs(steps - 300) <= 1
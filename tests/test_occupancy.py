@@ -0,0 +1,50 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from occupancy import OccupancyGrid, fields, load_occupancy, merge_occupancy, save_occupancy
+
+# Random walk along the street, (frames, N, 2) positions and velocities
+def walk(seed, frames = 200, agents = 30):
+    rng = np.random.default_rng(seed)
+    positions = np.cumsum(rng.normal([12, 0], [4, 6], (frames, agents, 2)), axis = 0) + [-100, 400]
+    return positions, rng.normal(0, 50, (frames, agents, 2))
+
+# A tiled grid released segment by segment holds the same sums as one dense grid, with only the visited cells kept
+def test_tiled_grid_matches_dense_grid():
+    dense = OccupancyGrid(-100, 3000, 0, 800, 20)
+    tiled = OccupancyGrid(-100, 3000, 0, 800, 20, 375)
+    positions, velocities = walk(1)
+    for frame, (frame_positions, frame_velocities) in enumerate(zip(positions, velocities)):
+        dense.add(frame_positions, frame_velocities, 0.02)
+        tiled.add(frame_positions, frame_velocities, 0.02)
+        # Release the segments behind the crowd, like the streaming world
+        if frame % 20 == 0:
+            tiled.release(-100, frame_positions[:, 0].min() - 400)
+            assert len(tiled.tiles) <= (np.ptp(frame_positions[:, 0]) + 800) // 375 + 2
+    for field in fields:
+        assert np.allclose(tiled.grid(field), dense.grid(field))
+    tiled.compact()
+    assert not tiled.tiles and len(tiled.cells) == np.count_nonzero(dense.grid('samples'))
+    assert np.allclose(tiled.grid('dwell'), dense.grid('dwell'))
+
+# Saved grids load and merge back to the sums of their sessions, and dense files from before still load
+def test_save_load_and_merge(tmp_path):
+    grids = []
+    for seed in (2, 3):
+        grid = OccupancyGrid(-100, 3000, 0, 800, 20, 375)
+        positions, velocities = walk(seed)
+        grid.add(positions.reshape(-1, 2), velocities.reshape(-1, 2), 0.02)
+        grids.append(grid)
+        save_occupancy(tmp_path / f'occupancy_{seed}.npz', {('H2', 'pedestrians'): grid})
+    merged = merge_occupancy([tmp_path / 'occupancy_2.npz', tmp_path / 'occupancy_3.npz'])[('H2', 'pedestrians')]
+    for field in fields:
+        assert np.allclose(merged.grid(field), grids[0].grid(field) + grids[1].grid(field))
+
+    legacy = {'H2_pedestrians_extent': np.array(grids[0].extent, dtype = float)}
+    legacy.update({f'H2_pedestrians_{field}': grids[0].grid(field).ravel() for field in fields})
+    np.savez(tmp_path / 'legacy.npz', **legacy)
+    loaded = load_occupancy(tmp_path / 'legacy.npz')[('H2', 'pedestrians')]
+    assert np.allclose(loaded.grid('velocity_x'), grids[0].grid('velocity_x'))
@@ -0,0 +1,58 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay import SessionReplay
+from session_store import SessionStore
+
+# Player and pedestrian paths at time t of a trial
+def player_path(t):
+    return 20 + 47 * t, 735 + 10 * np.sin(t)
+
+def pedestrian_path(t):
+    return 2000 - 90 * t, 700 + 5 * np.cos(t)
+
+# Session of two trials (35 s and 20 s) sampled every 0.25 s, with a click just before the first chunk boundary
+def recorded_session(path):
+    store = SessionStore(path)
+    session_id, _ = store.new_session(5)
+    for position, (treatment, seconds) in enumerate((('H2', 35.0), ('H3', 20.0))):
+        trial_id = store.new_trial(session_id, 5, treatment, position, None)
+        for t in np.arange(0, seconds + 0.125, 0.25):
+            store.add_sample(trial_id, t, *player_path(t))
+            store.add_pedestrians(trial_id, t, [0], [pedestrian_path(t)])
+        store.add_click(trial_id, 9.8, 500, 700)
+        store.end_trial(trial_id, seconds, 0, 1)
+    store.close()
+    return session_id
+
+# Seeking either side of the chunk and trial boundaries interpolates the recorded samples, in any order and through the LRU cache
+def test_seek_across_chunk_boundaries(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    session_id = recorded_session(path)
+    replay = SessionReplay(path, session_id, chunk_seconds = 10, cached_chunks = 2)
+    assert replay.duration == 55.0
+
+    times = np.arange(0, 0.25 * 140 + 0.125, 0.25)
+    boundaries = [t + offset for t in (10, 20, 30, 35, 45) for offset in (-0.13, -1e-6, 0, 1e-6, 0.13)]
+    for t in boundaries + boundaries[::-1] + list(np.random.default_rng(0).uniform(0, 55, 40)):
+        trial, local_t, player, pedestrians, clicks = replay.state(t)
+        assert trial['treatment'] == ('H2' if t < 35 else 'H3')
+        assert local_t == pytest.approx(t if t < 35 else t - 35)
+        x, y = player_path(times)
+        assert player == pytest.approx((np.interp(local_t, times, x), np.interp(local_t, times, y)))
+        pedestrian_x, pedestrian_y = pedestrian_path(times)
+        assert pedestrians == [pytest.approx((np.interp(local_t, times, pedestrian_x), np.interp(local_t, times, pedestrian_y)))]
+        # The click before the boundary still shows in the next chunk
+        assert clicks == ([(500, 700)] if 9.8 <= local_t < 10.8 else [])
+        assert len(replay.chunks) <= 2
+
+# An unknown session is reported rather than failing on the missing row
+def test_unknown_session(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    session_id = recorded_session(path)
+    with pytest.raises(ValueError, match = f'No session {session_id + 1}'):
+        SessionReplay(path, session_id + 1)
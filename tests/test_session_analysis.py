@@ -0,0 +1,57 @@
+import os
+import sys
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import main_moving_final as game
+import session_analysis
+from crowd_warmup import warm_up
+from occupancy import OccupancyGrid
+from proximity_events import ProximityEvents
+
+# Scenario with the attributes save_data reads
+def fake_scenario(name, crowded, warmup_stats = None):
+    events = None
+    if crowded:
+        events = ProximityEvents(game.player_radius)
+        # One pedestrian (id 0) walking into the player
+        events.update(0.0, np.array([[0, 60, 735, -90, 0, -1, np.inf, 40, 0]], dtype = float), (20, 735), (0, 0))
+    occupancy = {agent: OccupancyGrid(game.road_start, game.road_end, 0, game.height, game.occupancy_cell_size, game.segment_length) for agent in ('player', 'pedestrians')}
+    log = {'start': 0, 'end': 12000, 'player_position': [(20.0, 735.0), (70.0, 735.0), (120.0, 730.0)],
+           'pedestrian_positions': [[(300.0, 700.0)], [(250.0, 700.0)], [(200.0, 700.0)]] if crowded else [],
+           'cross_road': 1, 'clicks': 4, 'click_position': [(120.0, 730.0)]}
+    return SimpleNamespace(name = name, spec = {**game.scenario_specs[name], 'log_pedestrians': crowded}, log = log, occupancy = occupancy,
+                           events = events, warmup_stats = warmup_stats, layout_index = 3 if crowded else None, time = lambda: 12.0)
+
+# A session saved by the game can be analysed (the extra data has more columns ending in _time than the trial times)
+def test_saved_session_is_analysed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crowd = game.Crowd(game.scenario_specs['H2']['crowd'])
+    crowd.spawn(300, 700, (-100, 700))
+    crowd.spawn(400, 760, (-100, 760))
+    warmup = warm_up(crowd, lambda: crowd.step(None, (20, 735)), game.Timestep, max_time = 0.5)
+    scenarios = {'H1': fake_scenario('H1', False), 'H2': fake_scenario('H2', True, warmup), 'H3': fake_scenario('H3', True, warmup)}
+    # Session stats may end in _time as well
+    game.save_data(7, scenarios, ('H2', 'H3', 'H1'), {'Frame_total_time': 42.0}, {}, {})
+
+    metrics, recomputed = session_analysis.analyse(str(tmp_path), str(tmp_path / 'analysis_cache.db'), workers = 0)
+    assert recomputed == 1
+    (session,) = metrics
+    for name in ('H1', 'H2', 'H3'):
+        assert session[f'{name}_time'] == 12.0
+        assert session[f'{name}_crossings'] == 1
+        assert session[f'{name}_clicks'] == 4
+    assert session['H2_min_distance'] > 0
+    assert 'H2_player_near_miss_time' not in session
+
+    # Only the trial times end in _time
+    import pandas as pd
+    extra = pd.read_csv(tmp_path / 'extra_data_7.csv')
+    assert extra['H2_warmup_seconds'][0] == warmup['seconds'] > 0
+    assert sorted(column for column in extra.columns if column.endswith('_time') and column != 'Frame_total_time') == ['H1_time', 'H2_time', 'H3_time']
+
+    # Unchanged files come from the cache
+    assert session_analysis.analyse(str(tmp_path), str(tmp_path / 'analysis_cache.db'), workers = 0)[1] == 0
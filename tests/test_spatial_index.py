@@ -0,0 +1,63 @@
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStore
+from spatial_index import SpatialIndex
+
+# Session store with two trials of random player samples and pedestrian snapshots, returns every (participant, treatment, agent, x, y)
+def random_store(path, seed = 1):
+    rng = random.Random(seed)
+    store = SessionStore(path)
+    points = []
+    for participant, treatment in ((1, 'H1'), (2, 'H2')):
+        session_id, _ = store.new_session(participant)
+        trial_id = store.new_trial(session_id, participant, treatment, 0, None)
+        for k in range(300):
+            x, y = rng.uniform(0, 2000), rng.uniform(0, 800)
+            store.add_sample(trial_id, k * 0.5, x, y)
+            points.append((participant, treatment, 'player', x, y))
+            positions = [(rng.uniform(0, 2000), rng.uniform(0, 800)) for _ in range(3)]
+            store.add_pedestrians(trial_id, k * 0.5, [0, 1, 2], positions)
+            points += [(participant, treatment, 'pedestrian', px, py) for px, py in positions]
+        store.end_trial(trial_id, 150.0, 0, 0)
+    store.close()
+    return points
+
+# box, radius and nearest return what a scan of every point returns, with and without filters
+def test_queries_match_brute_force(tmp_path):
+    points = random_store(str(tmp_path / 'sessions.db'))
+    index = SpatialIndex(str(tmp_path / 'spatial_index.db'))
+    assert index.update(str(tmp_path / 'sessions.db')) == len(points)
+    assert index.update(str(tmp_path / 'sessions.db')) == 0
+
+    rng = random.Random(2)
+    for _ in range(20):
+        x, y = rng.uniform(-100, 2100), rng.uniform(-100, 900)
+        for filters in ({}, {'treatment': 'H2'}, {'agent': 'player', 'participant': 1}):
+            matching = [point for point in points if all(point[('participant', 'treatment', 'agent').index(key)] == value for key, value in filters.items())]
+
+            x_min, y_min = x - 150, y - 80
+            expected = sorted((px, py) for _, _, _, px, py in matching if x_min <= px <= x + 150 and y_min <= py <= y + 80)
+            assert sorted((row[6], row[7]) for row in index.box(x_min, x + 150, y_min, y + 80, **filters)) == expected
+
+            expected = sorted((px, py) for _, _, _, px, py in matching if (px - x)**2 + (py - y)**2 <= 120**2)
+            assert sorted((row[6], row[7]) for row in index.radius(x, y, 120, **filters)) == expected
+
+            distances = sorted(math.hypot(px - x, py - y) for _, _, _, px, py in matching)
+            nearest = index.nearest(x, y, 5, **filters)
+            assert [math.hypot(row[6] - x, row[7] - y) for row in nearest] == distances[:5]
+
+    # Fewer matches than k, and no matches at all
+    assert len(index.nearest(1000, 400, 2000, agent = 'player', participant = 1)) == 300
+    assert index.nearest(1000, 400, 3, treatment = 'H3') == []
+    index.close()
+
+# An empty index has no nearest points
+def test_nearest_in_empty_index(tmp_path):
+    index = SpatialIndex(str(tmp_path / 'spatial_index.db'))
+    assert index.nearest(0, 0, 3) == []
+    index.close()
@@ -0,0 +1,43 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telemetry import TelemetryPublisher, TelemetryReader
+
+# A reader that fell more than a ring behind gets the records after the slot the game may be rewriting
+def test_reader_keeps_only_complete_records():
+    publisher = TelemetryPublisher(f'telemetry_test_{os.getpid()}', no_slots = 16)
+    reader = TelemetryReader(publisher.block.name)
+    for k in range(40):
+        publisher.click(k, k)
+    records = reader.poll()
+    assert [record['x'] for _, record in records] == list(range(25, 40))
+    assert reader.dropped == 25
+    reader.close()
+    publisher.close()
+
+# A second game does not take over the ring of a running one
+def test_live_ring_is_not_replaced():
+    publisher = TelemetryPublisher(f'telemetry_test_{os.getpid()}')
+    with pytest.raises(FileExistsError):
+        TelemetryPublisher(publisher.block.name)
+    publisher.close()
+
+# The crowd summary of a frame comes from the proximity array of the crowd's last step
+def test_frame_summary_from_proximity():
+    publisher = TelemetryPublisher(f'telemetry_test_{os.getpid()}')
+    reader = TelemetryReader(publisher.block.name)
+    proximity = np.array([[0, 100, 700, 3, 4, -1, np.inf, 80, 0],
+                          [1, 150, 710, 6, 8, 0, 50, 30, 0]], dtype = float)
+    publisher.frame(0.016, (90, 700), (1, 0), 'H2', 1, proximity)
+    publisher.frame(0.016, (90, 700), (1, 0), None, 0)
+    (_, crowded), (_, empty) = reader.poll()
+    assert (crowded['crowd'], crowded['treatment']) == (2, b'H2')
+    assert crowded['crowd_speed'] == pytest.approx(7.5)
+    assert crowded['nearest'] == pytest.approx(30)
+    assert (empty['crowd'], empty['nearest'], empty['treatment']) == (0, -1, b'--')
+    reader.close()
+    publisher.close()
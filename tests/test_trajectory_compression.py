@@ -0,0 +1,59 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStore
+from trajectory_compression import decode_track, decode_varints, encode_track, encode_varints, interpolate_track, reconstruction_error
+
+# Wandering path sampled every 0.5 s
+def random_track(seed, points = 400):
+    rng = np.random.default_rng(seed)
+    times = np.arange(points) * 0.5 + rng.uniform(0, 0.01, points)
+    positions = np.cumsum(rng.normal([40, 0], [15, 10], (points, 2)), axis = 0) + [-600, 700]
+    return times, positions
+
+# Varints round-trip every size of signed 64-bit value
+def test_varints_round_trip():
+    values = np.array([0, 1, -1, 63, -64, 64, 127, 128, -129, 300, 2**31, -2**31, 2**62, -2**63, 2**63 - 1], dtype = np.int64)
+    assert np.array_equal(decode_varints(encode_varints(values)), values)
+    assert len(encode_varints([0, 1, -1, 63, -64])) == 5 # small deltas take one byte each
+    assert len(decode_varints(encode_varints([]))) == 0
+
+# Error bound of a track: tolerance + resolution/sqrt(2) + the distance covered in time_resolution/2
+def error_bound(times, positions, resolution, tolerance, time_resolution = 0.001):
+    speed = (np.hypot(*np.diff(positions, axis = 0).T) / np.diff(times)).max()
+    return (tolerance or 0) + resolution / 2**0.5 + speed * time_resolution / 2 + 1e-9
+
+# The decoded track stays within the error bound of the original at its sample times
+def test_track_round_trip_error():
+    times, positions = random_track(1)
+    for resolution, tolerance in ((0.1, None), (0.1, 0.5), (1.0, 2.0)):
+        data = encode_track(times, positions, resolution, tolerance = tolerance)
+        assert reconstruction_error(times, positions, data) <= error_bound(times, positions, resolution, tolerance)
+    # Simplifying a straight walk keeps only its ends
+    times = np.linspace(0, 25, 50)
+    line = np.column_stack([np.linspace(0, 500, 50), np.full(50, 700.0)])
+    data = encode_track(times, line, 0.1, tolerance = 0.2)
+    assert len(decode_track(data)[0]) == 2
+    assert reconstruction_error(times, line, data) <= error_bound(times, line, 0.1, 0.2)
+
+# With a track_resolution the store keeps the player path as a track (pedestrian -1) with its own tolerance
+def test_store_compresses_player_track(tmp_path):
+    store = SessionStore(str(tmp_path / 'sessions.db'), track_resolution = 0.1, track_tolerance = 0.5, player_track_tolerance = 0.2)
+    session_id, _ = store.new_session(1)
+    trial_id = store.new_trial(session_id, 1, 'H2', 0, None)
+    times, positions = random_track(2)
+    pedestrian_times, pedestrian_positions = random_track(3)
+    for t, (x, y), pedestrian in zip(times, positions, pedestrian_positions):
+        store.add_sample(trial_id, t, x, y)
+        store.add_pedestrians(trial_id, t, [0], [tuple(pedestrian)])
+    store.end_trial(trial_id, float(times[-1]), 0, 0)
+
+    assert store.query('SELECT COUNT(*) FROM samples') == [(0,)]
+    assert sorted(store.pedestrian_tracks(trial_id)) == [0]
+    track_times, track_positions = store.player_track(trial_id)
+    error = np.hypot(*(interpolate_track(track_times, track_positions, times) - positions).T).max()
+    assert error <= error_bound(times, positions, 0.1, 0.2)
+    store.close()
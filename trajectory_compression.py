@@ -0,0 +1,121 @@
+import struct
+import numpy as np
+
+'''
+Trajectory compression.
+
+A track is the path of one agent: an array of times (seconds) and an (N, 2) array of positions (pixels).
+encode_track packs a track into bytes in three stages:
+    1. simplify (optional) - Douglas-Peucker with the synchronised Euclidean distance, ie a point is
+       dropped only if the position interpolated in time between the kept points is within tolerance
+       pixels of it, so the bound also holds for positions looked up by time
+    2. quantise            - positions to multiples of resolution pixels and times to multiples of
+                             time_resolution seconds
+    3. delta/varint encode - differences between consecutive points, zigzag mapped and written as
+                             little-endian base 128 varints (pedestrians walking along the pavement
+                             move a few pixels per sample, so most deltas take one byte)
+decode_track reverses stages 2 and 3 and interpolate_track resamples the kept points at any times
+(track_samples at the evenly spaced times of the points that were encoded).
+The reconstruction error is at most tolerance + resolution/sqrt(2), plus the distance the agent covers
+in time_resolution/2 (the times are quantised too, so a position is looked up at a slightly shifted time).
+'''
+
+header_format = '<ddI' # resolution, time_resolution, number of points
+
+# Indices of the points kept by Douglas-Peucker with the synchronised Euclidean distance
+def simplify(times, positions, tolerance):
+    times = np.asarray(times, dtype = float)
+    positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+    keep = np.zeros(len(positions), dtype = bool)
+    if len(positions) == 0:
+        return np.flatnonzero(keep)
+    keep[[0, -1]] = True
+
+    stack = [(0, len(positions) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        # Positions interpolated in time on the segment from point i to point j
+        span = times[j] - times[i]
+        fraction = (times[i+1:j] - times[i]) / span if span > 0 else np.zeros(j - i - 1)
+        interpolated = positions[i] + fraction[:, None] * (positions[j] - positions[i])
+        errors = np.hypot(*(positions[i+1:j] - interpolated).T)
+        k = int(errors.argmax())
+        if errors[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.extend([(i, k), (k, j)])
+    return np.flatnonzero(keep)
+
+# Zigzag map signed integers to unsigned ones and write them as varints
+def encode_varints(values):
+    values = np.asarray(values, dtype = np.int64)
+    unsigned = ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+    # Bytes needed per value (7 bits each)
+    no_bytes = np.ones(len(unsigned), dtype = np.int64)
+    rest = unsigned >> np.uint64(7)
+    while rest.any():
+        no_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    data = np.empty(int(no_bytes.sum()), dtype = np.uint8)
+    starts = np.cumsum(no_bytes) - no_bytes
+    for k in range(int(no_bytes.max(initial = 0))):
+        active = no_bytes > k
+        low_bits = ((unsigned[active] >> np.uint64(7*k)) & np.uint64(0x7f)).astype(np.uint8)
+        more = (no_bytes[active] > k + 1).astype(np.uint8) << 7 # continuation bit
+        data[starts[active] + k] = low_bits | more
+    return data.tobytes()
+
+# Read the varints written by encode_varints
+def decode_varints(data):
+    data = np.frombuffer(data, dtype = np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lengths = ends - starts + 1
+
+    unsigned = np.zeros(len(ends), dtype = np.uint64)
+    for k in range(int(lengths.max(initial = 0))):
+        active = lengths > k
+        unsigned[active] |= (data[starts[active] + k] & 0x7f).astype(np.uint64) << np.uint64(7*k)
+    return (unsigned >> np.uint64(1)).view(np.int64) ^ -(unsigned & np.uint64(1)).view(np.int64)
+
+# Pack a track into bytes (tolerance None keeps every point)
+def encode_track(times, positions, resolution = 0.1, time_resolution = 0.001, tolerance = None):
+    times = np.asarray(times, dtype = float)
+    positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+    if tolerance is not None:
+        kept = simplify(times, positions, tolerance)
+        times, positions = times[kept], positions[kept]
+
+    columns = [np.round(times / time_resolution), np.round(positions[:, 0] / resolution), np.round(positions[:, 1] / resolution)]
+    deltas = [np.diff(column.astype(np.int64), prepend = 0) for column in columns]
+    return struct.pack(header_format, resolution, time_resolution, len(times)) + encode_varints(np.concatenate(deltas))
+
+# Unpack a track, returns the times and positions of the kept points
+def decode_track(data):
+    resolution, time_resolution, no_points = struct.unpack_from(header_format, data)
+    values = decode_varints(data[struct.calcsize(header_format):]).reshape(3, no_points)
+    columns = np.cumsum(values, axis = 1)
+    return columns[0] * time_resolution, np.column_stack([columns[1], columns[2]]) * resolution
+
+# Positions of a decoded track at the given times (clamped to the ends of the track)
+def interpolate_track(track_times, track_positions, times):
+    return np.column_stack([np.interp(times, track_times, track_positions[:, 0]),
+                            np.interp(times, track_times, track_positions[:, 1])])
+
+# Times and positions of a stored track at points evenly spaced times from first_time to last_time (its samples,
+# which the game takes every data_interval)
+def track_samples(data, first_time, last_time, points):
+    times = np.linspace(first_time, last_time, points)
+    return times, interpolate_track(*decode_track(data), times)
+
+# Largest distance (pixels) between a track and its encoding, compared at the original times
+def reconstruction_error(times, positions, data):
+    positions = np.asarray(positions, dtype = float).reshape(-1, 2)
+    if len(positions) == 0:
+        return 0.0
+    decoded = interpolate_track(*decode_track(data), times)
+    return float(np.hypot(*(decoded - positions).T).max())